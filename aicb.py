@@ -11,7 +11,8 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import torch
-from utils.utils import get_args, get_comp_out, extract_averages, Comp_with_aiob
+from utils.utils import get_args, Comp_with_aiob
+from utils.aiob_profile import ComputeProfile, shared_compute_profile
 from utils.benchmark_logger import bench_logger
 from workload_generator.mocked_model.MockedDeepspeed import DeepspeedForCausalLM
 from workload_generator.mocked_model.MockedMegatron import MegatronModel
@@ -57,23 +58,25 @@ if __name__ == "__main__":
         print("model_param:", args.model_param)
         print("activation_memory:", args.activation_memory)
         if args.comp_filepath == None:
-            local_rank = torch.distributed.get_rank() % torch.cuda.device_count()
-            if local_rank == 0:
-                filepath = get_comp_out(args)
-            else:
-                filepath = get_aiob_path(args)
-            torch.distributed.barrier()
-            compute_cache = extract_averages(filepath,args)
+            compute_profile = shared_compute_profile(args)
         else:
             print("comp_filepath:", args.comp_filepath)
-            compute_cache = extract_averages(args.comp_filepath,args)
-        workload = Comp_with_aiob(workload, compute_cache)
+            compute_profile = ComputeProfile.load(args.comp_filepath, args)
+        workload = Comp_with_aiob(workload, compute_profile)
     if torch.distributed.get_rank() == 0:
         filename = f"{workload_generator.name}_{args.model_name}_sp_{args.enable_sequence_parallel}_iteration_{args.epoch_num}_computationEnable_{args.computation_enable}_{args.world_size}n.csv"
         workload.dump(filename)
     if not args.workload_only :
         applyer = WorkloadApplyer(workload=workload, args=args)
+        if torch.distributed.get_rank() == 0 and (args.live_metrics_file or args.live_metrics_port):
+            bench_logger.enable_live_metrics(
+                filename=args.live_metrics_file,
+                port=args.live_metrics_port,
+                interval=args.live_metrics_interval,
+                total_iterations=args.epoch_num,
+            )
         cpu_time = applyer.apply_workload()
+        bench_logger.stop_live_metrics()
         if torch.distributed.get_rank() == 0:
             bench_logger.analyze_comm_log()
             if args.frame != "collective_test":
@@ -0,0 +1,322 @@
+"""
+Copyright (c) 2021, Alibaba Group;
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Fit alpha-beta latency models from AICB comm logs and predict comm time.
+
+python -m log_analyzer.alpha_beta fit results/comm_logs/*_log.csv -o results/alpha_beta.json
+python -m log_analyzer.alpha_beta predict results/alpha_beta.json --comm_type all_reduce \
+  --comm_group tp_group --group_size 8 --msg_size "64.0 MB"
+python -m log_analyzer.alpha_beta estimate results/alpha_beta.json results/mocked_workload/xxx_workload.csv
+
+For every (comm_type, comm_group, group_size) the elapsed time is modeled as
+time_ms = alpha + beta * msg_size, piecewise over message-size ranges so that
+protocol/algorithm switches (e.g. NCCL LL -> Simple) get their own segment.
+Each segment is fitted with Huber-weighted least squares on relative
+residuals; breakpoints are chosen by dynamic programming and the number of
+segments by BIC.
+"""
+
+import argparse
+import json
+import math
+import numpy as np
+import pandas as pd
+from log_analyzer.utils import convert_msg_to_size, convert_size_to_msg
+
+HUBER_C = 1.345
+# relative residual above which the segment cost grows linearly instead of quadratically
+COST_DELTA = 0.1
+IRLS_ITERS = 20
+
+
+def _name(value):
+    """CommType.all_reduce / 'CommType.all_reduce' / 'all_reduce' -> 'all_reduce'"""
+    if hasattr(value, "name"):
+        return value.name
+    return str(value).split(".")[-1]
+
+
+def _group_size(value):
+    try:
+        value = int(float(value))
+    except (TypeError, ValueError):
+        return 0
+    return max(value, 0)
+
+
+def _huber_weights(r, scale):
+    u = np.abs(r) / (HUBER_C * scale)
+    return np.where(u <= 1, 1.0, 1.0 / np.maximum(u, 1e-12))
+
+
+def fit_segment(x, t):
+    """Robust fit of t = alpha + beta * x with alpha, beta >= 0, on relative residuals.
+
+    Returns (alpha, beta, cost) where cost is the Huber loss of the relative residuals.
+    """
+    x, t = np.asarray(x, dtype=float), np.asarray(t, dtype=float)
+    rel_w = 1.0 / t
+    if np.ptp(x) == 0:
+        alpha, beta = float(np.median(t)), 0.0
+    else:
+        # scale x for conditioning, beta is converted back below
+        x_scale = x.max()
+        A = np.stack([np.ones_like(x), x / x_scale], axis=1)
+        w = np.ones_like(x)
+        coef = np.zeros(2)
+        for _ in range(IRLS_ITERS):
+            sw = np.sqrt(w) * rel_w
+            coef_new = np.linalg.lstsq(A * sw[:, None], t * sw, rcond=None)[0]
+            if coef_new[1] < 0:
+                coef_new = np.array([np.average(t, weights=w * rel_w ** 2), 0.0])
+            elif coef_new[0] < 0:
+                xs = A[:, 1]
+                coef_new = np.array([0.0, np.sum(w * rel_w ** 2 * xs * t) / np.sum(w * rel_w ** 2 * xs * xs)])
+            r = (t - A @ coef_new) * rel_w
+            scale = max(1.4826 * np.median(np.abs(r - np.median(r))), 1e-6)
+            w = _huber_weights(r, scale)
+            converged = np.allclose(coef_new, coef, rtol=1e-9, atol=1e-15)
+            coef = coef_new
+            if converged:
+                break
+        alpha, beta = float(coef[0]), float(coef[1] / x_scale)
+    r = np.abs((t - alpha - beta * x) * rel_w)
+    cost = float(np.sum(np.where(r <= COST_DELTA, 0.5 * r ** 2, COST_DELTA * (r - 0.5 * COST_DELTA))))
+    return alpha, beta, cost
+
+
+class PiecewiseAlphaBeta:
+    """Piecewise alpha-beta model: segments of (lo, hi, alpha_ms, beta_ms_per_byte)."""
+
+    def __init__(self, segments, n_samples=0, rel_rmse=None):
+        self.segments = sorted(segments, key=lambda s: s[0])
+        self.n_samples = n_samples
+        self.rel_rmse = rel_rmse
+        # a message size belongs to the segment whose range it is closest to (geometrically)
+        self.breakpoints = np.array([
+            math.sqrt(max(prev[1], 1) * max(nxt[0], 1)) for prev, nxt in zip(self.segments, self.segments[1:])
+        ])
+
+    @classmethod
+    def fit(cls, msg_size, elapsed_time, max_segments=3, min_sizes_per_segment=3):
+        msg_size, elapsed_time = np.asarray(msg_size, dtype=float), np.asarray(elapsed_time, dtype=float)
+        order = np.argsort(msg_size, kind="stable")
+        msg_size, elapsed_time = msg_size[order], elapsed_time[order]
+        sizes, starts = np.unique(msg_size, return_index=True)
+        bounds = list(starts) + [len(msg_size)]
+        m, n = len(sizes), len(msg_size)
+        max_segments = max(1, min(max_segments, m // min_sizes_per_segment))
+
+        seg_cache = {}
+
+        def seg(i, j):
+            if (i, j) not in seg_cache:
+                lo, hi = bounds[i], bounds[j]
+                seg_cache[(i, j)] = fit_segment(msg_size[lo:hi], elapsed_time[lo:hi])
+            return seg_cache[(i, j)]
+
+        # best[k][j]: (cost, split) for the first j unique sizes in k segments
+        best = [dict() for _ in range(max_segments + 1)]
+        best[0][0] = (0.0, None)
+        min_width = min_sizes_per_segment if max_segments > 1 else 1
+        for k in range(1, max_segments + 1):
+            for j in range(1, m + 1):
+                candidates = [(best[k - 1][i][0] + seg(i, j)[2], i) for i in best[k - 1] if j - i >= min_width]
+                if candidates:
+                    best[k][j] = min(candidates)
+
+        best_bic, best_k = None, 1
+        for k in range(1, max_segments + 1):
+            if m not in best[k]:
+                continue
+            bic = n * math.log(best[k][m][0] / n + 1e-12) + 2 * k * math.log(max(n, 2))
+            if best_bic is None or bic < best_bic:
+                best_bic, best_k = bic, k
+
+        segments, j = [], m
+        for k in range(best_k, 0, -1):
+            i = best[k][j][1]
+            alpha, beta, _ = seg(i, j)
+            segments.append((float(sizes[i]), float(sizes[j - 1]), alpha, beta))
+            j = i
+        model = cls(segments, n_samples=n)
+        rel = (model.predict(msg_size) - elapsed_time) / elapsed_time
+        model.rel_rmse = float(np.sqrt(np.mean(rel ** 2)))
+        return model
+
+    def predict(self, msg_size):
+        """Predicted elapsed time (ms) for a message size or an array of sizes (bytes)."""
+        size = np.asarray(msg_size, dtype=float)
+        idx = np.searchsorted(self.breakpoints, size)
+        alpha = np.array([s[2] for s in self.segments])[idx]
+        beta = np.array([s[3] for s in self.segments])[idx]
+        return alpha + beta * size
+
+    def to_dict(self):
+        return {
+            "segments": [
+                {"lo": lo, "hi": hi, "alpha_ms": alpha, "beta_ms_per_byte": beta,
+                 "bw_GBps": round(1e3 / beta / 1024 ** 3, 3) if beta > 0 else None}
+                for lo, hi, alpha, beta in self.segments
+            ],
+            "n_samples": self.n_samples,
+            "rel_rmse": self.rel_rmse,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        segments = [(s["lo"], s["hi"], s["alpha_ms"], s["beta_ms_per_byte"]) for s in d["segments"]]
+        return cls(segments, d.get("n_samples", 0), d.get("rel_rmse"))
+
+
+class AlphaBetaModels:
+    """Fitted models keyed by (comm_type, comm_group, group_size)."""
+
+    def __init__(self, models=None):
+        self.models = models or {}
+        self._warned = set()
+
+    @staticmethod
+    def load_samples(csv_files):
+        frames = []
+        for csv_file in csv_files:
+            df = pd.read_csv(csv_file)
+            df = df[~df["comm_type"].astype(str).str.contains("computation|epoch_end|barrier")]
+            df = pd.DataFrame({
+                "comm_type": df["comm_type"].map(_name),
+                "comm_group": df["comm_group"].map(_name),
+                "group_size": df["comm_group_size"].map(_group_size) if "comm_group_size" in df else 0,
+                "msg_size": pd.to_numeric(df["msg_size"], errors="coerce"),
+                "elapsed_time": pd.to_numeric(df["_elapsed_time"], errors="coerce"),
+            })
+            frames.append(df[(df["elapsed_time"] > 0) & df["msg_size"].notna()])
+        return pd.concat(frames, ignore_index=True)
+
+    @classmethod
+    def fit(cls, samples: pd.DataFrame, max_segments=3, min_samples=5):
+        models = {}
+        for key, group in samples.groupby(["comm_type", "comm_group", "group_size"]):
+            if len(group) < min_samples:
+                print(f"WARNING: skip {key}, only {len(group)} samples")
+                continue
+            models[(key[0], key[1], int(key[2]))] = PiecewiseAlphaBeta.fit(
+                group["msg_size"].to_numpy(), group["elapsed_time"].to_numpy(), max_segments
+            )
+        return cls(models)
+
+    def lookup(self, comm_type, comm_group, group_size):
+        key = (_name(comm_type), _name(comm_group), _group_size(group_size))
+        if key in self.models:
+            return self.models[key]
+        # fall back to the closest group size of the same comm_type/comm_group, then of the same comm_type
+        for same in (lambda k: k[:2] == key[:2], lambda k: k[0] == key[0]):
+            candidates = [k for k in self.models if same(k)]
+            if candidates:
+                nearest = min(candidates, key=lambda k: abs(k[2] - key[2]))
+                if key not in self._warned:
+                    self._warned.add(key)
+                    print(f"WARNING: no model for {key}, using {nearest}")
+                return self.models[nearest]
+        return None
+
+    def predict(self, comm_type, comm_group, group_size, msg_size):
+        model = self.lookup(comm_type, comm_group, group_size)
+        if model is None:
+            return None
+        return float(model.predict(msg_size))
+
+    def estimate_workload(self, workload_items):
+        """Sum of predicted comm time (ms) over workload items, returned with a per-comm_type breakdown."""
+        total, by_type = 0.0, {}
+        for item in workload_items:
+            comm_type = _name(item["comm_type"])
+            if comm_type in ("computation", "epoch_end", "barrier"):
+                continue
+            t = self.predict(comm_type, item["comm_group"], item.get("comm_group_size"), float(item["msg_size"]))
+            if t is None:
+                continue
+            t *= float(item.get("count", 1) or 1)
+            total += t
+            by_type[comm_type] = by_type.get(comm_type, 0.0) + t
+        return total, by_type
+
+    def save(self, filename):
+        data = [
+            dict(comm_type=k[0], comm_group=k[1], group_size=k[2], **model.to_dict())
+            for k, model in sorted(self.models.items())
+        ]
+        with open(filename, "w") as f:
+            json.dump(data, f, indent=2)
+        return filename
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            data = json.load(f)
+        return cls(dict(
+            ((d["comm_type"], d["comm_group"], d["group_size"]), PiecewiseAlphaBeta.from_dict(d)) for d in data
+        ))
+
+
+def _parse_msg_size(s):
+    try:
+        return float(s)
+    except ValueError:
+        return convert_msg_to_size(s)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Alpha-beta comm performance model")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    fit_parser = sub.add_parser("fit", help="fit models from comm log CSVs")
+    fit_parser.add_argument("files", nargs="+")
+    fit_parser.add_argument("-o", "--output", default="results/alpha_beta.json")
+    fit_parser.add_argument("--max_segments", type=int, default=3)
+    predict_parser = sub.add_parser("predict", help="predict the elapsed time of one collective")
+    predict_parser.add_argument("model")
+    predict_parser.add_argument("--comm_type", required=True)
+    predict_parser.add_argument("--comm_group", required=True)
+    predict_parser.add_argument("--group_size", type=int, required=True)
+    predict_parser.add_argument("--msg_size", required=True, help='bytes, or e.g. "64.0 MB"')
+    estimate_parser = sub.add_parser("estimate", help="estimate the comm time of a workload CSV")
+    estimate_parser.add_argument("model")
+    estimate_parser.add_argument("workload")
+    args = parser.parse_args()
+
+    if args.cmd == "fit":
+        models = AlphaBetaModels.fit(AlphaBetaModels.load_samples(args.files), args.max_segments)
+        models.save(args.output)
+        for (comm_type, comm_group, group_size), model in sorted(models.models.items()):
+            segs = ", ".join(
+                f"[{convert_size_to_msg(lo)}, {convert_size_to_msg(hi)}] alpha={alpha * 1e3:.1f}us "
+                f"bw={(1e3 / beta / 1024 ** 3) if beta > 0 else float('inf'):.2f}GB/s"
+                for lo, hi, alpha, beta in model.segments
+            )
+            print(f"{comm_type:<16} {comm_group:<10} n={group_size:<5} rel_rmse={model.rel_rmse:.3f} {segs}")
+        print(f"Alpha-beta models saved to {args.output}")
+    elif args.cmd == "predict":
+        models = AlphaBetaModels.load(args.model)
+        t = models.predict(args.comm_type, args.comm_group, args.group_size, _parse_msg_size(args.msg_size))
+        print(f"{t:.4f} ms" if t is not None else f"no model for {args.comm_type}")
+    else:
+        models = AlphaBetaModels.load(args.model)
+        df = pd.read_csv(args.workload)
+        df = df[pd.to_numeric(df["msg_size"], errors="coerce").notna()]
+        total, by_type = models.estimate_workload(df.to_dict("records"))
+        for comm_type, t in sorted(by_type.items(), key=lambda kv: -kv[1]):
+            print(f"{comm_type:<16} {t:.3f} ms")
+        print(f"estimated comm time: {total:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
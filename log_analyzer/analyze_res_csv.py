@@ -1,38 +1,146 @@
+import argparse
+import numpy as np
 import pandas as pd
 from log_analyzer.utils import convert_msg_to_size, convert_size_to_msg
-import sys
 
-def analyze_csv(file_path):
-    df = pd.read_csv(file_path)
+KEY_COLUMNS = ['comm_type', 'comm_group', 'msg_size']
+PARQUET_SUFFIXES = ('.parquet', '.pq')
 
-    df = df.dropna(subset=['busbw'])
 
+def _prepare(df):
+    df = df[KEY_COLUMNS + ['busbw']].copy()
     df['busbw'] = pd.to_numeric(df['busbw'], errors='coerce')
+    return df.dropna(subset=['busbw'])
 
-    df = df.dropna(subset=['busbw'])
 
-    def exclude_min(group):
-        if len(group) > 1:
-            group = group.sort_values(by='busbw')
-            return group.iloc[2:]
-        return group
+def read_frames(file_path, chunksize=None):
+    """Yield the key and busbw columns of a comm log CSV (or Parquet) file, chunksize rows at a time."""
+    columns = KEY_COLUMNS + ['busbw']
+    if file_path.endswith(PARQUET_SUFFIXES):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Reading Parquet comm logs requires pyarrow, please `pip install pyarrow`")
+        parquet_file = pq.ParquetFile(file_path)
+        if chunksize is None:
+            yield _prepare(parquet_file.read(columns=columns).to_pandas())
+            return
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+            yield _prepare(batch.to_pandas())
+        return
+    if chunksize is None:
+        yield _prepare(pd.read_csv(file_path, usecols=columns))
+        return
+    for chunk in pd.read_csv(file_path, usecols=columns, chunksize=chunksize):
+        yield _prepare(chunk)
 
-    df_excluded_min = df.groupby(['comm_type', 'comm_group', 'msg_size']).apply(exclude_min).reset_index(drop=True)
-    grouped = df_excluded_min.groupby(['comm_type', 'comm_group', 'msg_size']).agg(
+
+def trim_mask(df, drop_lowest=2, drop_highest=0, method='rank', iqr_factor=1.5):
+    """Boolean mask of the busbw samples kept in each (comm_type, comm_group, msg_size) group.
+
+    method='rank' drops the drop_lowest lowest and drop_highest highest samples of
+    every group with more than one sample; method='iqr' keeps the samples within
+    iqr_factor * IQR of the group quartiles.
+    """
+    grouped = df.groupby(KEY_COLUMNS, sort=False)['busbw']
+    if method == 'iqr':
+        q1 = grouped.transform('quantile', 0.25)
+        q3 = grouped.transform('quantile', 0.75)
+        iqr = q3 - q1
+        return df['busbw'].between(q1 - iqr_factor * iqr, q3 + iqr_factor * iqr)
+    assert method == 'rank', f"unknown trim method {method}"
+    rank = grouped.rank(method='first')
+    size = grouped.transform('size')
+    return (size <= 1) | ((rank > drop_lowest) & (rank <= size - drop_highest))
+
+
+def _aggregate(df):
+    return df.groupby(KEY_COLUMNS).agg(
         busbw_mean=('busbw', 'mean'),
         busbw_max=('busbw', 'max'),
         busbw_min=('busbw', 'min'),
         busbw_std=('busbw', 'std'),
         occurrence_count=('busbw', 'size')
     ).reset_index()
+
+
+def _extremes(df, n, largest):
+    """The n lowest (or highest) busbw samples of every group."""
+    if n == 0:
+        return df.iloc[:0]
+    return df.sort_values('busbw', ascending=not largest, kind='stable').groupby(KEY_COLUMNS, sort=False).head(n)
+
+
+def _analyze_chunked_rank(frames, drop_lowest, drop_highest):
+    # per group running count/sum/sum of squares plus the drop_lowest + 1 lowest
+    # and drop_highest + 1 highest samples; enough to remove the trimmed samples
+    # exactly and to know the min/max of what is kept
+    totals, lowest, highest = None, None, None
+    for df in frames:
+        df = df.assign(busbw_sq=df['busbw'] ** 2)
+        chunk_totals = df.groupby(KEY_COLUMNS).agg(
+            n=('busbw', 'size'), s=('busbw', 'sum'), sq=('busbw_sq', 'sum'))
+        totals = chunk_totals if totals is None else totals.add(chunk_totals, fill_value=0)
+        df = df[KEY_COLUMNS + ['busbw']]
+        lowest = _extremes(df if lowest is None else pd.concat([lowest, df]), drop_lowest + 1, False)
+        highest = _extremes(df if highest is None else pd.concat([highest, df]), drop_highest + 1, True)
+    if totals is None:
+        return _aggregate(pd.DataFrame(columns=KEY_COLUMNS + ['busbw']))
+
+    def nth(extremes, k, largest):
+        ordered = extremes.sort_values('busbw', ascending=not largest, kind='stable').groupby(KEY_COLUMNS)
+        dropped = ordered.head(k).assign(busbw_sq=lambda d: d['busbw'] ** 2).groupby(KEY_COLUMNS)[['busbw', 'busbw_sq']].sum()
+        return dropped, ordered.nth(k).set_index(KEY_COLUMNS)['busbw']
+
+    low_dropped, kept_min = nth(lowest, drop_lowest, False)
+    high_dropped, kept_max = nth(highest, drop_highest, True)
+    result = totals.copy()
+    trimmed = result['n'] > 1
+    for dropped, k in ((low_dropped, drop_lowest), (high_dropped, drop_highest)):
+        dropped = dropped.reindex(result.index, fill_value=0)
+        result.loc[trimmed, 's'] -= dropped.loc[trimmed, 'busbw']
+        result.loc[trimmed, 'sq'] -= dropped.loc[trimmed, 'busbw_sq']
+        result.loc[trimmed, 'n'] -= k
+    result = result[result['n'] > 0]
+    n = result['n']
+    result['busbw_mean'] = result['s'] / n
+    var = (result['sq'] - result['s'] ** 2 / n) / (n - 1)
+    result['busbw_std'] = np.sqrt(var.clip(lower=0)).where(n > 1)
+    all_min = lowest.groupby(KEY_COLUMNS)['busbw'].min()
+    all_max = highest.groupby(KEY_COLUMNS)['busbw'].max()
+    result['busbw_min'] = kept_min.reindex(result.index).where(totals.loc[result.index, 'n'] > 1, all_min)
+    result['busbw_max'] = kept_max.reindex(result.index).where(totals.loc[result.index, 'n'] > 1, all_max)
+    result['occurrence_count'] = n.astype(int)
+    return result[['busbw_mean', 'busbw_max', 'busbw_min', 'busbw_std', 'occurrence_count']].reset_index()
+
+
+def analyze_csv(file_path, drop_lowest=2, drop_highest=0, method='rank', iqr_factor=1.5, chunksize=None):
+    """busbw mean/max/min/std per (comm_type, comm_group, msg_size) after trimming outliers.
+
+    With chunksize set the file is streamed; rank trimming is then computed
+    exactly from running sums and per-group extremes, while IQR trimming,
+    which needs the full distribution, keeps only the key and busbw columns
+    in memory.
+    """
+    frames = read_frames(file_path, chunksize)
+    if chunksize is not None and method == 'rank':
+        grouped = _analyze_chunked_rank(frames, drop_lowest, drop_highest)
+    else:
+        df = pd.concat(frames, ignore_index=True)
+        df = df[trim_mask(df, drop_lowest, drop_highest, method, iqr_factor)]
+        grouped = _aggregate(df)
     grouped['msg_size'] = grouped['msg_size'].apply(convert_size_to_msg)
     return grouped
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print("Usage: python -m log_analyzer.analyze_res_csv <path_to_csv>")
-        sys.exit(1)
-    grouped = analyze_csv(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Summarize busbw of an AICB comm log CSV or Parquet file")
+    parser.add_argument('file_path')
+    parser.add_argument('--trim', choices=['rank', 'iqr'], default='rank')
+    parser.add_argument('--drop_lowest', type=int, default=2, help="Lowest busbw samples dropped per group (rank trim)")
+    parser.add_argument('--drop_highest', type=int, default=0, help="Highest busbw samples dropped per group (rank trim)")
+    parser.add_argument('--iqr_factor', type=float, default=1.5)
+    parser.add_argument('--chunksize', type=int, default=None, help="Stream the file this many rows at a time")
+    args = parser.parse_args()
+    grouped = analyze_csv(args.file_path, args.drop_lowest, args.drop_highest, args.trim, args.iqr_factor, args.chunksize)
     print(grouped)
-
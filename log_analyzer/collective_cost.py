@@ -0,0 +1,369 @@
+"""
+Copyright (c) 2021, Alibaba Group;
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Analytic cost of collectives under several algorithms, with NCCL-like selection.
+
+python -m log_analyzer.collective_cost predict --comm_type all_reduce --group_size 64 --msg_size "64.0 MB"
+python -m log_analyzer.collective_cost sweep --comm_type all_reduce --group_size 1024 --net_bw 50
+python -m log_analyzer.collective_cost estimate --workload results/mocked_workload/<workload>.pkl
+python -m log_analyzer.collective_cost estimate --world_size 256 --tensor_model_parallel_size 8 \
+  --num_layers 40 --hidden_size 5120 --num_attention_heads 40 --global_batch 1024
+
+A group of n ranks has local_size ranks on each of its nodes (by default
+the group fills nodes of gpus_per_node GPUs), linked by NVLink at
+--intra_bw GB/s per GPU and by one network rail of --net_bw GB/s per GPU.
+Every algorithm is an alpha-beta model over these links:
+- ring: n - 1 (all_gather, reduce_scatter, broadcast, reduce) or
+  2(n - 1) (all_reduce) steps limited by the slowest hop
+- tree: NCCL double binary tree all_reduce (chains within nodes, a
+  binary tree across nodes), binomial trees for broadcast/reduce
+- recursive_doubling: log2(n) exchange steps (recursive halving for
+  reduce_scatter), two extra steps when n is not a power of two
+- hierarchical: intra-node reduce_scatter, inter-node ring on every rail,
+  intra-node all_gather
+- direct: all_to_all and isend/irecv send to every peer at once
+Each algorithm runs with the LL, LL128 and Simple protocols, whose base
+latency, per-hop latency and bandwidth efficiency are close to the NCCL
+tuning defaults. Like NCCL, auto selection takes the fastest algorithm and
+protocol of each op; --algorithms restricts the candidates, e.g. to
+ring,tree,direct for the algorithms NCCL implements. Times are in ms like
+comm logs and every function takes arrays of group and message sizes.
+"""
+
+import time
+import argparse
+import dataclasses
+from collections import defaultdict
+import numpy as np
+from utils.utils import CommGroup, CommType
+from log_analyzer.utils import convert_msg_to_size, convert_size_to_msg
+
+GB = 1024 ** 3
+# bandwidth efficiency, base latency (us) and per-hop latency (us) on NVLink and on the network
+PROTOCOLS = {
+    "LL": {"bw": 0.5, "base_us": 6.6, "intra_us": 0.6, "inter_us": 2.7},
+    "LL128": {"bw": 0.92, "base_us": 14.0, "intra_us": 1.25, "inter_us": 4.0},
+    "Simple": {"bw": 1.0, "base_us": 8.4, "intra_us": 3.4, "inter_us": 14.0},
+}
+ALGORITHMS = {
+    CommType.all_reduce: ("ring", "tree", "recursive_doubling", "hierarchical"),
+    CommType.all_gather: ("ring", "recursive_doubling", "hierarchical"),
+    CommType.reduce_scatter: ("ring", "recursive_doubling", "hierarchical"),
+    CommType.broadcast: ("ring", "tree"),
+    CommType.reduce: ("ring", "tree"),
+    CommType.all_to_all: ("direct",),
+    CommType.isend: ("direct",),
+    CommType.irecv: ("direct",),
+}
+NCCL_ALGORITHMS = ("ring", "tree", "direct")
+ALIASES = {
+    CommType.all_gather_into_tensor: CommType.all_gather,
+    CommType.reduce_scatter_tensor: CommType.reduce_scatter,
+    CommType.barrier: CommType.all_reduce,
+}
+
+
+@dataclasses.dataclass
+class NetworkParams:
+    gpus_per_node: int = 8
+    intra_bw: float = 200.0  # GB/s per GPU over NVLink
+    net_bw: float = 50.0  # GB/s per GPU over its network rail
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.gpus_per_node, args.intra_bw, args.net_bw)
+
+
+class _Links:
+    """Per-op link latencies (ms) and bandwidths (bytes/ms) of one protocol."""
+
+    def __init__(self, n, local, params, protocol):
+        proto = PROTOCOLS[protocol]
+        self.n = n
+        self.local = local
+        self.nodes = np.ceil(n / local)
+        self.cross = self.nodes > 1
+        self.base = proto["base_us"] / 1e3
+        self.a_intra = proto["intra_us"] / 1e3
+        self.a_inter = proto["inter_us"] / 1e3
+        self.b_intra = params.intra_bw * proto["bw"] * GB / 1e3
+        self.b_inter = params.net_bw * proto["bw"] * GB / 1e3
+        # a step all ranks take together is as slow as the slowest hop; rings and trees
+        # run one channel per rail, so their node to node hops use the rails of all local ranks
+        self.a_step = np.where(self.cross, self.a_inter, self.a_intra)
+        self.b_step = np.where(self.cross, np.minimum(self.b_intra, self.b_inter * local), self.b_intra)
+
+
+def _log2(x):
+    return np.ceil(np.log2(np.maximum(x, 1)))
+
+
+def _ring(comm_type, size, l):
+    n = l.n
+    # as in NCCL, only the steps entering a new node pay the network latency
+    if comm_type == CommType.all_reduce:
+        steps, inter_steps = 2 * (n - 1), np.where(l.cross, 2 * l.nodes, 0)
+        data = 2 * (n - 1) / n * size
+    elif comm_type in (CommType.all_gather, CommType.reduce_scatter):
+        steps, inter_steps = n - 1, l.nodes - 1
+        data = (n - 1) / n * size
+    else:
+        # broadcast/reduce pipeline the message along the ring
+        steps, inter_steps = n - 1, l.nodes - 1
+        data = size
+    inter_steps = np.minimum(inter_steps, steps)
+    return (steps - inter_steps) * l.a_intra + inter_steps * l.a_inter + data / l.b_step
+
+
+def _tree(comm_type, size, l):
+    depth = (l.local - 1) * l.a_intra + _log2(l.nodes) * l.a_inter
+    if comm_type == CommType.all_reduce:
+        # reduce up and broadcast down, each tree carrying half of the message
+        return 2 * depth + 2 * size / l.b_step
+    # binomial tree, every level forwards the whole message
+    intra_levels = np.minimum(_log2(l.local), _log2(l.n))
+    inter_levels = _log2(l.n) - intra_levels
+    return intra_levels * (l.a_intra + size / l.b_intra) + inter_levels * (l.a_inter + size / l.b_inter)
+
+
+def _recursive_doubling(comm_type, size, l):
+    steps = _log2(l.n)
+    # partners at distances below the local power of two stay within the node
+    intra_steps = np.minimum(np.floor(np.log2(np.maximum(l.local, 1))), steps)
+    inter_steps = steps - intra_steps
+    # non power of two groups fold the extra ranks in before and out after
+    extra = np.where(2 ** steps != l.n, 2, 0) * (l.a_step + size / l.b_step)
+    if comm_type == CommType.all_reduce:
+        return intra_steps * (l.a_intra + size / l.b_intra) + inter_steps * (l.a_inter + size / l.b_inter) + extra
+    intra_ranks = 2 ** intra_steps
+    return (
+        intra_steps * l.a_intra + inter_steps * l.a_inter
+        + (intra_ranks - 1) / l.n * size / l.b_intra
+        + (l.n - intra_ranks) / l.n * size / l.b_inter
+        + extra
+    )
+
+
+def _hierarchical(comm_type, size, l):
+    p, k = np.minimum(l.local, l.n), l.nodes
+    # the local_size rails each carry 1 / local_size of the message between nodes
+    intra = (p - 1) * l.a_intra + (p - 1) / p * size / l.b_intra
+    inter = (k - 1) * l.a_inter + (k - 1) / k * size / p / l.b_inter
+    if comm_type == CommType.all_reduce:
+        return 2 * intra + 2 * inter
+    return intra + inter
+
+
+def _direct(comm_type, size, l):
+    if comm_type == CommType.all_to_all:
+        intra_peers = np.minimum(l.local, l.n) - 1
+        inter_peers = l.n - 1 - intra_peers
+        # NVLink and network transfers overlap
+        return l.a_step + np.maximum(intra_peers / l.n * size / l.b_intra, inter_peers / l.n * size / l.b_inter)
+    return l.a_step + size / l.b_step
+
+
+COST_MODELS = {
+    "ring": _ring,
+    "tree": _tree,
+    "recursive_doubling": _recursive_doubling,
+    "hierarchical": _hierarchical,
+    "direct": _direct,
+}
+
+
+def _normalize(comm_type, group_size, msg_size, local_size, params):
+    comm_type = CommType(getattr(comm_type, "value", comm_type))
+    comm_type = ALIASES.get(comm_type, comm_type)
+    size = np.asarray(msg_size, dtype=float)
+    n = np.broadcast_to(np.asarray(group_size, dtype=float), size.shape)
+    if comm_type in (CommType.isend, CommType.irecv):
+        # the group of a p2p op is the sender and the receiver
+        n = np.full(size.shape, 2.0)
+    if local_size is None:
+        local = np.minimum(n, params.gpus_per_node)
+    else:
+        local = np.minimum(np.broadcast_to(np.asarray(local_size, dtype=float), size.shape), n)
+    return comm_type, np.maximum(n, 1), size, np.maximum(local, 1)
+
+
+def algorithm_times(comm_type, group_size, msg_size, local_size=None, params=None, algorithms=None):
+    """{(algorithm, protocol): time ms array} of every candidate for the ops of one comm_type."""
+    params = params or NetworkParams()
+    comm_type, n, size, local = _normalize(comm_type, group_size, msg_size, local_size, params)
+    candidates = [a for a in ALGORITHMS.get(comm_type, ()) if algorithms is None or a in algorithms]
+    times = {}
+    for protocol in PROTOCOLS:
+        links = _Links(n, local, params, protocol)
+        for algorithm in candidates:
+            t = links.base + COST_MODELS[algorithm](comm_type, size, links)
+            # a single rank does not communicate
+            times[(algorithm, protocol)] = np.where(n > 1, t, 0.0)
+    return times
+
+
+def select(comm_type, group_size, msg_size, local_size=None, params=None, algorithms=None):
+    """(time ms array, [(algorithm, protocol)] candidates, index array of the fastest candidate)."""
+    times = algorithm_times(comm_type, group_size, msg_size, local_size, params, algorithms)
+    size = np.asarray(msg_size, dtype=float)
+    if not times:
+        return np.zeros(size.shape), [], np.full(size.shape, -1)
+    candidates = list(times)
+    stacked = np.stack([times[c] for c in candidates])
+    best = np.argmin(stacked, axis=0)
+    return np.take_along_axis(stacked, best[None], axis=0)[0], candidates, best
+
+
+def collective_time(comm_type, group_size, msg_size, local_size=None, params=None, algorithm="auto"):
+    """Time in ms of the ops, with the fastest algorithm or with `algorithm` and its fastest protocol."""
+    algorithms = None if algorithm == "auto" else (algorithm,)
+    return select(comm_type, group_size, msg_size, local_size, params, algorithms)[0]
+
+
+def group_layout(args, gpus_per_node):
+    """{comm_group: (group size, ranks per node)} of the rank groups of args on nodes of gpus_per_node."""
+    from utils.utils import RankGenerator
+    from workload_generator.placement import GROUP_TOKENS, RANK_ORDER
+
+    generator = RankGenerator(
+        tp=args.tensor_model_parallel_size,
+        ep=args.expert_model_parallel_size,
+        dp=args.dp_num,
+        pp=args.pipeline_model_parallel,
+        cp=args.context_parallel_size,
+        order=RANK_ORDER,
+    )
+    layout = {CommGroup.all: (generator.world_size, min(generator.world_size, gpus_per_node))}
+    for comm_group, (token, independent_ep) in GROUP_TOKENS.items():
+        group = np.array(generator.get_ranks(token, independent_ep)[0])
+        nodes = group // gpus_per_node
+        layout[comm_group] = (len(group), int((nodes == nodes[0]).sum()))
+    return layout
+
+
+def estimate_volume(volume, layout=None, params=None, algorithms=None):
+    """Comm time (ms) of a {(comm_type, comm_group, group_size, msg_size): count} volume.
+
+    Returns the total, {comm_type: ms} and {comm_type: {"algorithm/protocol": ops}}.
+    layout gives the size and ranks per node of the groups without a group size.
+    """
+    params = params or NetworkParams()
+    layout = layout or {}
+    by_type = defaultdict(list)
+    for (comm_type, comm_group, group_size, msg_size), count in volume.items():
+        if comm_type in (CommType.computation, CommType.epoch_end) or msg_size is None:
+            continue
+        n, local = layout.get(comm_group, (group_size or 1, None))
+        if group_size:
+            n = group_size
+        by_type[comm_type].append((n, msg_size, local if local is not None else min(n, params.gpus_per_node), count))
+    total, times, choices = 0.0, {}, {}
+    for comm_type, rows in by_type.items():
+        n, size, local, count = (np.array(column, dtype=float) for column in zip(*rows))
+        t, candidates, best = select(comm_type, n, size, local, params, algorithms)
+        times[comm_type] = float((t * count).sum())
+        total += times[comm_type]
+        ops = np.bincount(best[best >= 0], weights=count[best >= 0], minlength=len(candidates))
+        choices[comm_type] = {"/".join(c): int(o) for c, o in zip(candidates, ops) if o}
+    return total, times, choices
+
+
+def _parse_msg_size(s):
+    try:
+        return float(s)
+    except ValueError:
+        return convert_msg_to_size(s)
+
+
+def add_network_args(parser):
+    parser.add_argument("--gpus_per_node", type=int, default=NetworkParams.gpus_per_node)
+    parser.add_argument("--intra_bw", type=float, default=NetworkParams.intra_bw, help="NVLink GB/s per GPU")
+    parser.add_argument("--net_bw", type=float, default=NetworkParams.net_bw, help="Network GB/s per GPU")
+    parser.add_argument("--algorithms", type=str, default=None,
+                        help=f"Comma separated candidates, e.g. {','.join(NCCL_ALGORITHMS)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analytic collective cost model")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    predict_parser = sub.add_parser("predict", help="time of one collective under every algorithm")
+    sweep_parser = sub.add_parser("sweep", help="selected algorithm of one collective over message sizes")
+    for p in (predict_parser, sweep_parser):
+        p.add_argument("--comm_type", required=True)
+        p.add_argument("--group_size", type=int, required=True)
+        p.add_argument("--local_size", type=int, default=None, help="Ranks of the group on each node")
+        add_network_args(p)
+    predict_parser.add_argument("--msg_size", required=True, help='bytes, or e.g. "64.0 MB"')
+    estimate_parser = sub.add_parser(
+        "estimate", help="comm time of a workload pickle or of estimated model options"
+    )
+    estimate_parser.add_argument("--workload", type=str, default=None)
+    add_network_args(estimate_parser)
+    cost_args, rest = parser.parse_known_args()
+
+    params = NetworkParams.from_args(cost_args)
+    algorithms = cost_args.algorithms.split(",") if cost_args.algorithms else None
+    from log_analyzer.results_index import print_table
+
+    if cost_args.cmd == "predict":
+        assert not rest, f"unrecognized arguments: {' '.join(rest)}"
+        size = _parse_msg_size(cost_args.msg_size)
+        times = algorithm_times(
+            cost_args.comm_type, cost_args.group_size, size, cost_args.local_size, params, algorithms
+        )
+        rows = sorted(([algorithm, protocol, round(float(t), 4)] for (algorithm, protocol), t in times.items()),
+                      key=lambda row: row[2])
+        print_table(["algorithm", "protocol", "time_ms"], rows)
+        if rows:
+            algbw = size / (rows[0][2] / 1e3) / GB if rows[0][2] else 0
+            print(f"selected: {rows[0][0]}/{rows[0][1]} {rows[0][2]} ms, algbw {algbw:.2f} GB/s")
+    elif cost_args.cmd == "sweep":
+        assert not rest, f"unrecognized arguments: {' '.join(rest)}"
+        sizes = 2.0 ** np.arange(10, 33)
+        t, candidates, best = select(
+            cost_args.comm_type, cost_args.group_size, sizes, cost_args.local_size, params, algorithms
+        )
+        rows = [
+            [convert_size_to_msg(s), "/".join(candidates[b]) if b >= 0 else "-", round(float(ms), 4),
+             round(float(s / (ms / 1e3) / GB), 2) if ms else 0]
+            for s, b, ms in zip(sizes, best, t)
+        ]
+        print_table(["msg_size", "selected", "time_ms", "algbw_GB/s"], rows)
+    else:
+        from workload_generator.comm_volume import estimate_comm_volume, workload_volume
+
+        if cost_args.workload:
+            from log_analyzer.log import Workload
+
+            workload, args = Workload.load(cost_args.workload)
+            volume = workload_volume(workload)
+        else:
+            from utils.utils import get_params
+
+            args = get_params(rest + ["--workload_only"])
+            volume = estimate_comm_volume(args)
+        layout = group_layout(args, params.gpus_per_node)
+        start = time.perf_counter()
+        total, times, choices = estimate_volume(volume, layout, params, algorithms)
+        elapsed = time.perf_counter() - start
+        rows = [
+            [comm_type.value, round(times[comm_type], 3),
+             ", ".join(f"{c}: {o}" for c, o in sorted(choices[comm_type].items(), key=lambda kv: -kv[1]))]
+            for comm_type in sorted(times, key=lambda c: -times[c])
+        ]
+        print_table(["comm_type", "time_ms", "selected (ops)"], rows)
+        print(f"estimated comm time: {total:.3f} ms ({sum(volume.values())} ops costed in {elapsed * 1e3:.1f} ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Copyright (c) 2021, Alibaba Group;
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Compare two or more results/comm_logs/*_log.csv runs.
+
+python -m log_analyzer.compare_runs baseline_log.csv candidate_log.csv [more_log.csv ...] \
+  --output results/compare.json --fail_on_regression
+
+The first file is the baseline; every other file is compared against it on
+(comm_type, comm_group, msg_size, stage). For each key the relative delta of
+busbw and latency is reported with a bootstrap confidence interval, and keys
+whose interval excludes zero and whose delta is worse than --threshold are
+flagged as regressions.
+"""
+
+import argparse
+import json
+import sys
+import numpy as np
+import pandas as pd
+
+KEY_COLUMNS = ["comm_type", "comm_group", "msg_size", "stage"]
+# metric -> True if a larger value is better
+METRICS = {"busbw": True, "_elapsed_time": False}
+
+
+def load_comm_log(file_path):
+    df = pd.read_csv(file_path)
+    df = df[~df["comm_type"].astype(str).str.contains("computation|epoch_end")]
+    for metric in METRICS:
+        df[metric] = pd.to_numeric(df[metric], errors="coerce")
+    df = df.dropna(subset=list(METRICS))
+    df["msg_size"] = pd.to_numeric(df["msg_size"], errors="coerce")
+    df["stage"] = df["stage"].fillna("")
+    return df.dropna(subset=["msg_size"])
+
+
+def bootstrap_relative_delta(base, cand, statistic=np.median, num_resamples=2000, confidence=0.95, seed=0, chunk=200):
+    """Percentile bootstrap CI of (stat(cand) - stat(base)) / stat(base)."""
+    rng = np.random.default_rng(seed)
+    base_stat, cand_stat = statistic(base), statistic(cand)
+    if base_stat == 0:
+        return None, None, None
+    deltas = []
+    for start in range(0, num_resamples, chunk):
+        n = min(chunk, num_resamples - start)
+        base_resampled = statistic(base[rng.integers(0, len(base), (n, len(base)))], axis=1)
+        cand_resampled = statistic(cand[rng.integers(0, len(cand), (n, len(cand)))], axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            deltas.append((cand_resampled - base_resampled) / base_resampled)
+    deltas = np.concatenate(deltas)
+    deltas = deltas[np.isfinite(deltas)]
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(deltas, [alpha, 1 - alpha]) if len(deltas) else (np.nan, np.nan)
+    return (cand_stat - base_stat) / base_stat, float(low), float(high)
+
+
+def compare_runs(base_df, cand_df, statistic="median", threshold=0.05, num_resamples=2000, confidence=0.95, min_samples=3):
+    stat_fn = np.median if statistic == "median" else np.mean
+    base_groups = dict(tuple(base_df.groupby(KEY_COLUMNS, sort=True)))
+    cand_groups = dict(tuple(cand_df.groupby(KEY_COLUMNS, sort=True)))
+    results = []
+    for key in sorted(set(base_groups) | set(cand_groups), key=str):
+        comm_type, comm_group, msg_size, stage = key
+        row = {
+            "comm_type": comm_type,
+            "comm_group": comm_group,
+            "msg_size": int(msg_size),
+            "stage": stage,
+        }
+        if key not in base_groups or key not in cand_groups:
+            row["status"] = "missing_in_candidate" if key not in cand_groups else "missing_in_baseline"
+            results.append(row)
+            continue
+        base_g, cand_g = base_groups[key], cand_groups[key]
+        row["base_count"], row["cand_count"] = len(base_g), len(cand_g)
+        status = "ok"
+        for metric, higher_is_better in METRICS.items():
+            name = "latency" if metric == "_elapsed_time" else metric
+            base = base_g[metric].to_numpy(dtype=float)
+            cand = cand_g[metric].to_numpy(dtype=float)
+            row[f"base_{name}"] = float(stat_fn(base))
+            row[f"cand_{name}"] = float(stat_fn(cand))
+            if len(base) < min_samples or len(cand) < min_samples:
+                status = "insufficient_samples" if status == "ok" else status
+                continue
+            delta, low, high = bootstrap_relative_delta(base, cand, stat_fn, num_resamples, confidence)
+            if delta is None:
+                continue
+            row[f"{name}_delta"], row[f"{name}_ci_low"], row[f"{name}_ci_high"] = float(delta), low, high
+            significant = low > 0 or high < 0
+            worse = -delta if higher_is_better else delta
+            if significant and worse > threshold:
+                status = "regression"
+            elif significant and -worse > threshold and status == "ok":
+                status = "improvement"
+        row["status"] = status
+        results.append(row)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare AICB comm logs run to run")
+    parser.add_argument("files", nargs="+", help="baseline _log.csv followed by one or more candidate _log.csv")
+    parser.add_argument("--statistic", choices=["median", "mean"], default="median")
+    parser.add_argument("--threshold", type=float, default=0.05,
+                        help="Minimum relative change to flag a significant regression")
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--num_resamples", type=int, default=2000)
+    parser.add_argument("--output", type=str, default=None, help="Write results as JSON (or CSV if it ends with .csv)")
+    parser.add_argument("--fail_on_regression", action="store_true", help="Exit with status 1 if any regression is found")
+    args = parser.parse_args()
+    if len(args.files) < 2:
+        parser.error("at least two comm logs are required")
+
+    base_df = load_comm_log(args.files[0])
+    report = {"baseline": args.files[0], "statistic": args.statistic, "threshold": args.threshold,
+              "confidence": args.confidence, "comparisons": []}
+    num_regressions = 0
+    for cand_file in args.files[1:]:
+        results = compare_runs(base_df, load_comm_log(cand_file), args.statistic, args.threshold,
+                               args.num_resamples, args.confidence)
+        regressions = [r for r in results if r["status"] == "regression"]
+        num_regressions += len(regressions)
+        report["comparisons"].append({"candidate": cand_file, "num_regressions": len(regressions), "results": results})
+        print(f"{cand_file}: {len(regressions)} regression(s) out of {len(results)} keys")
+        for r in regressions:
+            print(
+                f"  REGRESSION {r['comm_type']} {r['comm_group']} {r['msg_size']} {r['stage']}: "
+                f"busbw {r.get('busbw_delta', float('nan')):+.2%} "
+                f"[{r.get('busbw_ci_low', float('nan')):+.2%}, {r.get('busbw_ci_high', float('nan')):+.2%}], "
+                f"latency {r.get('latency_delta', float('nan')):+.2%}"
+            )
+
+    if args.output:
+        if args.output.endswith(".csv"):
+            rows = [dict(candidate=c["candidate"], **r) for c in report["comparisons"] for r in c["results"]]
+            pd.DataFrame(rows).to_csv(args.output, index=False)
+        else:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+    if args.fail_on_regression and num_regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,9 +12,13 @@ limitations under the License.
 """
 
 # /usr/bin/python3
+import os
+import re
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
 from utils.utils import CommType, CommGroup
 from log_analyzer.utils import convert_msg_to_size, convert_size_to_msg
-from utils.benchmark_logger import BenchLogger
 from log_analyzer.log import LogItem, Log
 
 COMM_OP = "comm op"
@@ -22,10 +26,28 @@ CALLER_FUNC = "Caller Func"
 TIME_MS = "time (ms)"
 MSG_SIZE = "msg size"
 LOG_STARTER = "[rank 0]"
-WORLD_SIZE = 16
-TP_SIZE = 4
-DP_SIZE = 4
-# LOG_STARTER = "[INFO] "
+EPOCH_MARKERS = ("After initializing ZeRO optimizer", "microstep")
+# files larger than this are split into byte-range shards parsed in parallel
+DEFAULT_SHARD_SIZE = 256 * 1024 * 1024
+
+_RANK_RE = re.compile(r"\[rank\s*(\d+)\]", re.IGNORECASE)
+_FIELD_RE = re.compile(r"([^|:]+):([^|]*)")
+_INT_RE = re.compile(r"-?\d+")
+_COMM_TYPE_RULES = [
+    ("all_gather", CommType.all_gather),
+    ("reduce_scatter", CommType.reduce_scatter),
+    ("all_reduce", CommType.all_reduce),
+    ("all_to_all", CommType.all_to_all),
+    ("broadcast", CommType.broadcast),
+    ("barrier", CommType.barrier),
+    ("reduce", CommType.reduce),
+]
+
+# column order of the records produced by the shard parser
+RECORD_COLUMNS = [
+    "rank", "is_epoch_end", "comm_type", "group_size", "group_stride",
+    "msg_size", "elapsed_time", "algbw", "busbw", "stage",
+]
 
 
 def clean_s(s):
@@ -33,102 +55,199 @@ def clean_s(s):
 
 
 def string2comm_type(s):
-    if "all_gather" in s:
-        return CommType.all_gather
-    if "reduce_scatter" in s:
-        return CommType.reduce_scatter
-    if "all_reduce" in s:
-        return CommType.all_reduce
-    if "broadcast" in s:
-        return CommType.broadcast
-    if "barrier" in s:
-        return CommType.barrier
-    if "reduce" in s:
-        return CommType.reduce
+    for pattern, comm_type in _COMM_TYPE_RULES:
+        if pattern in s:
+            return comm_type
     print(f"WARNING cannot convert {s} to CommType")
     return CommType.epoch_end
 
 
-def parse_ds_log_item(line):
-    index = line.lower().find(LOG_STARTER)
-    if index == -1:
+def parse_ds_log_item(line, rank=0):
+    """Parse one DeepSpeed comm log line into a dict, None if it is not a log line of `rank`
+    (any rank if `rank` is None)."""
+    match = _RANK_RE.search(line)
+    if match is None or (rank is not None and int(match.group(1)) != rank):
         return None
-    item_list = line[index + len(LOG_STARTER) :].split("|")
-    item = {}
-    for raw_item in item_list:
-        if "epoch" in raw_item:
-            split_text = raw_item.split()
-            numbers = [word for word in split_text if word.isdigit()]
-            item["epoch_num"] = int(numbers[0])
-            continue
-        if "micro_step" in raw_item:
-            split_text = raw_item.split()
-            numbers = [word for word in split_text if word.replace(".", "").isdigit()]
-            item["iter_time"] = float(numbers[0])
-            continue
-        if ":" not in raw_item:
-            continue
-        key, value = raw_item.split(":")
-        key, value = clean_s(key), clean_s(value)
+    item = {"rank": int(match.group(1))}
+    for field in _FIELD_RE.finditer(line, match.end()):
+        key, value = clean_s(field.group(1)), field.group(2).strip()
         if key == COMM_OP:
             item["comm_type"] = string2comm_type(value)
-        elif key == MSG_SIZE or MSG_SIZE in key:
-            item["msg_size"] = convert_msg_to_size(value)
+        elif MSG_SIZE in key:
+            item["msg_size"] = convert_msg_to_size(clean_s(value))
         elif key == CALLER_FUNC:
             item["stage"] = value
-        elif key == TIME_MS or TIME_MS in key:
+        elif TIME_MS in key:
             item["elapsed_time"] = float(value)
-        if key == "group":
-            group = eval(value)
-            if len(group) == WORLD_SIZE:
-                item["group"] = CommGroup.all
-            elif len(group) == TP_SIZE:
-                item["group"] = CommGroup.tp_group
-            elif len(group) == DP_SIZE:
-                item["group"] = CommGroup.dp_group
+        elif key == "group":
+            ranks = [int(r) for r in _INT_RE.findall(value)]
+            item["group_size"] = len(ranks)
+            item["group_stride"] = ranks[1] - ranks[0] if len(ranks) > 1 else 0
         elif "algbw" in key:
             item["algbw"] = float(value)
         elif "busbw" in key:
             item["busbw"] = float(value)
-        else:
-            try:
-                item[key] = float(value)
-            except:
-                item[key] = value
     return item
 
 
-def parse_ds_comm_log(filename):
-    comm_log = Log()
-    with open(filename, "r") as f:
-        lines = f.read().split("\n")
-        for line in lines:
-            if "After initializing ZeRO optimizer" in line:
-                comm_log.add_comm_log(LogItem(comm_type=CommType.epoch_end))
+def _parse_shard(task):
+    """Parse lines whose first byte lies in [start, end) of filename into record tuples."""
+    filename, start, end, rank = task
+    records = []
+    with open(filename, "rb") as f:
+        if start > 0:
+            # skip the line straddling the shard boundary, the previous shard owns it
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while end is None or pos < end:
+            raw = f.readline()
+            if not raw:
+                break
+            pos += len(raw)
+            line = raw.decode("utf-8", errors="replace")
+            if any(marker in line for marker in EPOCH_MARKERS):
+                records.append((rank, True, None, 0, 0, 0, -1, -1, -1, ""))
                 continue
-            elif "microstep" in line:
-                comm_log.add_comm_log(LogItem(comm_type=CommType.epoch_end))
+            log = parse_ds_log_item(line, rank)
+            if log is None or "comm_type" not in log:
                 continue
-            log = parse_ds_log_item(line)
-            if log is None:
-                continue
-            if "comm_type" in log:
-                log_item = LogItem(
-                    comm_type=log["comm_type"],
-                    comm_group=log.get("group", CommGroup.dp_group),
-                    msg_size=log["msg_size"],
-                )
-                log_item._elapsed_time = log.get("elapsed_time", -1)
-                log_item.algbw, log_item.busbw = log.get("algbw", -1), log.get(
-                    "busbw", -1
-                )
-                comm_log.add_comm_log(log_item)
+            records.append((
+                log["rank"], False, log["comm_type"],
+                log.get("group_size", 0), log.get("group_stride", 0),
+                log.get("msg_size", 0), log.get("elapsed_time", -1),
+                log.get("algbw", -1), log.get("busbw", -1), log.get("stage", ""),
+            ))
+    return records
+
+
+def _plan_shards(path, rank, shard_size):
+    if os.path.isdir(path):
+        filenames = sorted(
+            os.path.join(path, name) for name in os.listdir(path)
+            if os.path.isfile(os.path.join(path, name))
+        )
+    else:
+        filenames = [path]
+    tasks = []
+    for filename in filenames:
+        size = os.path.getsize(filename)
+        if size <= shard_size:
+            tasks.append((filename, 0, None, rank))
+            continue
+        for start in range(0, size, shard_size):
+            tasks.append((filename, start, min(start + shard_size, size), rank))
+    return tasks
+
+
+def classify_group(group_size, group_stride, world_size, tp_size, dp_size):
+    if group_size == 0:
+        return CommGroup.dp_group
+    if group_size == world_size:
+        return CommGroup.all
+    # TP ranks are adjacent, DP ranks are strided by the TP size
+    if group_size == tp_size and group_stride in (0, 1):
+        return CommGroup.tp_group
+    if group_size == dp_size:
+        return CommGroup.dp_group
+    if group_size == tp_size:
+        return CommGroup.tp_group
+    return CommGroup.dp_group
+
+
+def infer_parallel_sizes(group_sizes, group_strides, world_size=None, tp_size=None, dp_size=None):
+    """(world, TP, DP) sizes, the ones not given are inferred from the logged groups.
+
+    world is the largest group. TP ranks are adjacent, so TP is the smallest
+    group of stride 1 smaller than the world (1 when there is none), and
+    DP = world / TP.
+    """
+    if world_size is None:
+        world_size = max(group_sizes, default=0) or 1
+    if tp_size is None:
+        adjacent = {
+            size for size, stride in zip(group_sizes, group_strides) if stride == 1 and 1 < size < world_size
+        }
+        tp_size = min(adjacent, default=1)
+    dp_size = dp_size or max(world_size // tp_size, 1)
+    return world_size, tp_size, dp_size
+
+
+def parse_ds_comm_log_columns(
+    path, rank=0, world_size=None, tp_size=None, dp_size=None, num_workers=None, shard_size=DEFAULT_SHARD_SIZE
+) -> Dict[str, List]:
+    """Stream a DeepSpeed comm log file (or a directory of per-rank logs) into columns.
+
+    Large files are split into byte-range shards and, together with multiple
+    files, parsed in a process pool; shards are concatenated in file order.
+    Groups are classified from their size and rank stride against the real
+    world/TP/DP sizes; sizes that are not given are inferred from the log
+    (see infer_parallel_sizes).
+    """
+    tasks = _plan_shards(path, rank, shard_size)
+    if len(tasks) > 1 and num_workers != 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            shard_records = list(executor.map(_parse_shard, tasks))
+    else:
+        shard_records = [_parse_shard(task) for task in tasks]
+
+    columns = dict((name, []) for name in RECORD_COLUMNS)
+    for records in shard_records:
+        for record in records:
+            for name, value in zip(RECORD_COLUMNS, record):
+                columns[name].append(value)
+
+    world_size, tp_size, dp_size = infer_parallel_sizes(
+        columns["group_size"], columns["group_stride"], world_size, tp_size, dp_size
+    )
+    columns["comm_group"] = [
+        None if is_epoch_end else classify_group(size, stride, world_size, tp_size, dp_size)
+        for is_epoch_end, size, stride in zip(columns["is_epoch_end"], columns["group_size"], columns["group_stride"])
+    ]
+    return columns
+
+
+def columns_to_log(columns: Dict[str, List]) -> Log:
+    comm_log = Log()
+    for i, is_epoch_end in enumerate(columns["is_epoch_end"]):
+        if is_epoch_end:
+            # an epoch marker with no comm op since the previous one would be an empty epoch
+            if comm_log.comm_logs and not comm_log.comm_logs[-1].is_epoch_end():
+                comm_log.add_comm_log(LogItem(comm_type=CommType.epoch_end))
+            continue
+        log_item = LogItem(
+            comm_type=columns["comm_type"][i],
+            comm_group=columns["comm_group"][i],
+            comm_group_size=columns["group_size"][i] or None,
+            msg_size=columns["msg_size"][i],
+            stage=columns["stage"][i],
+        )
+        log_item._elapsed_time = columns["elapsed_time"][i]
+        log_item.algbw, log_item.busbw = columns["algbw"][i], columns["busbw"][i]
+        comm_log.add_comm_log(log_item)
     return comm_log
 
 
+def parse_ds_comm_log(filename, **kwargs):
+    return columns_to_log(parse_ds_comm_log_columns(filename, **kwargs))
+
+
 if __name__ == "__main__":
-    import sys
+    parser = argparse.ArgumentParser(description="Analyze DeepSpeed comm logs")
+    parser.add_argument("path", help="DeepSpeed log file or directory of per-rank log files")
+    parser.add_argument("--rank", type=int, default=0, help="Rank whose lines are parsed, -1 for all ranks")
+    parser.add_argument("--world_size", type=int, default=None)
+    parser.add_argument("--tp_size", type=int, default=None)
+    parser.add_argument("--dp_size", type=int, default=None)
+    parser.add_argument("--num_workers", type=int, default=None)
+    args = parser.parse_args()
 
-    filename = sys.argv[1]
-    comm_log = parse_ds_comm_log(filename)
+    comm_log = parse_ds_comm_log(
+        args.path,
+        rank=None if args.rank < 0 else args.rank,
+        world_size=args.world_size,
+        tp_size=args.tp_size,
+        dp_size=args.dp_size,
+        num_workers=args.num_workers,
+    )
     comm_log.analyze()
@@ -0,0 +1,165 @@
+"""
+Copyright (c) 2021, Alibaba Group;
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import csv
+import math
+import sys
+from typing import Dict, List
+
+DEFAULT_RELATIVE_ERROR = 0.01
+QUANTILES = [("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999)]
+HISTOGRAM_CSV_HEADER = [
+    "stage", "comm_type", "comm_group", "msg_size", "count", "min",
+    "p50", "p90", "p99", "p999", "max", "relative_error", "buckets",
+]
+
+
+class LatencyHistogram:
+    """Log-bucketed latency histogram with a fixed relative error.
+
+    A value v > 0 goes to bucket ceil(log(v) / log(gamma)) where
+    gamma = (1 + e) / (1 - e), so every quantile is reported within a
+    relative error of e whatever the dynamic range is. Buckets are kept
+    sparse, so histograms with the same relative error can be merged
+    across ranks and runs by adding their bucket counts.
+    """
+
+    def __init__(self, relative_error=DEFAULT_RELATIVE_ERROR):
+        assert 0 < relative_error < 1, f"relative_error should be in (0, 1), got {relative_error}"
+        self.relative_error = relative_error
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value, count=1):
+        self.count += count
+        self.sum += value * count
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if value <= 0:
+            self.zero_count += count
+            return
+        idx = math.ceil(math.log(value) / self._log_gamma)
+        self.buckets[idx] = self.buckets.get(idx, 0) + count
+
+    def merge(self, other: "LatencyHistogram"):
+        assert math.isclose(self.gamma, other.gamma), "cannot merge histograms with different relative error"
+        for idx, count in other.buckets.items():
+            self.buckets[idx] = self.buckets.get(idx, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def _bucket_value(self, idx):
+        return 2 * self.gamma ** idx / (self.gamma + 1)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for idx in sorted(self.buckets):
+            seen += self.buckets[idx]
+            if rank < seen:
+                return min(max(self._bucket_value(idx), self.min), self.max)
+        return self.max
+
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def percentiles(self):
+        return dict((name, self.quantile(q)) for name, q in QUANTILES)
+
+    def encode_buckets(self):
+        buckets = ";".join(f"{idx}:{count}" for idx, count in sorted(self.buckets.items()))
+        return f"z:{self.zero_count};{buckets}" if self.zero_count else buckets
+
+    @classmethod
+    def from_csv_row(cls, row: Dict[str, str]) -> "LatencyHistogram":
+        hist = cls(float(row["relative_error"]))
+        for token in filter(None, row["buckets"].split(";")):
+            idx, count = token.split(":")
+            if idx == "z":
+                hist.zero_count = int(count)
+            else:
+                hist.buckets[int(idx)] = int(count)
+        hist.count = int(row["count"])
+        hist.min, hist.max = float(row["min"]), float(row["max"])
+        hist.sum = sum(hist._bucket_value(idx) * c for idx, c in hist.buckets.items())
+        return hist
+
+
+def dump_histograms(histograms: Dict[str, Dict], csv_filename):
+    """histograms: stage -> (comm_type, comm_group, msg_size) -> LatencyHistogram"""
+    with open(csv_filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(HISTOGRAM_CSV_HEADER)
+        for stage, stage_hists in histograms.items():
+            for (comm_type, comm_group, msg_size), hist in sorted(stage_hists.items(), key=str):
+                percentiles = hist.percentiles()
+                writer.writerow(
+                    [stage, comm_type, comm_group, msg_size, hist.count, f"{hist.min:.4f}"]
+                    + [f"{percentiles[name]:.4f}" for name, _ in QUANTILES]
+                    + [f"{hist.max:.4f}", hist.relative_error, hist.encode_buckets()]
+                )
+    return csv_filename
+
+
+def load_histograms(csv_filenames: List[str]) -> Dict[str, Dict]:
+    """Load and merge histogram CSVs written by dump_histograms, e.g. from several ranks or runs."""
+    histograms: Dict[str, Dict] = {}
+    for csv_filename in csv_filenames:
+        with open(csv_filename, newline="") as f:
+            for row in csv.DictReader(f):
+                key = (row["comm_type"], row["comm_group"], row["msg_size"])
+                hist = LatencyHistogram.from_csv_row(row)
+                stage_hists = histograms.setdefault(row["stage"], {})
+                if key in stage_hists:
+                    stage_hists[key].merge(hist)
+                else:
+                    stage_hists[key] = hist
+    return histograms
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m log_analyzer.histogram <hist_csv> [<hist_csv> ...] [-o merged.csv]")
+        sys.exit(1)
+    files, output = sys.argv[1:], None
+    if "-o" in files:
+        i = files.index("-o")
+        output = files[i + 1]
+        files = files[:i] + files[i + 2:]
+    merged = load_histograms(files)
+    if output:
+        dump_histograms(merged, output)
+    for stage, stage_hists in merged.items():
+        print(f"{stage}:")
+        for (comm_type, comm_group, msg_size), hist in sorted(stage_hists.items(), key=str):
+            percentiles = hist.percentiles()
+            print(
+                f"  {comm_type:<28} {comm_group:<22} {msg_size:<14} count={hist.count:<8} "
+                + " ".join(f"{name}={percentiles[name]:.3f}" for name, _ in QUANTILES)
+            )
@@ -19,6 +19,7 @@ import numpy as np
 from typing import Union, Dict, List
 from utils.utils import CommType, CommGroup
 from log_analyzer.utils import convert_size_to_msg, calc_bw_log
+from log_analyzer.histogram import LatencyHistogram, dump_histograms
 import copy
 
 @dataclasses.dataclass
@@ -80,8 +81,9 @@ class LogItem:
         return "None"
 
 
-def _print_stage_log(stage_name: str, stage_count: int, comm_type_info: Dict, primary_key: List[str], agg_key: List[str], performance_key: List[str], busbw_key: List[str]):
-    header = f"{'Comm_Type':<15} {'Comm_Group':<12} {'Message_Size':<12} {'Count':<12} {'Avg_Elapsed_Time ± Std ':<24} {'Avg_BusBw ± Std':<24}\n"
+def _print_stage_log(stage_name: str, stage_count: int, comm_type_info: Dict, primary_key: List[str], agg_key: List[str], performance_key: List[str], busbw_key: List[str], histograms: Dict = None):
+    histograms = histograms or {}
+    header = f"{'Comm_Type':<15} {'Comm_Group':<12} {'Message_Size':<12} {'Count':<12} {'Avg_Elapsed_Time ± Std ':<24} {'Avg_BusBw ± Std':<24} {'P50/P90/P99/P99.9 Elapsed_Time':<36}\n"
     separator = "-" * len(header) + "\n"
     log_str = separator + header + separator
 
@@ -105,7 +107,13 @@ def _print_stage_log(stage_name: str, stage_count: int, comm_type_info: Dict, pr
             busbw_value_list = sorted(comm_type_info[pkey][key])
             values[f'avg_{key}'] = f"{np.mean(busbw_value_list):.2f}±{np.std(busbw_value_list):.2f}"
 
-        row_str += f"{values['comm_type']:<15} {values['comm_group']:<12} {values['msg_size']:<12} {values['count']:<16} {values['avg__elapsed_time']:<24} {values['avg_busbw']:<18}\n"
+        hist = histograms.get(pkey)
+        if hist is not None and hist.count:
+            values['percentiles'] = "/".join(f"{v:.2f}" for v in hist.percentiles().values())
+        else:
+            values['percentiles'] = "-"
+
+        row_str += f"{values['comm_type']:<15} {values['comm_group']:<12} {values['msg_size']:<12} {values['count']:<16} {values['avg__elapsed_time']:<24} {values['avg_busbw']:<18} {values['percentiles']:<36}\n"
         log_str += row_str
 
     return log_str
@@ -168,6 +176,19 @@ class Log:
         self.comm_logs = []
         self.comm_log_each_epoch = [[]]
         self.epoch_times = []
+        # stage -> (comm_type, comm_group, msg_size) -> LatencyHistogram
+        self.latency_histograms: Dict[str, Dict] = {}
+
+    def _update_histogram(self, comm_log: LogItem):
+        if comm_log.comm_type == CommType.computation or comm_log._elapsed_time is None:
+            return
+        stage = "init" if len(self.comm_log_each_epoch) == 1 else "train"
+        stage_hists = self.latency_histograms.setdefault(stage, {})
+        key = (comm_log.comm_type, comm_log.comm_group, comm_log.msg_size)
+        hist = stage_hists.get(key)
+        if hist is None:
+            hist = stage_hists[key] = LatencyHistogram()
+        hist.add(comm_log._elapsed_time)
 
     def add_comm_log(self, comm_log: LogItem):
         if (
@@ -181,6 +202,8 @@ class Log:
             return
         self.comm_logs.append(comm_log)
         self.comm_log_each_epoch[-1].append(comm_log)
+        if not comm_log.is_epoch_end():
+            self._update_histogram(comm_log)
 
     def analyze(self, print_fn=print):
         comm_info: Dict[str, Dict] = {}
@@ -193,7 +216,7 @@ class Log:
                 comm_type_info = comm_info[stage]["comm_type_info"]
                 detailed_comm_type_info = comm_info[stage]["detailed_comm_type_info"]
 
-                log_str = _print_stage_log(stage, stage_count, detailed_comm_type_info, ["comm_type", "comm_group", "msg_size"], ["count"], ["_elapsed_time"], ["busbw"])
+                log_str = _print_stage_log(stage, stage_count, detailed_comm_type_info, ["comm_type", "comm_group", "msg_size"], ["count"], ["_elapsed_time"], ["busbw"], self.latency_histograms.get(stage))
                 print_fn(f"\n\tDetailed comm info for AICB {stage} stage\n{log_str}")
         return comm_info
 
@@ -214,6 +237,8 @@ class Log:
                     log_item_write.msg_size = msg_size_str
                 f.write(log_item_write.view_as_csv_line() + "\n")
                 del log_item_write
+        if self.latency_histograms:
+            dump_histograms(self.latency_histograms, filename + "_latency_hist.csv")
         return csv_filename
 
     @staticmethod
@@ -0,0 +1,389 @@
+"""
+Copyright (c) 2021, Alibaba Group;
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Incremental SQLite index over the results/ directory.
+
+python -m log_analyzer.results_index update
+python -m log_analyzer.results_index busbw --world_size 64 --tp 8 --comm_type all_gather
+python -m log_analyzer.results_index iter --model gpt_13B
+python -m log_analyzer.results_index sql "SELECT model_name, COUNT(*) FROM runs GROUP BY model_name"
+
+`update` walks results/comm_logs, results/mocked_workload, results/aiob_outputs
+and results/log, and only parses files whose size or mtime changed since the
+last update; files that disappeared are dropped from the index. The run
+configuration is recovered from the file name and, for comm logs and
+workloads, the group sizes found in the rows (tp = size of tp_group, ...).
+"""
+
+import argparse
+import csv
+import math
+import os
+import re
+import sqlite3
+import sys
+
+DEFAULT_RESULTS_DIR = "results"
+DEFAULT_DB = os.path.join(DEFAULT_RESULTS_DIR, "index.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    kind TEXT,
+    mtime REAL,
+    size INTEGER,
+    name TEXT,
+    frame TEXT,
+    model_name TEXT,
+    world_size INTEGER,
+    tp INTEGER,
+    pp INTEGER,
+    ep INTEGER,
+    dp INTEGER,
+    sp TEXT,
+    iterations INTEGER,
+    computation_enable TEXT,
+    global_batch INTEGER,
+    micro_batch INTEGER,
+    seq_length INTEGER,
+    flash_attn TEXT,
+    init_time_ms REAL,
+    iter_time_avg_ms REAL,
+    iter_time_p90_ms REAL,
+    iter_time_max_ms REAL,
+    total_time_s REAL
+);
+CREATE TABLE IF NOT EXISTS comm_stats (
+    run_id INTEGER REFERENCES runs(run_id) ON DELETE CASCADE,
+    stage TEXT,
+    comm_type TEXT,
+    comm_group TEXT,
+    group_size INTEGER,
+    msg_size REAL,
+    count INTEGER,
+    total_bytes REAL,
+    elapsed_avg_ms REAL,
+    busbw_avg REAL,
+    busbw_min REAL,
+    busbw_max REAL
+);
+CREATE TABLE IF NOT EXISTS aiob_stats (
+    run_id INTEGER REFERENCES runs(run_id) ON DELETE CASCADE,
+    op TEXT,
+    time_gpu_avg REAL,
+    time_gpu_min REAL,
+    time_gpu_max REAL
+);
+CREATE INDEX IF NOT EXISTS runs_config ON runs(world_size, tp, model_name);
+CREATE INDEX IF NOT EXISTS comm_stats_key ON comm_stats(comm_type, comm_group, msg_size);
+CREATE INDEX IF NOT EXISTS comm_stats_run ON comm_stats(run_id);
+CREATE INDEX IF NOT EXISTS aiob_stats_run ON aiob_stats(run_id);
+"""
+
+# {generator.name}_{model_name}_sp_..._iteration_..._computationEnable_..._{world_size}n_log.csv / _workload.csv
+RUN_NAME_RE = re.compile(
+    r"^(?P<prefix>.+?)_sp_(?P<sp>True|False)_iteration_(?P<iterations>\d+)"
+    r"_computationEnable_(?P<computation_enable>True|False)_(?P<world_size>\d+)n"
+)
+FRAMES = ("megatron", "deepspeed_stage1", "deepspeed_stage2", "deepspeed_stage3", "collective_test", "pytorch_trace")
+# {model_name}-world_size..-tp..-pp..-ep..-gbs..-mbs..-seq..-flash_attn-...txt
+AIOB_NAME_RE = re.compile(
+    r"^(?P<model_name>.+?)-world_size(?P<world_size>\d+)-tp(?P<tp>\d+)-pp(?P<pp>\d+)-ep(?P<ep>\d+)"
+    r"-gbs(?P<global_batch>\d+)-mbs(?P<micro_batch>\d+)-seq(?P<seq_length>\d+)-flash_attn-(?P<flash_attn>\w+)"
+)
+AIOB_SECTION_RE = re.compile(r"^(\w+):\s*$")
+AIOB_VALUE_RE = re.compile(r"^\s+(time_gpu_avg|time_gpu_min|time_gpu_max):\s+([\d.eE+-]+)")
+TOTAL_TIME_RE = re.compile(r"total time for (\S+) and (\d+) iterations is ([\d.]+) s")
+ITER_TABLE_RE = re.compile(r"Init time\s+Max iteration time")
+NUMBER_RE = re.compile(r"-?\d+(?:\.\d+)?")
+GROUP_COLUMNS = {"tp_group": "tp", "pp_group": "pp", "ep_group": "ep", "dp_group": "dp", "all": "world_size"}
+
+
+def _name(value):
+    return str(value).split(".")[-1]
+
+
+def _float(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+def parse_run_name(filename):
+    run = {"name": os.path.splitext(os.path.basename(filename))[0]}
+    match = RUN_NAME_RE.match(run["name"])
+    if match:
+        prefix = match.group("prefix")
+        frame = next((f for f in FRAMES if prefix.startswith(f + "_")), None)
+        run["frame"] = frame
+        run["model_name"] = prefix[len(frame) + 1:] if frame else prefix
+        run["sp"] = match.group("sp")
+        run["iterations"] = int(match.group("iterations"))
+        run["computation_enable"] = match.group("computation_enable")
+        run["world_size"] = int(match.group("world_size"))
+    return run
+
+
+def _iteration_stats(epoch_times):
+    # the first epoch_end closes the init stage
+    if not epoch_times:
+        return {}
+    stats = {"init_time_ms": epoch_times[0]}
+    iters = sorted(epoch_times[1:])
+    if iters:
+        stats["iter_time_avg_ms"] = sum(iters) / len(iters)
+        stats["iter_time_p90_ms"] = iters[int(len(iters) * 0.9)]
+        stats["iter_time_max_ms"] = iters[-1]
+    return stats
+
+
+def parse_comm_csv(filename, with_timing):
+    """Per (stage, comm_type, comm_group, group_size, msg_size) stats of a comm log or workload CSV."""
+    run = parse_run_name(filename)
+    if run["name"].endswith("_latency_hist"):
+        return None, None
+    stats, epoch_times, epoch = {}, [], 0
+    with open(filename, newline="") as f:
+        for row in csv.DictReader(f):
+            comm_type = _name(row.get("comm_type"))
+            if comm_type == "epoch_end":
+                epoch += 1
+                if with_timing and _float(row.get("_elapsed_time")) is not None:
+                    epoch_times.append(_float(row["_elapsed_time"]))
+                continue
+            msg_size = _float(row.get("msg_size"))
+            if comm_type == "computation" or msg_size is None:
+                continue
+            comm_group = _name(row.get("comm_group"))
+            group_size = int(_float(row.get("comm_group_size")) or 0)
+            if group_size > 0 and comm_group in GROUP_COLUMNS:
+                run.setdefault(GROUP_COLUMNS[comm_group], group_size)
+            stage = "init" if epoch == 0 else "train"
+            key = (stage, comm_type, comm_group, group_size, msg_size)
+            s = stats.get(key)
+            if s is None:
+                s = stats[key] = [0, 0.0, 0.0, 0, 0.0, 0, None, None]
+            count = int(_float(row.get("count")) or 1)
+            s[0] += count
+            s[1] += msg_size * count
+            elapsed, busbw = _float(row.get("_elapsed_time")), _float(row.get("busbw"))
+            if with_timing and elapsed is not None and elapsed >= 0:
+                s[2] += elapsed
+                s[3] += 1
+            if with_timing and busbw is not None and busbw >= 0:
+                s[4] += busbw
+                s[5] += 1
+                s[6] = busbw if s[6] is None else min(s[6], busbw)
+                s[7] = busbw if s[7] is None else max(s[7], busbw)
+    run.update(_iteration_stats(epoch_times))
+    rows = [
+        (stage, comm_type, comm_group, group_size, msg_size, count, total_bytes,
+         elapsed_sum / n_timed if n_timed else None, busbw_sum / n_busbw if n_busbw else None, busbw_min, busbw_max)
+        for (stage, comm_type, comm_group, group_size, msg_size), (count, total_bytes, elapsed_sum, n_timed, busbw_sum, n_busbw, busbw_min, busbw_max)
+        in stats.items()
+    ]
+    return run, rows
+
+
+def parse_aiob_output(filename):
+    run = {"name": os.path.splitext(os.path.basename(filename))[0]}
+    match = AIOB_NAME_RE.match(run["name"])
+    if match:
+        run.update(match.groupdict())
+        for key in ("world_size", "tp", "pp", "ep", "global_batch", "micro_batch", "seq_length"):
+            run[key] = int(run[key])
+    ops, section = {}, None
+    with open(filename) as f:
+        for line in f:
+            header = AIOB_SECTION_RE.match(line)
+            if header:
+                section = header.group(1)
+                continue
+            value = AIOB_VALUE_RE.match(line)
+            if section and value:
+                ops.setdefault(section, {})[value.group(1)] = float(value.group(2))
+    rows = [(op, v.get("time_gpu_avg"), v.get("time_gpu_min"), v.get("time_gpu_max")) for op, v in ops.items()]
+    return run, rows
+
+
+def parse_run_log(filename):
+    run = {"name": os.path.splitext(os.path.basename(filename))[0]}
+    with open(filename, errors="replace") as f:
+        lines = f.readlines()
+    for i, line in enumerate(lines):
+        total = TOTAL_TIME_RE.search(line)
+        if total:
+            run["frame"], run["iterations"], run["total_time_s"] = total.group(1), int(total.group(2)), float(total.group(3))
+        elif ITER_TABLE_RE.search(line):
+            # header, separator, then: init, max, min, avg, p90, std
+            for row in lines[i + 1:i + 4]:
+                values = [float(v) for v in NUMBER_RE.findall(row)]
+                if len(values) >= 5:
+                    run["init_time_ms"], run["iter_time_max_ms"] = values[0], values[1]
+                    run["iter_time_avg_ms"], run["iter_time_p90_ms"] = values[3], values[4]
+                    break
+    return run, []
+
+
+KINDS = {
+    "comm_logs": ("comm_log", lambda f: parse_comm_csv(f, True), ".csv"),
+    "mocked_workload": ("workload", lambda f: parse_comm_csv(f, False), ".csv"),
+    "aiob_outputs": ("aiob", parse_aiob_output, ".txt"),
+    "log": ("log", parse_run_log, ".txt"),
+}
+
+
+class ResultsIndex:
+    def __init__(self, db_path=DEFAULT_DB):
+        folder = os.path.dirname(db_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.executescript(SCHEMA)
+
+    def update(self, results_dir=DEFAULT_RESULTS_DIR):
+        known = dict(
+            (path, (mtime, size)) for path, mtime, size in self.conn.execute("SELECT path, mtime, size FROM runs")
+        )
+        seen, added = set(), 0
+        with self.conn:
+            for subdir, (kind, parse, suffix) in KINDS.items():
+                folder = os.path.join(results_dir, subdir)
+                if not os.path.isdir(folder):
+                    continue
+                for entry in os.scandir(folder):
+                    if not entry.is_file() or not entry.name.endswith(suffix):
+                        continue
+                    path = os.path.abspath(entry.path)
+                    stat = entry.stat()
+                    seen.add(path)
+                    if known.get(path) == (stat.st_mtime, stat.st_size):
+                        continue
+                    try:
+                        run, rows = parse(entry.path)
+                    except (OSError, ValueError, csv.Error) as e:
+                        print(f"WARNING: failed to index {entry.path}: {e}")
+                        continue
+                    if run is None:
+                        continue
+                    self._insert(path, kind, stat, run, rows)
+                    added += 1
+            removed = [path for path in known if path not in seen]
+            self.conn.executemany("DELETE FROM runs WHERE path = ?", [(path,) for path in removed])
+        return added, len(removed)
+
+    def _insert(self, path, kind, stat, run, rows):
+        self.conn.execute("DELETE FROM runs WHERE path = ?", (path,))
+        run = dict(run, path=path, kind=kind, mtime=stat.st_mtime, size=stat.st_size)
+        columns = list(run)
+        cursor = self.conn.execute(
+            f"INSERT INTO runs ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            [run[c] for c in columns],
+        )
+        run_id = cursor.lastrowid
+        if kind == "aiob":
+            self.conn.executemany("INSERT INTO aiob_stats VALUES (?, ?, ?, ?, ?)", [(run_id,) + r for r in rows])
+        elif rows:
+            self.conn.executemany(
+                "INSERT INTO comm_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [(run_id,) + r for r in rows]
+            )
+
+    def query(self, sql, params=()):
+        cursor = self.conn.execute(sql, params)
+        return [d[0] for d in cursor.description], cursor.fetchall()
+
+    def busbw(self, stage="train", kind="comm_log", **filters):
+        where, params = ["r.kind = ?", "c.stage = ?"], [kind, stage]
+        for column, value in filters.items():
+            if value is None:
+                continue
+            table = "c" if column in ("comm_type", "comm_group", "msg_size") else "r"
+            where.append(f"{table}.{column} = ?")
+            params.append(value)
+        return self.query(
+            "SELECT r.name, r.model_name, r.world_size, r.tp, r.pp, r.ep, c.comm_type, c.comm_group, c.group_size, "
+            "c.msg_size, c.count, ROUND(c.elapsed_avg_ms, 4) AS elapsed_avg_ms, ROUND(c.busbw_avg, 2) AS busbw_avg, "
+            "ROUND(c.busbw_min, 2) AS busbw_min, ROUND(c.busbw_max, 2) AS busbw_max FROM comm_stats c JOIN runs r USING (run_id) "
+            f"WHERE {' AND '.join(where)} ORDER BY c.comm_type, c.comm_group, c.msg_size, r.name",
+            params,
+        )
+
+    def iteration_times(self, **filters):
+        where, params = ["r.iter_time_avg_ms IS NOT NULL"], []
+        for column, value in filters.items():
+            if value is not None:
+                where.append(f"r.{column} = ?")
+                params.append(value)
+        return self.query(
+            "SELECT r.name, r.kind, r.model_name, r.world_size, r.tp, r.pp, r.ep, r.iterations, "
+            "ROUND(r.init_time_ms, 2) AS init_time_ms, ROUND(r.iter_time_avg_ms, 2) AS iter_time_avg_ms, "
+            "ROUND(r.iter_time_p90_ms, 2) AS iter_time_p90_ms, ROUND(r.iter_time_max_ms, 2) AS iter_time_max_ms, "
+            f"r.total_time_s FROM runs r WHERE {' AND '.join(where)} ORDER BY r.model_name, r.world_size, r.name",
+            params,
+        )
+
+
+def print_table(columns, rows, file=sys.stdout):
+    cells = [[("" if v is None else str(v)) for v in row] for row in rows]
+    widths = [max([len(c)] + [len(r[i]) for r in cells]) for i, c in enumerate(columns)]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)), file=file)
+    print("  ".join("-" * w for w in widths), file=file)
+    for row in cells:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)), file=file)
+    print(f"({len(rows)} rows)", file=file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index and query AICB results")
+    parser.add_argument("--db", default=DEFAULT_DB)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    update_parser = sub.add_parser("update", help="index new and changed result files")
+    update_parser.add_argument("--results_dir", default=DEFAULT_RESULTS_DIR)
+    for cmd in ("busbw", "iter"):
+        p = sub.add_parser(cmd, help="busbw per comm op across runs" if cmd == "busbw" else "iteration times across runs")
+        p.add_argument("--model", dest="model_name")
+        p.add_argument("--world_size", type=int)
+        p.add_argument("--tp", type=int)
+        p.add_argument("--pp", type=int)
+        p.add_argument("--ep", type=int)
+        if cmd == "busbw":
+            p.add_argument("--comm_type")
+            p.add_argument("--comm_group")
+            p.add_argument("--msg_size", type=float)
+            p.add_argument("--stage", default="train", choices=["init", "train"])
+    sql_parser = sub.add_parser("sql", help="run a raw SQL query on the index")
+    sql_parser.add_argument("sql")
+    args = parser.parse_args()
+
+    index = ResultsIndex(args.db)
+    if args.cmd == "update":
+        added, removed = index.update(args.results_dir)
+        print(f"indexed {added} new or changed file(s), dropped {removed} removed file(s) in {args.db}")
+        return
+    if args.cmd == "sql":
+        print_table(*index.query(args.sql))
+        return
+    filters = dict(model_name=args.model_name, world_size=args.world_size, tp=args.tp, pp=args.pp, ep=args.ep)
+    if args.cmd == "busbw":
+        print_table(*index.busbw(args.stage, comm_type=args.comm_type, comm_group=args.comm_group,
+                                 msg_size=args.msg_size, **filters))
+    else:
+        print_table(*index.iteration_times(**filters))
+
+
+if __name__ == "__main__":
+    main()
@@ -44,7 +44,7 @@ def convert_msg_to_size(msg):
 def calc_bw_log(comm_type: CommType, size, duration,group_size):  # size: Bytes; duration: ms
     n = group_size if group_size else 1
     duration /= 1000
-    if comm_type in [CommType.all_gather, CommType.reduce_scatter]:
+    if comm_type in [CommType.all_gather, CommType.reduce_scatter, CommType.all_to_all]:
         # size *= n
         tput = size / duration
         busbw = (size / duration) * ((n - 1) / n)
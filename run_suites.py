@@ -158,10 +158,13 @@ if __name__ == "__main__":
         if not os.path.isdir(result_dir):
             os.makedirs(result_dir)
         output_file = f"./results/log/{name}.txt"
-        
+        # rank 0 of each suite keeps ./results/live_metrics/{name}.json up to date
+        env = dict(os.environ)
+        env.setdefault("AICB_LIVE_METRICS_FILE", f"./results/live_metrics/{name}.json")
+
         command += f" 2>&1 | tee {output_file}"
         print(name)
-        ret = subprocess.run(command, shell=True, text=True)
+        ret = subprocess.run(command, shell=True, text=True, env=env)
 
         # if ret.returncode != 0:
         #     print(f"ERROR when running {name}: {command}")
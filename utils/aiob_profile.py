@@ -0,0 +1,330 @@
+"""
+Copyright (c) 2021, Alibaba Group;
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""AIOB kernel samples and the compute profile aggregated from them.
+
+While AIOB measures, AIOBRecorder appends every kernel time to
+<profile>.jsonl as {"op": ..., "time_gpu": ...} lines, so an interrupted
+run keeps its samples. Closing the recorder aggregates the samples with
+NumPy into a ComputeProfile and writes the <profile>.txt summary read by
+--comp_filepath, the results index and the AIOB database. The time of an
+op is the --aiob_estimator of its samples: the median, a 10% trimmed
+mean, the minimum, or the mean of the samples below 3x the minimum (the
+historical AIOB filter).
+
+With --aiob_device cpu, profile_on_cpu runs the same kernels on CPU in
+float32, on a copy of the model with the sequence length and the
+gradient buffer divided by --aiob_cpu_shrink. The times are scaled back
+by the work ratio of each op (see workload_generator.aiob_db.OP_WORK),
+then by the GPU/CPU ratios of --aiob_calibration.
+
+AIOBProfileStore keeps the profiles under --aiob_store, keyed by a hash
+of the args that change the measured kernels and of the GPU type, so
+later jobs of the same shape reuse them instead of profiling. In
+distributed runs, shared_compute_profile looks the profile up or
+measures it on global rank 0 only, then broadcasts the op times to
+every rank.
+
+AIOBSampler decides how long AIOB measures: after --aiob_warmup
+discarded iterations, an op is measured until the 95% confidence
+interval of its mean is within --aiob_rel_ci of the mean, between
+--aiob_min_samples and --aiob_max_samples samples.
+
+A ComputeProfile is a read-only mapping from SimAI compute stages
+(attention_forward, mlp_backward, Emb, ...) to times, as returned by
+extract_averages, so Comp_with_aiob and SIMAI_workload take it directly;
+the per-op statistics are kept in `ops`.
+"""
+
+import os
+import copy
+import json
+import hashlib
+import dataclasses
+from collections.abc import Mapping
+from typing import Dict
+import numpy as np
+from utils.utils import parse_aiob_times, aggregate_aiob_times, get_aiob_path, get_comp_out
+
+OUTLIER_RATIO = 3
+TRIM_RATIO = 0.1
+ESTIMATORS = ("median", "trimmed_mean", "min", "mean")
+
+
+@dataclasses.dataclass
+class OpTime:
+    time_gpu_max: float
+    time_gpu_min: float
+    time_gpu_avg: float
+    count: int = 0
+
+
+def estimate(samples, estimator="median"):
+    """Op time of a sorted array of kernel times."""
+    if estimator == "median":
+        return float(np.median(samples))
+    if estimator == "trimmed_mean":
+        trim = max(int(samples.size * TRIM_RATIO), 1 if samples.size > 2 else 0)
+        return float(samples[trim:samples.size - trim].mean())
+    if estimator == "min":
+        return float(samples[0])
+    assert estimator == "mean", f"unknown AIOB estimator {estimator}, choose from {', '.join(ESTIMATORS)}"
+    return float(samples[samples <= OUTLIER_RATIO * samples[0]].mean())
+
+
+def summarize_samples(samples, estimator="median"):
+    """OpTime of an array of kernel times, its max ignores samples above OUTLIER_RATIO x the minimum."""
+    samples = np.sort(np.asarray(samples, dtype=np.float64))
+    minimum = samples[0]
+    kept = samples[samples <= OUTLIER_RATIO * minimum]
+    return OpTime(float(kept[-1]), float(minimum), estimate(samples, estimator), int(samples.size))
+
+
+class AIOBSampler:
+    def __init__(self, warmup=3, min_samples=5, max_samples=100, rel_ci=0.02):
+        assert min_samples >= 2 and max_samples >= min_samples, "need 2 <= aiob_min_samples <= aiob_max_samples"
+        self.warmup = warmup
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.rel_ci = rel_ci
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.aiob_warmup, args.aiob_min_samples, args.aiob_max_samples, args.aiob_rel_ci)
+
+    def converged(self, samples):
+        """Whether the kernel times of an op are enough."""
+        n = len(samples)
+        if n < self.min_samples:
+            return False
+        if n >= self.max_samples:
+            return True
+        samples = np.asarray(samples, dtype=np.float64)
+        half_width = 1.96 * samples.std(ddof=1) / np.sqrt(n)
+        return half_width <= self.rel_ci * samples.mean()
+
+    def done(self, samples):
+        """Whether every op of {op: kernel times} is converged."""
+        return bool(samples) and all(self.converged(values) for values in samples.values())
+
+
+class ComputeProfile(Mapping):
+    def __init__(self, ops: Dict[str, OpTime], args, train_iter=None, filepath=None):
+        self.ops = ops
+        self.args = args
+        self.train_iter = train_iter
+        self.filepath = filepath
+        self.cache = aggregate_aiob_times(self.times(), args)
+
+    def __getitem__(self, key):
+        return self.cache[key]
+
+    def __iter__(self):
+        return iter(self.cache)
+
+    def __len__(self):
+        return len(self.cache)
+
+    def times(self):
+        """{op: {"time_gpu_max": .., "time_gpu_min": .., "time_gpu_avg": ..}}"""
+        return {
+            op: {"time_gpu_max": t.time_gpu_max, "time_gpu_min": t.time_gpu_min, "time_gpu_avg": t.time_gpu_avg}
+            for op, t in self.ops.items()
+        }
+
+    def scaled(self, factors, args=None):
+        """Profile with the times of every op multiplied by factors[op], 1 when missing."""
+        ops = {}
+        for op, t in self.ops.items():
+            f = factors.get(op, 1)
+            ops[op] = OpTime(t.time_gpu_max * f, t.time_gpu_min * f, t.time_gpu_avg * f, t.count)
+        return ComputeProfile(ops, args or self.args, self.train_iter, self.filepath)
+
+    @classmethod
+    def from_samples(cls, samples, args, **kwargs):
+        """Profile of {op: kernel times}."""
+        estimator = getattr(args, "aiob_estimator", "median")
+        ops = {op: summarize_samples(values, estimator) for op, values in samples.items() if len(values)}
+        return cls(ops, args, **kwargs)
+
+    @classmethod
+    def from_times(cls, times, args, **kwargs):
+        """Profile of {op: {"time_gpu_avg": .., ...}} as returned by parse_aiob_times."""
+        ops = {}
+        for op, values in times.items():
+            if "time_gpu_avg" not in values:
+                continue
+            avg = values["time_gpu_avg"]
+            ops[op] = OpTime(values.get("time_gpu_max", avg), values.get("time_gpu_min", avg), avg)
+        return cls(ops, args, **kwargs)
+
+    @classmethod
+    def load(cls, filepath, args):
+        """Profile of a sample file (.jsonl) or of a summary (.txt, e.g. --comp_filepath)."""
+        if filepath.endswith(".jsonl"):
+            samples = {}
+            with open(filepath) as f:
+                for line in f:
+                    if line.strip():
+                        sample = json.loads(line)
+                        samples.setdefault(sample["op"], []).append(sample["time_gpu"])
+            return cls.from_samples(samples, args, filepath=filepath)
+        return cls.from_times(parse_aiob_times(filepath), args, filepath=filepath)
+
+    def dump_summary(self, filepath):
+        with open(filepath, "w") as f:
+            f.write(f"train_iter:{self.train_iter}\n")
+            for op, t in self.ops.items():
+                f.write(f"{op}:\n")
+                f.write(f"    time_gpu_max: {t.time_gpu_max}\n")
+                f.write(f"    time_gpu_min: {t.time_gpu_min}\n")
+                f.write(f"    time_gpu_avg: {t.time_gpu_avg}\n")
+        self.filepath = filepath
+        return filepath
+
+
+class AIOBRecorder:
+    """Stream the kernel times of an AIOB run to <summary_path without .txt>.jsonl."""
+
+    def __init__(self, summary_path, args):
+        self.summary_path = summary_path
+        self.samples_path = os.path.splitext(summary_path)[0] + ".jsonl"
+        self.args = args
+        self.samples = {}
+        self._f = open(self.samples_path, "w")
+
+    def record(self, op, time_gpu):
+        self.samples.setdefault(op, []).append(time_gpu)
+        self._f.write(json.dumps({"op": op, "time_gpu": time_gpu}) + "\n")
+
+    def close(self, train_iter=None):
+        """Aggregate the samples, write the summary and return the ComputeProfile."""
+        self._f.close()
+        profile = ComputeProfile.from_samples(self.samples, self.args, train_iter=train_iter)
+        profile.dump_summary(self.summary_path)
+        print(f"Compute-results save in:{self.summary_path}")
+        return profile
+
+
+def cpu_measure_args(args):
+    """Args of the reduced model AIOB runs on CPU for args."""
+    shrink = args.aiob_cpu_shrink
+    measure_args = copy.copy(args)
+    tp = args.tensor_model_parallel_size
+    # sequence parallel layernorms split the sequence between the tp ranks
+    measure_args.seq_length = max(args.seq_length // shrink // tp, 1) * tp
+    measure_args.model_param = max(args.model_param // shrink, tp)
+    measure_args.dtype = "float32"
+    measure_args.aiob_cpu_measure = True
+    return measure_args
+
+
+def profile_on_cpu(args):
+    """AIOB profile of args measured on CPU, scaled to the shapes and GPU of args."""
+    from workload_generator.aiob_db import OP_WORK, profile_shape
+    from workload_generator.aiob_calibration import load_calibration
+
+    measure_args = cpu_measure_args(args)
+    profile = get_comp_out(measure_args)
+    full, reduced = profile_shape(args), profile_shape(measure_args)
+    factors = {op: OP_WORK[op](full) / OP_WORK[op](reduced) for op in profile.ops if op in OP_WORK}
+    if args.aiob_calibration:
+        ratios = load_calibration(args.aiob_calibration)
+        factors = {op: f * ratios(op) for op, f in factors.items()}
+    else:
+        print("WARNING: no --aiob_calibration, the AIOB profile holds CPU times")
+    scaled = profile.scaled(factors, args)
+    scaled.dump_summary(get_aiob_path(args))
+    print(f"Compute-results save in:{scaled.filepath}")
+    return scaled
+
+
+# args besides aiob_db.profile_shape that change the kernels AIOB measures
+STORE_KEY_ARGS = (
+    "enable_sequence_parallel", "num_experts", "expert_model_parallel_size", "moe_grouped_gemm",
+    "add_bias_linear", "openai_gelu", "squared_relu", "onnx_safe", "max_position_embeddings",
+    "aiob_estimator", "aiob_device", "aiob_cpu_shrink", "aiob_calibration",
+)
+
+
+def gpu_name(args):
+    if args.gpu_type:
+        return args.gpu_type
+    if args.aiob_device == "cpu":
+        return "cpu"
+    import torch
+
+    return torch.cuda.get_device_name()
+
+
+def profile_key(args):
+    """{arg: value} a stored profile must match, and its hash."""
+    from workload_generator.aiob_db import profile_shape
+
+    key_args = dict(profile_shape(args), gpu_type=gpu_name(args))
+    key_args.update((name, getattr(args, name, None)) for name in STORE_KEY_ARGS)
+    digest = hashlib.sha1(json.dumps(key_args, sort_keys=True).encode()).hexdigest()[:16]
+    return key_args, digest
+
+
+class AIOBProfileStore:
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, args):
+        return os.path.join(self.root, profile_key(args)[1] + ".txt")
+
+    def get(self, args):
+        """Stored ComputeProfile of args, None when there is none."""
+        filepath = self.path(args)
+        if not os.path.exists(filepath):
+            return None
+        print(f"AIOB profile found in store: {filepath}")
+        return ComputeProfile.load(filepath, args)
+
+    def put(self, profile, args):
+        key_args, digest = profile_key(args)
+        os.makedirs(self.root, exist_ok=True)
+        source = profile.filepath
+        profile.dump_summary(os.path.join(self.root, digest + ".txt"))
+        with open(os.path.join(self.root, digest + ".json"), "w") as f:
+            json.dump({"args": key_args, "source": source}, f, indent=2)
+        profile.filepath = source
+        return digest
+
+
+def lookup_or_profile(args):
+    """ComputeProfile of args from the --aiob_store, or measured and stored."""
+    store = AIOBProfileStore(args.aiob_store) if args.aiob_store else None
+    if store is not None and not args.aiob_profile:
+        profile = store.get(args)
+        if profile is not None:
+            return profile
+    profile = get_comp_out(args)
+    if store is not None:
+        store.put(profile, args)
+    return profile
+
+
+def shared_compute_profile(args):
+    """ComputeProfile of args on every rank, looked up or measured by global rank 0 only."""
+    import torch
+
+    if args.aiob_device == "cuda":
+        torch.cuda.set_device(torch.distributed.get_rank() % torch.cuda.device_count())
+    payload = [None, None]
+    if torch.distributed.get_rank() == 0:
+        profile = lookup_or_profile(args)
+        payload = [profile.times(), profile.train_iter]
+    torch.distributed.broadcast_object_list(payload, src=0)
+    return ComputeProfile.from_times(payload[0], args, train_iter=payload[1])
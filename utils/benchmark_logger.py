@@ -58,6 +58,20 @@ class BenchLogger:
         self.epoch_timer = Timer(use_host_timer=True)
         self.epoch = 0
         self.epoch_timer.start()
+        self.live_metrics = None
+
+    def enable_live_metrics(self, filename=None, port=None, interval=10.0, total_iterations=None):
+        from utils.live_metrics import LiveMetricsPublisher
+
+        self.live_metrics = LiveMetricsPublisher(
+            filename=filename, port=port, interval=interval, total_iterations=total_iterations
+        )
+        self.live_metrics.start()
+
+    def stop_live_metrics(self):
+        if self.live_metrics is not None:
+            self.live_metrics.stop()
+            self.live_metrics = None
 
     def log_timing(self, name):
         def decorator(func):
@@ -72,6 +86,8 @@ class BenchLogger:
                 else:
                     log_item.elapsed_time = elapsed_time_ms
                 self.comm_log.add_comm_log(log_item)
+                if self.live_metrics is not None:
+                    self.live_metrics.record_op(log_item)
                 if torch.distributed.get_rank() == 0:
                     logger.info(log_item.view_as_ds_log())
                 return result
@@ -89,6 +105,8 @@ class BenchLogger:
             )
         log_item.elapsed_time = elapsed_time_ms
         self.comm_log.add_comm_log(log_item)
+        if self.live_metrics is not None:
+            self.live_metrics.record_iteration(elapsed_time_ms)
         self.epoch += 1
         self.epoch_timer.start()
 
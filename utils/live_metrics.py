@@ -0,0 +1,195 @@
+"""
+Copyright (c) 2021, Alibaba Group;
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    idx = min(int(len(sorted_values) * q), len(sorted_values) - 1)
+    return sorted_values[idx]
+
+
+class LiveMetricsPublisher:
+    """Publish running benchmark metrics while a workload is being applied.
+
+    The hot path (record_op / record_iteration) only bumps counters; all
+    aggregation, formatting and I/O happen on a background thread every
+    `interval` seconds. Metrics are written to `filename` as JSON through an
+    atomic os.replace, and optionally served in Prometheus text format on
+    http://127.0.0.1:<port>/metrics (JSON on /metrics.json).
+    """
+
+    def __init__(self, filename=None, port=None, interval=10.0, total_iterations=None, window=100):
+        self.filename = filename
+        self.port = port
+        self.interval = interval
+        self.total_iterations = total_iterations
+        self.iteration_times = deque(maxlen=window)
+        self.iterations_completed = 0
+        self.init_time_ms = None
+        # comm_type -> [count, elapsed_ms_sum, busbw_sum, busbw_count]
+        self.comm_stats = {}
+        self.start_time = time.time()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._server = None
+        self._prom_text = ""
+        self._json_text = "{}"
+
+    def record_op(self, log_item):
+        stats = self.comm_stats.get(log_item.comm_type)
+        if stats is None:
+            stats = self.comm_stats[log_item.comm_type] = [0, 0.0, 0.0, 0]
+        stats[0] += 1
+        if log_item._elapsed_time:
+            stats[1] += log_item._elapsed_time
+        if log_item.busbw:
+            stats[2] += log_item.busbw
+            stats[3] += 1
+
+    def record_iteration(self, elapsed_time_ms):
+        # the first epoch_end closes the init stage, not a training iteration
+        if self.init_time_ms is None:
+            self.init_time_ms = elapsed_time_ms
+            return
+        self.iteration_times.append(elapsed_time_ms)
+        self.iterations_completed += 1
+
+    def snapshot(self):
+        iter_times = sorted(self.iteration_times)
+        elapsed_s = time.time() - self.start_time
+        eta_s = None
+        if self.total_iterations and iter_times:
+            remaining = max(self.total_iterations - self.iterations_completed, 0)
+            eta_s = remaining * (sum(iter_times) / len(iter_times)) / 1000
+        comm = {}
+        for comm_type, (count, time_sum, busbw_sum, busbw_count) in list(self.comm_stats.items()):
+            comm[getattr(comm_type, "value", str(comm_type))] = {
+                "count": count,
+                "elapsed_time_ms": round(time_sum, 3),
+                "busbw_avg": round(busbw_sum / busbw_count, 2) if busbw_count else None,
+            }
+        return {
+            "timestamp": time.time(),
+            "elapsed_s": round(elapsed_s, 3),
+            "iterations_completed": self.iterations_completed,
+            "total_iterations": self.total_iterations,
+            "eta_s": round(eta_s, 3) if eta_s is not None else None,
+            "init_time_ms": self.init_time_ms,
+            "iteration_time_ms": {
+                "window": len(iter_times),
+                "mean": sum(iter_times) / len(iter_times) if iter_times else None,
+                "p50": _percentile(iter_times, 0.5),
+                "p90": _percentile(iter_times, 0.9),
+                "p99": _percentile(iter_times, 0.99),
+                "max": iter_times[-1] if iter_times else None,
+            },
+            "comm": comm,
+        }
+
+    @staticmethod
+    def to_prometheus(metrics):
+        lines = []
+
+        def gauge(name, help_str, samples):
+            samples = [(labels, value) for labels, value in samples if value is not None]
+            if not samples:
+                return
+            lines.append(f"# HELP {name} {help_str}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                label_str = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+
+        gauge("aicb_iterations_completed", "Training iterations completed.",
+              [({}, metrics["iterations_completed"])])
+        gauge("aicb_iterations_total", "Training iterations requested.",
+              [({}, metrics["total_iterations"])])
+        gauge("aicb_eta_seconds", "Estimated seconds until the workload finishes.",
+              [({}, metrics["eta_s"])])
+        gauge("aicb_iteration_time_ms", "Rolling iteration time percentiles in ms.",
+              [({"quantile": q}, metrics["iteration_time_ms"][k])
+               for q, k in (("0.5", "p50"), ("0.9", "p90"), ("0.99", "p99"))])
+        gauge("aicb_comm_ops_total", "Communication ops applied per comm type.",
+              [({"comm_type": t}, v["count"]) for t, v in metrics["comm"].items()])
+        gauge("aicb_comm_busbw_gbps", "Average bus bandwidth per comm type in GB/s.",
+              [({"comm_type": t}, v["busbw_avg"]) for t, v in metrics["comm"].items()])
+        return "\n".join(lines) + "\n"
+
+    def publish(self):
+        metrics = self.snapshot()
+        self._json_text = json.dumps(metrics, indent=2)
+        self._prom_text = self.to_prometheus(metrics)
+        if self.filename:
+            folder = os.path.dirname(self.filename)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder, exist_ok=True)
+            tmp_filename = f"{self.filename}.tmp.{os.getpid()}"
+            with open(tmp_filename, "w") as f:
+                f.write(self._json_text)
+            os.replace(tmp_filename, self.filename)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.publish()
+            except OSError as e:
+                print(f"WARNING: failed to publish live metrics: {e}")
+
+    def _start_server(self):
+        publisher = self
+
+        class _MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith("/metrics.json"):
+                    body, content_type = publisher._json_text, "application/json"
+                elif self.path.startswith("/metrics"):
+                    body, content_type = publisher._prom_text, "text/plain; version=0.0.4"
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", self.port), _MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def start(self):
+        if self.port:
+            self._start_server()
+        self.publish()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.publish()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
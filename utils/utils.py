@@ -13,6 +13,7 @@ limitations under the License.
 
 from typing import List, Dict
 import pandas as pd
+import numpy as np
 import pickle
 from enum import Enum
 import argparse
@@ -20,7 +21,7 @@ import sys
 import time
 import os
 import json
-from collections import defaultdict
+from collections import defaultdict, Counter
 import math
 import re
 
@@ -81,62 +82,23 @@ def generate_masked_orthogonal_rank_groups(
         dp_group[1] = 1 + range(0, 3) * 2 + 0 = [1, 3, 5]
         ...
         dp_group[7] = 1 + range(0, 3) * 2 + 3 * 2 * 3 = [19, 21, 23]
-    """
 
-    def prefix_product(a: List[int], init=1) -> List[int]:
-        r = [init]
-        for v in a:
-            init = init * v
-            r.append(init)
-        return r
-
-    def inner_product(a: List[int], b: List[int]) -> int:
-        return sum([x * y for x, y in zip(a, b)])
-
-    def decompose(index, shape, stride=None):
-        ''' 
-        This function solve the math problem below:
-            There is an equation: 
-                index = sum(idx[i] * stride[i])
-            And given the value of index, stride.
-            Return the idx.
-        This function will used to get the pp/dp/pp_rank
-        from group_index and rank_in_group.
-        '''
-        if stride is None:
-            stride = prefix_product(shape)
-        idx = [(index // d) % s for s, d in zip(shape, stride)]
-        # stride is a prefix_product result. And the value of stride[-1]
-        # is not used.
-        assert (
-            sum([x * y for x, y in zip(idx, stride[:-1])]) == index
-        ), "idx {} with shape {} mismatch the return idx {}".format(index, shape, idx)
-        return idx
-
-    masked_shape = [s for s, m in zip(parallel_size, mask) if m]
-    unmasked_shape = [s for s, m in zip(parallel_size, mask) if not m]
-
-    global_stride = prefix_product(parallel_size)
-    masked_stride = [d for d, m in zip(global_stride, mask) if m]
-    unmasked_stride = [d for d, m in zip(global_stride, mask) if not m]
-
-    group_size = prefix_product(masked_shape)[-1]
-    num_of_group = world_size // group_size
-
-    ranks = []
-    for group_index in range(num_of_group):
-        # get indices from unmaksed for group_index.
-        decomposed_group_idx = decompose(group_index, unmasked_shape)
-        rank = []
-        for rank_in_group in range(group_size):
-            # get indices from masked for rank_in_group.
-            decomposed_rank_idx = decompose(rank_in_group, masked_shape)
-            rank.append(
-                inner_product(decomposed_rank_idx, masked_stride)
-                + inner_product(decomposed_group_idx, unmasked_stride)
-            )
-        ranks.append(rank)
-    return ranks
+    The ranks are laid out as an array of shape parallel_size with the
+    first parallel type varying fastest. Transposing the unmasked axes
+    before the masked ones, both from the slowest to the fastest, and
+    flattening each side gives all the groups at once.
+    """
+    assert math.prod(parallel_size) == world_size, \
+        f"parallel sizes {parallel_size} do not multiply to the world size {world_size}"
+    num_dims = len(parallel_size)
+    # axis of the i-th parallel type in the C-ordered rank array
+    masked_axes = [num_dims - 1 - i for i in reversed(range(num_dims)) if mask[i]]
+    unmasked_axes = [num_dims - 1 - i for i in reversed(range(num_dims)) if not mask[i]]
+    group_size = math.prod(s for s, m in zip(parallel_size, mask) if m)
+
+    ranks = np.arange(world_size).reshape(parallel_size[::-1])
+    ranks = ranks.transpose(unmasked_axes + masked_axes).reshape(world_size // group_size, group_size)
+    return ranks.tolist()
 class RankGenerator(object):
     def __init__(self, tp: int, ep: int, dp: int, pp: int, cp: int, order: str) -> None:
         self.tp = tp
@@ -240,25 +202,64 @@ def erf_gelu(x):
     )
 
 
+# (substring of a computation stage, compute cache key), the first matching rule wins
+AIOB_STAGE_RULES = (
+    ("attention", "attention_{phase}"),
+    ("mlp", "mlp_{phase}"),
+    ("embedding", "Emb"),
+    ("grad", "grad_{phase}"),
+    ("layernorm", "layernorm_post"),
+    ("logit", "logit_time"),
+)
+
+
+def aiob_stage_key(stage):
+    """Compute cache key of a computation stage, None if no rule matches it."""
+    phase = "backward" if stage.startswith(("backward", "weight_grad")) else "forward"
+    lowered = stage.lower()
+    for token, key in AIOB_STAGE_RULES:
+        if token in lowered:
+            return key.format(phase=phase)
+    return None
+
+
+def map_aiob_stages(stages, compute_cache):
+    """{stage: compute cache key} of the distinct stages, and the stages without a compute time."""
+    mapping, unmapped = {}, []
+    for stage in stages:
+        key = aiob_stage_key(stage)
+        if key in compute_cache:
+            mapping[stage] = key
+        else:
+            unmapped.append(stage)
+    return mapping, unmapped
+
+
 def Comp_with_aiob(workload, compute_cache):
-    for item in workload.workload:
-        if item.comm_type == CommType.computation:
-            for key in compute_cache:
-                key_temp = key.split("_")[0]
-                if key_temp in item.stage:
-                    item._elapsed_time = compute_cache[key]
-                    break
+    items = [item for item in workload.workload if item.comm_type == CommType.computation]
+    stage_counts = Counter(item.stage for item in items)
+    mapping, unmapped = map_aiob_stages(stage_counts, compute_cache)
+    for stage in unmapped:
+        print(f"WARNING: no AIOB compute time for stage {stage} ({stage_counts[stage]} items), left unchanged")
+    stage_times = {stage: compute_cache[key] for stage, key in mapping.items()}
+    for item in items:
+        if item.stage in stage_times:
+            item._elapsed_time = stage_times[item.stage]
     return workload
 
 
 def get_comp_out(args):
+    if args.aiob_device == "cpu" and not getattr(args, "aiob_cpu_measure", False):
+        from utils.aiob_profile import profile_on_cpu
+
+        return profile_on_cpu(args)
     vocab_size = args.vocab_size
     batch_size = args.micro_batch
     seq_len = args.seq_length
     tp = args.tensor_model_parallel_size
     vocab_size = args.padded_vocab_size
     if "Megatron" in args.frame:
-        device = torch.cuda.current_device()
+        device = aiob_device(args)
         from workload_generator.mocked_model.AiobMegatron import MegatronModel
 
         measure_model = MegatronModel(args)
@@ -280,23 +281,18 @@ def get_comp_out(args):
             device=device,
             dtype=torch.int64,
         )
-        filepath = measure_model(masked_input)
-        return filepath
+        # ComputeProfile of the run, its summary is written to get_aiob_path(args)
+        return measure_model(masked_input)
 
     
 
 
-def extract_averages(file_path,args):
-    attention_avg_sum = 0.0
-    mlp_avg_sum = 0.0
-    other_avgs = {}
-    grad_forward = 0.0
-    grad_backward = 0.0
-
+def parse_aiob_times(file_path):
+    """{op: {"time_gpu_avg": .., "time_gpu_min": .., ...}} of an AIOB output file, in file order."""
     section_header_re = re.compile(r"^(\w+):")
-    time_gpu_avg_re = re.compile(r"time_gpu_avg:\s+(\d+(\.\d+)?)")
-    time_gpu_min_re = re.compile(r"time_gpu_min:\s+(\d+(\.\d+)?)")
+    time_gpu_re = re.compile(r"(time_gpu_avg|time_gpu_min|time_gpu_max):\s+(\d+(\.\d+)?)")
 
+    times = {}
     with open(file_path, "r") as file:
         current_section = None
 
@@ -305,25 +301,38 @@ def extract_averages(file_path,args):
             if header_match:
                 current_section = header_match.group(1).strip()
 
-            avg_match = time_gpu_avg_re.search(line)
-            min_match = time_gpu_min_re.search(line)
-            if current_section == "param_time":
-                if min_match:
-                    grad_forward = float(min_match.group(1)) * 1000 #us
-                if avg_match:
-                    grad_backward = float(avg_match.group(1)) * 1000
-            elif avg_match and current_section:
-                avg_value = float(avg_match.group(1)) * 1000
-                if "atten" in current_section or current_section == "layernorm":
-                    
-                    if args.recompute_activations and 'flash' in current_section:
-                        attention_avg_sum += avg_value*2
-                    else:
-                        attention_avg_sum += avg_value
-                elif "mlp" in current_section or current_section == "layernorm2":
-                    mlp_avg_sum += avg_value
+            for match in time_gpu_re.finditer(line):
+                if current_section:
+                    times.setdefault(current_section, {})[match.group(1)] = float(match.group(2))
+    return times
+
+
+def aggregate_aiob_times(times, args):
+    """SimAI compute cache of per-op AIOB times, as returned by extract_averages."""
+    attention_avg_sum = 0.0
+    mlp_avg_sum = 0.0
+    other_avgs = {}
+    grad_forward = 0.0
+    grad_backward = 0.0
+
+    for current_section, values in times.items():
+        if current_section == "param_time":
+            if "time_gpu_min" in values:
+                grad_forward = values["time_gpu_min"] * 1000 #us
+            if "time_gpu_avg" in values:
+                grad_backward = values["time_gpu_avg"] * 1000
+        elif "time_gpu_avg" in values:
+            avg_value = values["time_gpu_avg"] * 1000
+            if "atten" in current_section or current_section == "layernorm":
+                
+                if args.recompute_activations and 'flash' in current_section:
+                    attention_avg_sum += avg_value*2
                 else:
-                    other_avgs[current_section] = avg_value
+                    attention_avg_sum += avg_value
+            elif "mlp" in current_section or current_section == "layernorm2":
+                mlp_avg_sum += avg_value
+            else:
+                other_avgs[current_section] = avg_value
 
     # 四舍五入并转换为整数
     attention_forward = round(attention_avg_sum)
@@ -347,57 +356,23 @@ def extract_averages(file_path,args):
     return a100_compute_cache
 
 
-def process_all_keys(input_file):
-
-    with open(input_file, "r") as file:
-        first_line_str = file.readline().strip()
-        remaining_content = file.read().strip()
-    # 尝试修复和构建合法的 JSON 字符串
-    corrected_content = remaining_content.replace("}{", "},{").replace("]}{", "]},{")
-
-    # 构建 JSON 数组
-    json_str = f"[{corrected_content}]"
-
-    try:
-        data = json.loads(json_str)
-
-        processed_results = defaultdict(lambda: defaultdict(list))
-        for entry in data:
-            for key, measurements in entry.items():
-                for measure in measurements:
-                    measure_key, measure_value = next(iter(measure.items()))
-                    if "time_gpu" in measure_key:
-                        processed_results[key]["time_gpu"].append(measure["time_gpu"])
-                    else:
-                        processed_results[key][measure_key] = measure_value
-
-        for key, values in processed_results.items():
-            if "time_gpu" in values:
-                gpu_times = values["time_gpu"]
-                min_time_gpu = min(gpu_times)
-                gpu_times_filtered = [t for t in gpu_times if t <= 3 * min_time_gpu]
-                values["time_gpu_max"] = max(gpu_times_filtered)
-                values["time_gpu_min"] = min_time_gpu
-                values["time_gpu_avg"] = sum(gpu_times_filtered) / len(
-                    gpu_times_filtered
-                )
-                del values["time_gpu"]
+def extract_averages(file_path,args):
+    return aggregate_aiob_times(parse_aiob_times(file_path), args)
 
-        with open(input_file, "w") as outfile:
-            outfile.write(first_line_str + "\n")
-            for key, values in processed_results.items():
-                outfile.write(f"{key}:\n")
-                for subkey, subvalue in values.items():
-                    outfile.write(f"    {subkey}: {subvalue}\n")
-        print(f"Compute-results save in:{input_file}")
 
-    except json.JSONDecodeError as e:
-        print(f"Failed to decode JSON: {e}")
-        print("Invalid JSON content:\n", corrected_content)
+def aiob_device(args):
+    if args.aiob_device == "cpu":
+        return torch.device("cpu")
+    return torch.device("cuda", torch.cuda.current_device())
 
 
 def cuda_timing_decorator(func):
     def wrapper(*args, **kwargs):
+        if getattr(args[0], "device", None) == torch.device("cpu"):
+            # wall clock on CPU, in us like the CUDA events
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            return result, (time.perf_counter() - start) * 1e6
 
         start_event = torch.cuda.Event(enable_timing=True)
         end_event = torch.cuda.Event(enable_timing=True)
@@ -416,19 +391,13 @@ def get_aiob_path(args):
     if not os.path.isdir(result_dir):
         os.makedirs(result_dir)
     filename = f"{args.model_name}-world_size{args.world_size}-tp{args.tensor_model_parallel_size}-pp{args.pipeline_model_parallel}-ep{args.expert_model_parallel_size}-gbs{args.global_batch}-mbs{args.micro_batch}-seq{args.seq_length}-flash_attn-{args.use_flash_attn}.txt"
+    if getattr(args, "aiob_cpu_measure", False):
+        filename = filename[:-len(".txt")] + "-cpu_raw.txt"
+    elif args.aiob_device == "cpu":
+        filename = filename[:-len(".txt")] + "-cpu.txt"
     filepath = os.path.join(result_dir, filename)
     return filepath
 
-def write_op(time_list, args):
-    filepath = get_aiob_path(args)
-    with open(filepath, "w") as file:
-        file.write(f"train_iter:{args.epoch_num}\n")
-        data_str = json.dumps(time_list, indent=4)
-
-        file.write(data_str)
-    return filepath
-
-
 class ReduceOp(Enum):
     SUM = 0
     PRODUCT = 1
@@ -495,7 +464,7 @@ class WorkloadWriter:
         return workload, args
 
 
-def get_params():
+def get_params(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--frame",
@@ -550,7 +519,9 @@ def get_params():
     get_moe_params(parser)
     get_simAI_workload_params(parser)
     get_aiob_params(parser)
-    args = parser.parse_args()
+    get_live_metrics_params(parser)
+    get_trace_params(parser)
+    args = parser.parse_args(argv)
 
     assert (
         args.world_size % (args.tensor_model_parallel_size * args.pipeline_model_parallel) == 0
@@ -618,6 +589,33 @@ def get_aiob_params(parser: argparse.ArgumentParser):
     )
     parser.add_argument("--comp_filepath", type=str, default=None,
                         help="Use aiob_lib to get operation real compute time",)
+    parser.add_argument("--aiob_db", type=str, default=None,
+                        help="AIOB time database: compute times of unprofiled shapes are interpolated "
+                        "from it, new AIOB profiles are stored in it")
+    parser.add_argument("--aiob_profile", action="store_true",
+                        help="Profile with AIOB even when --aiob_db is set or --aiob_store has the profile")
+    parser.add_argument("--aiob_store", type=str, default="results/aiob_store",
+                        help="Directory of AIOB profiles reused by later runs of the same shape and GPU, "
+                        "empty to disable")
+    parser.add_argument("--aiob_estimator", choices=["median", "trimmed_mean", "min", "mean"], default="median",
+                        help="Op time of the AIOB samples, mean is the mean of the samples below 3x the minimum")
+    parser.add_argument("--aiob_warmup", type=int, default=3,
+                        help="AIOB iterations run before measuring")
+    parser.add_argument("--aiob_rel_ci", type=float, default=0.02,
+                        help="AIOB measures an op until the 95%% confidence interval of its mean is within this "
+                        "fraction of the mean")
+    parser.add_argument("--aiob_min_samples", type=int, default=5)
+    parser.add_argument("--aiob_max_samples", type=int, default=100)
+    parser.add_argument("--aiob_device", choices=["cuda", "cpu"], default="cuda",
+                        help="Run the AIOB kernels on CPU with wall clock timers, on shapes reduced by "
+                        "--aiob_cpu_shrink, and scale the times to the full shapes")
+    parser.add_argument("--aiob_cpu_shrink", type=int, default=8,
+                        help="Factor the sequence length and the gradient buffer are divided by on CPU")
+    parser.add_argument("--aiob_calibration", type=str, default=None,
+                        help="GPU/CPU time ratios of workload_generator.aiob_calibration applied to CPU profiles")
+    parser.add_argument("--aiob_analytic", action="store_true",
+                        help="Estimate compute times with the roofline model of --gpu_type instead of profiling, "
+                        "the default without a GPU")
     parser.add_argument("--gated_linear_unit", default=False)
     parser.add_argument("--bias_gelu_fusion", action="store_true",
                         help='Enable bias and gelu fusion.')
@@ -635,6 +633,25 @@ def get_aiob_params(parser: argparse.ArgumentParser):
                        'with larger models, sequences, and batch sizes.')
 
 
+def get_live_metrics_params(parser: argparse.ArgumentParser):
+    parser.add_argument("--live_metrics_file", type=str,
+                        default=os.environ.get("AICB_LIVE_METRICS_FILE"),
+                        help="Periodically publish running metrics to this JSON file "
+                        "(defaults to $AICB_LIVE_METRICS_FILE)")
+    parser.add_argument("--live_metrics_port", type=int,
+                        default=int(os.environ.get("AICB_LIVE_METRICS_PORT", 0)),
+                        help="Serve running metrics in Prometheus text format on "
+                        "127.0.0.1:<port>/metrics, 0 disables (defaults to $AICB_LIVE_METRICS_PORT)")
+    parser.add_argument("--live_metrics_interval", type=float, default=10.0,
+                        help="Seconds between two live metrics publications")
+
+
+def get_trace_params(parser: argparse.ArgumentParser):
+    parser.add_argument("--trace_file", type=str, default=None,
+                        help="PyTorch execution trace (JSON), or DeepSpeed comm log files/directories "
+                        "separated by commas, to convert into a workload")
+
+
 def get_model_params(parser: argparse.ArgumentParser):
     parser.add_argument("--model_name", help="Model for training")
     parser.add_argument(
@@ -706,6 +723,8 @@ def get_collective_test_params(parser: argparse.ArgumentParser):
 
 def get_simAI_workload_params(parser: argparse.ArgumentParser):
     parser.add_argument("--overlap_version", action="store_true")
+    parser.add_argument("--stream_workload", action="store_true",
+                        help="Write SimAI workload rows to disk while generating instead of keeping them in memory")
 
 def get_moe_params(parser: argparse.ArgumentParser):
     parser.add_argument('--moe_enable', action="store_true")
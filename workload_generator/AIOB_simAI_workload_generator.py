@@ -14,8 +14,10 @@ limitations under the License.
 import workload_generator.mocked_model.MockedDeepspeed
 from workload_generator.mocked_model.MockedMegatron import *
 from workload_generator.mocked_model.MockedModel import MockedParam, MockedModel
-from utils.utils import CommType, get_params, get_comp_out, extract_averages
+from utils.utils import CommType, get_params
+from utils.aiob_profile import ComputeProfile, lookup_or_profile
 import os
+import shutil
 from typing import List, Tuple
 from collections import deque
 import dataclasses
@@ -33,21 +35,116 @@ import re
 
 
 
-@dataclasses.dataclass
+WORK_ITEM_FIELDS = (
+    "name", "placeholder",
+    "forward_compute_time", "forward_comm", "forward_comm_size",
+    "backward_compute_time", "backward_comm", "backward_comm_size",
+    "dp_compute_time", "dp_comm", "dp_comm_size",
+    "process_time",
+)
+_WORK_ITEM_ROW = "\t".join(["%s"] * len(WORK_ITEM_FIELDS)) + "\n"
+
+
 class Work_Item:
-    name: str = dataclasses.field(default="none")
-    placeholder: int = dataclasses.field(default=-1)
-    forward_compute_time: int = dataclasses.field(default=0)
-    forward_comm: str = dataclasses.field(default="NONE")
-    forward_comm_size: int = dataclasses.field(default=0)
-    backward_compute_time: int = dataclasses.field(default=0)
-    backward_comm: str = dataclasses.field(default="NONE")
-    backward_comm_size: int = dataclasses.field(default=0)
-    dp_compute_time: int = dataclasses.field(default=0)
-    dp_comm: str = dataclasses.field(default="NONE")
-    dp_comm_size: int = dataclasses.field(default=0)
-    process_time: int = dataclasses.field(default=100)
+    """One row of a SimAI workload; __slots__ keep the hundreds of thousands of rows of MoE workloads small."""
+
+    __slots__ = WORK_ITEM_FIELDS
+
+    def __init__(
+        self,
+        name="none",
+        placeholder=-1,
+        forward_compute_time=0,
+        forward_comm="NONE",
+        forward_comm_size=0,
+        backward_compute_time=0,
+        backward_comm="NONE",
+        backward_comm_size=0,
+        dp_compute_time=0,
+        dp_comm="NONE",
+        dp_comm_size=0,
+        process_time=100,
+    ):
+        self.name = name
+        self.placeholder = placeholder
+        self.forward_compute_time = forward_compute_time
+        self.forward_comm = forward_comm
+        self.forward_comm_size = forward_comm_size
+        self.backward_compute_time = backward_compute_time
+        self.backward_comm = backward_comm
+        self.backward_comm_size = backward_comm_size
+        self.dp_compute_time = dp_compute_time
+        self.dp_comm = dp_comm
+        self.dp_comm_size = dp_comm_size
+        self.process_time = process_time
+
+    def astuple(self):
+        return tuple(getattr(self, k) for k in WORK_ITEM_FIELDS)
+
+    def __eq__(self, other):
+        return isinstance(other, Work_Item) and self.astuple() == other.astuple()
+
+    def __repr__(self):
+        return "Work_Item(" + ", ".join(f"{k}={getattr(self, k)!r}" for k in WORK_ITEM_FIELDS) + ")"
+
+
+class WorkItemWriter:
+    """Format Work_Items in blocks of block_rows rows, one write per block."""
+
+    def __init__(self, f, block_rows=8192):
+        self.f = f
+        self.block_rows = block_rows
+        self.block = []
+        self.rows = 0
+
+    def write(self, item):
+        self.block.append(_WORK_ITEM_ROW % item.astuple())
+        self.rows += 1
+        if len(self.block) >= self.block_rows:
+            self.flush()
+
+    def write_many(self, items):
+        for start in range(0, len(items), self.block_rows):
+            self.f.write("".join([_WORK_ITEM_ROW % item.astuple() for item in items[start:start + self.block_rows]]))
+        self.rows += len(items)
+
+    def flush(self):
+        if self.block:
+            self.f.write("".join(self.block))
+            self.block = []
+
+
+class WorkItemStream:
+    """List-like sink that streams appended Work_Items to disk instead of keeping them.
+
+    SimAI needs the row count in the header, so rows go to a temporary body
+    file first and finalize() writes the header, the count and the body.
+    """
 
+    def __init__(self, filename, block_rows=8192):
+        self.body_filename = filename + ".rows.tmp"
+        self._f = open(self.body_filename, "w")
+        self.writer = WorkItemWriter(self._f, block_rows)
+
+    def append(self, item):
+        self.writer.write(item)
+
+    def __len__(self):
+        return self.writer.rows
+
+    def finalize(self, filename, header):
+        self.writer.flush()
+        self._f.close()
+        with open(filename, "w") as f, open(self.body_filename) as body:
+            f.write(header + "\n" + str(len(self)) + "\n")
+            shutil.copyfileobj(body, f, 1 << 20)
+        os.remove(self.body_filename)
+
+
+def write_work_items(filename, header, workload):
+    with open(filename, "w") as f:
+        f.write(header + "\n" + str(len(workload)) + "\n")
+        WorkItemWriter(f).write_many(workload)
 
 
 def _get_aiob_compute_time(compute_cache, forward_or_backward, stage):
@@ -61,11 +158,8 @@ def _get_aiob_compute_time(compute_cache, forward_or_backward, stage):
     else:
         prefix = stage + "_" + forward_or_backward
 
-    for key, value in compute_time_map.items():
-        if prefix == key:
-
-            compute_time = compute_time_map.get(key)
-            return compute_time
+    if prefix in compute_time_map:
+        return compute_time_map[prefix]
 
     print("[warn] can't match any stage", stage)
     return 1
@@ -79,11 +173,12 @@ class LayerInfo:
 
 
 class SIMAI_workload:
-    def __init__(self, model, args, compute_cache=None):
+    def __init__(self, model, args, compute_cache=None, stream_to=None):
         self.model = model
         self.args = args
         self.compute_cache = compute_cache
-        self.workload = []
+        # with stream_to set, rows are written to disk as they are generated and dump_file(stream_to) completes the file
+        self.workload = WorkItemStream(stream_to + ".txt") if stream_to else []
         self.seq_len = args.seq_length
         self.tp = args.tensor_model_parallel_size
         self.mbs = args.micro_batch
@@ -129,7 +224,7 @@ class SIMAI_workload:
             for child in model.child_modules():
                 traverse_model(child)
 
-        traverse_model(model)
+        traverse_model(self.model)
 
         return layers
 
@@ -227,7 +322,7 @@ class SIMAI_workload:
                     dp_comm_size=0,
                 )
             )
-        if args.tensor_model_parallel_size == 1 :
+        if self.args.tensor_model_parallel_size == 1 :
             emd_backward_comm = "NONE"
         else:
             emd_backward_comm = "ALLREDUCE"
@@ -267,7 +362,7 @@ class SIMAI_workload:
                 dp_comm_size = 0
                 if self.args.enable_sequence_parallel:
                     if "embedding" in name:
-                        if args.tensor_model_parallel_size == 1 :
+                        if self.args.tensor_model_parallel_size == 1 :
                             forward_comm = "NONE"
                             backward_comm = "NONE"
                         else:
@@ -304,7 +399,7 @@ class SIMAI_workload:
                         forward_compute_time = int(forward_compute_time / 2)
                         backward_compute_time = int(backward_compute_time / 2)
                         forward_comm_size_sp = tp_comm_size
-                        if args.tensor_model_parallel_size == 1 :
+                        if self.args.tensor_model_parallel_size == 1 :
                             forward_comm = "NONE"
                             backward_comm = "NONE"
                         else:
@@ -337,7 +432,7 @@ class SIMAI_workload:
                             forward_compute_time *= 2
                         forward_compute_time = int(forward_compute_time / 2)
                         backward_compute_time = int(backward_compute_time / 2)
-                        if args.tensor_model_parallel_size == 1 :
+                        if self.args.tensor_model_parallel_size == 1 :
                             forward_comm = "NONE"
                             backward_comm = "NONE"
                             backward_comm_2 = "NONE"
@@ -366,7 +461,7 @@ class SIMAI_workload:
                         backward_compute_time = _get_aiob_compute_time(
                             self.compute_cache, "backward", name.split("_")[0]
                         )
-                        if args.tensor_model_parallel_size == 1 :
+                        if self.args.tensor_model_parallel_size == 1 :
                             forward_comm1 = "NONE"
                             forward_comm2 = "NONE"
                             forward_comm3 = "ALLTOALL_EP"
@@ -382,7 +477,7 @@ class SIMAI_workload:
                             forward_comm5 = "REDUCESCATTER"
                             forward_comm6 = "ALLTOALL_EP"
                             forward_comm7 = "ALLTOALL"
-                        if args.expert_model_parallel_size != 1:
+                        if self.args.expert_model_parallel_size != 1:
                             self.workload.append(Work_Item(name=name, forward_compute_time=forward_compute_time,
                                         forward_comm = forward_comm1, forward_comm_size= 2*self.mbs*self.seq_len*self.num_experts,
                                         backward_compute_time=backward_compute_time, backward_comm=forward_comm1, backward_comm_size=2*self.mbs*self.seq_len*self.num_experts,
@@ -455,7 +550,7 @@ class SIMAI_workload:
                                         dp_compute_time=default_compute_time, dp_comm=dp_comm, dp_comm_size=dp_comm_size
                                         ))
                 else:
-                    if args.tensor_model_parallel_size == 1 :
+                    if self.args.tensor_model_parallel_size == 1 :
                         forward_comm = "NONE"
                         backward_comm = "NONE"
                     else:
@@ -592,7 +687,7 @@ class SIMAI_workload:
                     dp_comm_size=0,
                 )
             )
-        if args.expert_model_parallel_size != args.dp_num:
+        if self.args.expert_model_parallel_size != self.args.dp_num:
             self.workload.append(Work_Item(name="moe_grad_norm1", forward_compute_time=default_compute_time,
                                     forward_comm = "NONE", forward_comm_size= 0,
                                     backward_compute_time=default_compute_time, backward_comm="NONE", backward_comm_size=0,
@@ -787,22 +882,18 @@ class SIMAI_workload:
             if self.args.pipeline_model_parallel != 1
             else "pp_comm: 0"
         )
-        with open(filename, "w") as f:
-            f.write((
-                f"HYBRID_TRANSFORMER_FWD_IN_BCKWD model_parallel_NPU_group: {self.args.tensor_model_parallel_size} "
-                f"ep: {self.args.expert_model_parallel_size} "
-                f"pp: {self.args.pipeline_model_parallel} "
-                f"vpp: {self.args.num_layers} "
-                f"ga: {self.ga_num} all_gpus: {self.args.world_size} "
-                f"checkpoints: 0 checkpoint_initiates: 0 "
-            ) + pp_comm + "\n")
-
-            f.write(str(len(self.workload)) + "\n")
-            for item in self.workload:
-                f.write(
-                    "\t".join([str(getattr(item, k)) for k in item.__dict__.keys()])
-                    + "\n"
-                )
+        header = (
+            f"HYBRID_TRANSFORMER_FWD_IN_BCKWD model_parallel_NPU_group: {self.args.tensor_model_parallel_size} "
+            f"ep: {self.args.expert_model_parallel_size} "
+            f"pp: {self.args.pipeline_model_parallel} "
+            f"vpp: {self.args.num_layers} "
+            f"ga: {self.ga_num} all_gpus: {self.args.world_size} "
+            f"checkpoints: 0 checkpoint_initiates: 0 "
+        ) + pp_comm
+        if isinstance(self.workload, WorkItemStream):
+            self.workload.finalize(filename, header)
+        else:
+            write_work_items(filename, header, self.workload)
 
 
 class simAI_MicroTest:
@@ -845,72 +936,93 @@ class simAI_MicroTest:
 
     def dump_file(self, filename):
         filename = filename + ".txt"
-        with open(filename, "w") as f:
-            if not self.args.multi_all_reduce_enable:
-                f.write(f"MICRO" + "\n")
-                f.write(str(len(self.workload)) + "\n")
-                for item in self.workload:
-                    f.write(
-                        "\t".join([str(getattr(item, k)) for k in item.__dict__.keys()])
-                        + "\n"
-                    )
-            else:
-                f.write(
-                    f"HYBRID_TRANSFORMER_FWD_IN_BCKWD	model_parallel_NPU_group: {self.args.tensor_model_parallel_size} \
-                        expert_parallel_npu_group: {self.args.expert_model_parallel_size} pp: {self.args.pipeline_model_parallel} \
-                        ga: {self.ga_num} all_gpus: {self.args.world_size} checkpoints: 0 checkpoint_initiates: 0"
-                    + "\n"
-                )
-                f.write(str(len(self.workload)) + "\n")
-                for item in self.workload:
-                    f.write(
-                        "\t".join([str(getattr(item, k)) for k in item.__dict__.keys()])
-                        + "\n"
-                    )
+        if not self.args.multi_all_reduce_enable:
+            header = f"MICRO"
+        else:
+            # micro test rows only carry dp comms, a single pass per iteration
+            header = (
+                f"HYBRID_TRANSFORMER_FWD_IN_BCKWD model_parallel_NPU_group: {self.args.tensor_model_parallel_size} "
+                f"expert_parallel_npu_group: {self.args.expert_model_parallel_size} "
+                f"pp: {self.args.pipeline_model_parallel} "
+                f"ga: 1 all_gpus: {self.args.world_size} checkpoints: 0 checkpoint_initiates: 0"
+            )
+        write_work_items(filename, header, self.workload)
+
+
+def get_simai_filename(args):
+    return f"{args.gpu_type}-{args.model_name}-world_size{args.world_size}-tp{args.tensor_model_parallel_size}-pp{args.pipeline_model_parallel}-ep{args.expert_model_parallel_size}-gbs{args.global_batch}-mbs{args.micro_batch}-seq{args.seq_length}-MOE-{args.moe_enable}-GEMM-{args.moe_grouped_gemm}-flash_attn-{args.use_flash_attn}"
+
+
+def get_compute_cache(args, verbose=True):
+    """ComputeProfile of args from --comp_filepath, the --aiob_db database, a fresh AIOB profile
+    or, without a GPU, the roofline model.
+
+    When the database misses an op of args, the model is profiled (or estimated) as without it.
+    """
+    if args.comp_filepath is not None:
+        if verbose:
+            print("comp_filepath:", args.comp_filepath)
+        return ComputeProfile.load(args.comp_filepath, args)
+    if args.aiob_db and not args.aiob_profile:
+        from workload_generator.aiob_db import AIOBDatabase
+
+        compute_cache = AIOBDatabase(args.aiob_db).compute_cache(args)
+        if compute_cache is not None:
+            return compute_cache
+    from workload_generator.roofline import analytic_compute_cache, cuda_available
+
+    if args.aiob_analytic or (args.aiob_device == "cuda" and not cuda_available()):
+        if verbose and not args.aiob_analytic:
+            print("WARNING: no GPU to profile with AIOB, compute times are estimated with the roofline model")
+        return analytic_compute_cache(args)
+    profile = lookup_or_profile(args)
+    if args.aiob_db and args.gpu_type and (args.aiob_device == "cuda" or args.aiob_calibration):
+        from workload_generator.aiob_db import AIOBDatabase
+
+        AIOBDatabase(args.aiob_db).add_times(profile.times(), args, source=profile.filepath)
+    return profile
+
+
+def generate_simai_workload(args, model=None, compute_cache=None, result_dir="results/workload/", verbose=True):
+    """Generate and dump the SimAI workload of args, returns the file path without the .txt suffix.
+
+    model and compute_cache may be shared between configurations that only
+    differ in world size / global batch, which do not change the mocked model.
+    """
+    if model is None:
+        model = MegatronModel(args)
+    if not os.path.isdir(result_dir):
+        os.makedirs(result_dir, exist_ok=True)
+    filepath = os.path.join(result_dir, get_simai_filename(args))
+    stream_to = filepath if args.stream_workload else None
+    if args.aiob_enable:
+        params = model.parameters()
+        args.model_param = sum(p.numel() for p in params)
+        if compute_cache is None:
+            compute_cache = get_compute_cache(args, verbose)
+
+        if verbose:
+            print("compute_cache = {")
+            for key, value in compute_cache.items():
+                print(f"    '{key}' : {value},")
+            print("}")
+        work = SIMAI_workload(model, args, compute_cache, stream_to=stream_to)
+        work.workload_generate_aiob()
+    else:
+        work = SIMAI_workload(model, args, None, stream_to=stream_to)
+        work.workload_generate()
+    work.dump_file(filepath)
+    return filepath
 
 
 if __name__ == "__main__":
     args = get_params()
     print(args)
     model = MegatronModel(args)
-    result_dir = "results/workload/"
-    if not os.path.isdir(result_dir):
-        os.makedirs(result_dir)
-    filename = f"{args.gpu_type}-{args.model_name}-world_size{args.world_size}-tp{args.tensor_model_parallel_size}-pp{args.pipeline_model_parallel}-ep{args.expert_model_parallel_size}-gbs{args.global_batch}-mbs{args.micro_batch}-seq{args.seq_length}-MOE-{args.moe_enable}-GEMM-{args.moe_grouped_gemm}-flash_attn-{args.use_flash_attn}"
-    filepath = os.path.join(result_dir, filename)
     params = model.parameters()
     # work = SIMAI_workload(model, args, GPU_Tensor_core.A100, "gpt13B")
     # name_layers = work.workload_generate()
     # work.dump_file("test")
     print(sum(p.numel() for p in params))
-    if args.aiob_enable:
-        params = model.parameters()
-        args.model_param = sum(p.numel() for p in params)
-        if args.comp_filepath == None:
-
-            comp_filepath = get_comp_out(args)
-
-            compute_cache = extract_averages(comp_filepath,args)
-        else:
-            print("comp_filepath:", args.comp_filepath)
-            comp_filepath = args.comp_filepath
-            compute_cache = extract_averages(comp_filepath,args)
-
-        print("compute_cache = {")
-        for key, value in compute_cache.items():
-            print(f"    '{key}' : {value},")
-        print("}")
-        work = SIMAI_workload(
-            model, args,compute_cache
-        )
-        name_layers = work.workload_generate_aiob()
-
-        work.dump_file(filepath)
-        print("workload save in :", filepath)
-    # print(args)
-    else:
-
-        work = SIMAI_workload(model, args, None)
-        name_layers = work.workload_generate()
-        work.dump_file(filepath)
-        print(f"workload save in : {filepath}.txt")
+    filepath = generate_simai_workload(args, model)
+    print(f"workload save in : {filepath}.txt")
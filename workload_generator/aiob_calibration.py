@@ -0,0 +1,75 @@
+"""
+Copyright (c) 2021, Alibaba Group;
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""GPU/CPU time ratios that turn CPU AIOB profiles into GPU estimates.
+
+python -m workload_generator.aiob_calibration \
+  --gpu_profile results/aiob_outputs/<profile>.txt \
+  --cpu_profile results/aiob_outputs/<profile>-cpu.txt --output results/aiob_calibration_A100.json
+
+Both profiles must be of the same model shape: the GPU one from a regular
+AIOB run, the CPU one from the same options with --aiob_device cpu and no
+--aiob_calibration. The ratio of every op is stored; CPU profiles of
+other shapes are then scaled with --aiob_calibration <output>. Ops
+without a ratio use the geometric mean of the others.
+"""
+
+import os
+import json
+import math
+import argparse
+from utils.utils import parse_aiob_times
+
+DEFAULT_OUTPUT = "results/aiob_calibration.json"
+
+
+def calibrate(gpu_times, cpu_times):
+    """{op: GPU time / CPU time} of the ops of two parse_aiob_times results."""
+    ratios = {}
+    for op, values in gpu_times.items():
+        cpu_avg = cpu_times.get(op, {}).get("time_gpu_avg")
+        if cpu_avg and "time_gpu_avg" in values:
+            ratios[op] = values["time_gpu_avg"] / cpu_avg
+    return ratios
+
+
+def load_calibration(filepath):
+    """ratio(op) of a calibration file."""
+    with open(filepath) as f:
+        ratios = json.load(f)["ratios"]
+    assert ratios, f"no ratio in calibration {filepath}"
+    default = math.exp(sum(math.log(r) for r in ratios.values()) / len(ratios))
+    return lambda op: ratios.get(op, default)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute the GPU/CPU ratios of AIOB op times.")
+    parser.add_argument("--gpu_profile", required=True, help="AIOB output of a GPU run")
+    parser.add_argument("--cpu_profile", required=True, help="AIOB output of the same shape with --aiob_device cpu")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    args = parser.parse_args()
+
+    ratios = calibrate(parse_aiob_times(args.gpu_profile), parse_aiob_times(args.cpu_profile))
+    assert ratios, "the GPU and CPU profiles have no op in common"
+    for op, ratio in ratios.items():
+        print(f"{op:<20}{ratio:>10.4f}")
+    folder = os.path.dirname(args.output)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump({"gpu_profile": args.gpu_profile, "cpu_profile": args.cpu_profile, "ratios": ratios}, f, indent=2)
+    print(f"calibration save in : {args.output}")
+
+
+if __name__ == "__main__":
+    main()
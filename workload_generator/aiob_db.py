@@ -0,0 +1,249 @@
+"""
+Copyright (c) 2021, Alibaba Group;
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Persistent database of AIOB kernel times, queried for unprofiled shapes.
+
+python -m workload_generator.aiob_db add results/aiob_outputs/<profile>.txt --gpu_type H100 \
+  --hidden_size 4096 --num_attention_heads 32 --seq_length 4096 --tensor_model_parallel_size 8
+python -m workload_generator.aiob_db query --gpu_type H100 --hidden_size 4096 \
+  --num_attention_heads 32 --seq_length 6144 --tensor_model_parallel_size 8
+python -m workload_generator.aiob_db list
+
+Every op time of an AIOB profile is stored with the GPU type and the shape
+it was measured at. A query for another shape interpolates, per op,
+between the profiles of the same GPU type, dtype and kernel variant
+according to the op's work (FLOPs for GEMMs and attention, elements for
+memory bound ops): linearly between the two profiles bracketing the
+target work, or by scaling the nearest profile with the work ratio
+outside of them. SimAI generation uses it with --aiob_db instead of
+profiling, and stores new AIOB profiles in it.
+"""
+
+import os
+import sqlite3
+import argparse
+from utils.utils import get_params, parse_aiob_times
+from utils.aiob_profile import ComputeProfile
+
+DEFAULT_DB = "results/aiob_db.sqlite"
+TIME_FIELDS = ("time_gpu_avg", "time_gpu_min", "time_gpu_max")
+# profiles only interpolate between profiles of the same variant
+VARIANT_FIELDS = ("gpu_type", "dtype", "flash_attn", "gated", "topk")
+SHAPE_FIELDS = (
+    "hidden_size", "ffn_hidden_size", "num_attention_heads", "seq_length",
+    "micro_batch", "tp", "vocab_size", "num_params",
+)
+COLUMNS = ("op",) + VARIANT_FIELDS + SHAPE_FIELDS + ("work",) + TIME_FIELDS + ("source",)
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS aiob_times (
+    op TEXT,
+    gpu_type TEXT,
+    dtype TEXT,
+    flash_attn INTEGER,
+    gated INTEGER,
+    topk INTEGER,
+    {", ".join(f"{field} INTEGER" for field in SHAPE_FIELDS)},
+    work REAL,
+    time_gpu_avg REAL,
+    time_gpu_min REAL,
+    time_gpu_max REAL,
+    source TEXT,
+    UNIQUE (op, {", ".join(VARIANT_FIELDS + SHAPE_FIELDS)})
+);
+CREATE INDEX IF NOT EXISTS aiob_times_variant ON aiob_times(op, {", ".join(VARIANT_FIELDS)});
+"""
+
+
+def _tokens(s):
+    return s["micro_batch"] * s["seq_length"]
+
+
+def _attention_scores(s):
+    return s["micro_batch"] * s["seq_length"] * s["seq_length"] * s["hidden_size"] / s["tp"]
+
+
+def _mlp_gemm(s):
+    return 2 * _tokens(s) * s["hidden_size"] * s["ffn_hidden_size"] * s["topk"] / s["tp"]
+
+
+# work of one AIOB op on one tensor parallel rank, the time of an op is assumed proportional to it
+OP_WORK = {
+    "Emb": lambda s: _tokens(s) * s["hidden_size"],
+    "layernorm": lambda s: _tokens(s) * s["hidden_size"],
+    "layernorm2": lambda s: _tokens(s) * s["hidden_size"],
+    "layernorm_post": lambda s: _tokens(s) * s["hidden_size"],
+    "atten_qkv": lambda s: 2 * _tokens(s) * s["hidden_size"] * 3 * s["hidden_size"] / s["tp"],
+    "atten_flash": lambda s: 4 * _attention_scores(s),
+    "atten_core_qk": lambda s: 2 * _attention_scores(s),
+    "atten_core_softmax": lambda s: _attention_scores(s) * s["num_attention_heads"] / s["hidden_size"],
+    "atten_core_contex": lambda s: 2 * _attention_scores(s),
+    "atten_linear": lambda s: 2 * _tokens(s) * s["hidden_size"] * s["hidden_size"] / s["tp"],
+    "mlp_linear_1": lambda s: _mlp_gemm(s) * (2 if s["gated"] else 1),
+    "mlp_gelu": lambda s: _tokens(s) * s["ffn_hidden_size"] * s["topk"] / s["tp"],
+    "mlp_linear_2": _mlp_gemm,
+    "logit_time": lambda s: 2 * _tokens(s) * s["hidden_size"] * s["vocab_size"] / s["tp"],
+    "param_time": lambda s: s["num_params"] / s["tp"],
+}
+
+
+def profile_shape(args):
+    """Variant and shape fields of the AIOB profile of args."""
+    num_params = getattr(args, "model_param", None)
+    if num_params is None:
+        from workload_generator.comm_volume import megatron_num_params
+
+        num_params = megatron_num_params(args)
+    return {
+        "gpu_type": args.gpu_type,
+        "dtype": args.dtype,
+        "flash_attn": int(bool(args.use_flash_attn)),
+        "gated": int(bool(args.swiglu or args.gated_linear_unit)),
+        "topk": args.moe_router_topk if args.moe_enable else 1,
+        "hidden_size": args.hidden_size,
+        "ffn_hidden_size": args.ffn_hidden_size,
+        "num_attention_heads": args.num_attention_heads,
+        "seq_length": args.seq_length,
+        "micro_batch": args.micro_batch,
+        "tp": args.tensor_model_parallel_size,
+        "vocab_size": args.padded_vocab_size,
+        "num_params": num_params,
+    }
+
+
+def interpolate(points, work):
+    """Time at `work` from [(work, time)] measurements, linear between brackets, proportional outside."""
+    points = sorted(points)
+    below = [p for p in points if p[0] <= work]
+    above = [p for p in points if p[0] >= work]
+    if below and above:
+        (w0, t0), (w1, t1) = below[-1], above[0]
+        if w1 == w0:
+            return (t0 + t1) / 2
+        return t0 + (work - w0) * (t1 - t0) / (w1 - w0)
+    w, t = below[-1] if below else above[0]
+    return t * work / w if w else t
+
+
+class AIOBDatabase:
+    def __init__(self, db_path=DEFAULT_DB):
+        folder = os.path.dirname(db_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript(SCHEMA)
+
+    def add_times(self, times, args, source=""):
+        """Store {op: {time field: value}} measured with args; returns the number of stored ops."""
+        assert args.gpu_type, "--gpu_type is required to store AIOB times"
+        shape = profile_shape(args)
+        rows = []
+        for op, values in times.items():
+            if op not in OP_WORK:
+                print(f"WARNING: no work model for AIOB op {op}, not stored")
+                continue
+            row = dict(shape, op=op, work=OP_WORK[op](shape), source=source)
+            row.update((field, values.get(field)) for field in TIME_FIELDS)
+            rows.append(tuple(row[c] for c in COLUMNS))
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO aiob_times ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                rows,
+            )
+        return len(rows)
+
+    def add_profile(self, filename, args):
+        return self.add_times(parse_aiob_times(filename), args, source=os.path.abspath(filename))
+
+    def query_times(self, args, ops=None):
+        """{op: {time field: value}} for the shape of args, measured or interpolated.
+
+        Ops without any profile of the same GPU type, dtype and variant are left out.
+        """
+        assert args.gpu_type, "--gpu_type is required to query AIOB times"
+        shape = profile_shape(args)
+        times = {}
+        for op in ops or OP_WORK:
+            rows = self.conn.execute(
+                f"SELECT work, {', '.join(TIME_FIELDS)}, {', '.join(SHAPE_FIELDS)} FROM aiob_times "
+                f"WHERE op = ? AND {' AND '.join(f'{field} = ?' for field in VARIANT_FIELDS)}",
+                [op] + [shape[field] for field in VARIANT_FIELDS],
+            ).fetchall()
+            if not rows:
+                continue
+            exact = [r for r in rows if tuple(r[1 + len(TIME_FIELDS):]) == tuple(shape[f] for f in SHAPE_FIELDS)]
+            if exact:
+                times[op] = dict(zip(TIME_FIELDS, exact[0][1:1 + len(TIME_FIELDS)]))
+                continue
+            work = OP_WORK[op](shape)
+            times[op] = {
+                field: interpolate([(r[0], r[1 + i]) for r in rows if r[1 + i] is not None], work)
+                for i, field in enumerate(TIME_FIELDS)
+            }
+        return times
+
+    def compute_cache(self, args):
+        """ComputeProfile of args estimated from the stored profiles, None if any op has no profile."""
+        ops = ["Emb", "layernorm", "layernorm2", "layernorm_post", "logit_time", "param_time"]
+        if args.use_flash_attn:
+            ops += ["atten_qkv", "atten_flash", "atten_linear"]
+        else:
+            ops += ["atten_qkv", "atten_core_qk", "atten_core_softmax", "atten_core_contex", "atten_linear"]
+        ops += ["mlp_linear_1", "mlp_gelu", "mlp_linear_2"]
+        times = self.query_times(args, ops)
+        missing = [op for op in ops if op not in times]
+        if missing:
+            print(f"WARNING: no {args.gpu_type} AIOB profile in {self.db_path} for {', '.join(missing)}")
+            return None
+        return ComputeProfile.from_times(times, args, filepath=self.db_path)
+
+    def list(self):
+        cursor = self.conn.execute(
+            "SELECT gpu_type, dtype, flash_attn, gated, topk, hidden_size, seq_length, micro_batch, tp, "
+            "COUNT(*) AS ops, source FROM aiob_times GROUP BY gpu_type, dtype, flash_attn, gated, topk, "
+            f"{', '.join(SHAPE_FIELDS)} ORDER BY gpu_type, hidden_size, seq_length, micro_batch, tp"
+        )
+        return [d[0] for d in cursor.description], cursor.fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Store AIOB profiles and estimate compute times of new shapes. "
+        "Unrecognized options describe the model, as for the workload generators."
+    )
+    parser.add_argument("cmd", choices=["add", "query", "list"])
+    parser.add_argument("files", nargs="*", help="AIOB output files to add")
+    parser.add_argument("--db", default=DEFAULT_DB)
+    db_args, rest = parser.parse_known_args()
+
+    db = AIOBDatabase(db_args.db)
+    if db_args.cmd == "list":
+        from log_analyzer.results_index import print_table
+
+        print_table(*db.list())
+        return
+    args = get_params(rest)
+    if db_args.cmd == "add":
+        assert db_args.files, "no AIOB output file to add"
+        for filename in db_args.files:
+            print(f"stored {db.add_profile(filename, args)} {args.gpu_type} AIOB ops from {filename} in {db_args.db}")
+        return
+    compute_cache = db.compute_cache(args)
+    assert compute_cache is not None, f"cannot estimate the compute times of this shape from {db_args.db}"
+    for key, value in compute_cache.items():
+        print(f"    '{key}' : {value},")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,62 +11,312 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import os
+import re
 import json
-from utils.utils import CommGroup, CommType
-from log_analyzer.log import LogItem
-from workload_generator.mocked_model.MockedModel import MockedModel
+import pickle
+from utils.utils import CommGroup, CommType, RankGenerator, get_params
+from log_analyzer.log import LogItem, Workload
 from workload_generator.workload_generator import WorkloadGenerator
 
-comm_node = {}
-workload = []
+CHUNK_SIZE = 1 << 20
+PG_INIT_NODE = "## process_group:init ##"
+COMM_NODE = "record_param_comms"
+DTYPE_SIZE = {
+    "double": 8, "float64": 8, "long": 8, "int64": 8,
+    "float": 4, "float32": 4, "int": 4, "int32": 4,
+    "half": 2, "float16": 2, "bfloat16": 2, "short": 2, "int16": 2,
+    "byte": 1, "char": 1, "bool": 1, "uint8": 1, "int8": 1, "float8_e4m3fn": 1, "float8_e5m2": 1,
+}
+# checked in order, so coincident groups (e.g. dp and ep_dp when ep = 1) resolve to the first family
+GROUP_FAMILIES = [
+    (CommGroup.tp_group, "tp", False),
+    (CommGroup.dp_group, "dp", False),
+    (CommGroup.pp_group, "pp", False),
+    (CommGroup.ep_group, "ep", True),
+    (CommGroup.ep_tp_group, "tp-ep", True),
+    (CommGroup.ep_dp_group, "dp", True),
+]
+_WS_RE = re.compile(r"[\s,]*")
+
+
+def iter_json_array(f, key, chunk_size=CHUNK_SIZE):
+    """Yield the elements of the top-level array `key` of a JSON document one by one.
+
+    Only the element being decoded is kept in memory, so multi-GB traces
+    can be scanned in bounded memory.
+    """
+    decoder = json.JSONDecoder()
+    key_re = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    buf = ""
+    while True:
+        match = key_re.search(buf)
+        if match:
+            buf = buf[match.end():]
+            break
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        # keep a tail in case the key straddles two chunks
+        buf = buf[-(len(key) + 16):] + chunk
+    pos, eof = 0, False
+    while True:
+        pos = _WS_RE.match(buf, pos).end()
+        if pos < len(buf) and buf[pos] == "]":
+            return
+        try:
+            element, pos = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        yield element
+        if pos > chunk_size:
+            buf, pos = buf[pos:], 0
+
+
+def string2comm_type(s):
+    s = s.lower().replace("_", "")
+    if "allgather" in s:
+        return CommType.all_gather
+    if "reducescatter" in s:
+        return CommType.reduce_scatter
+    if "allreduce" in s:
+        return CommType.all_reduce
+    if "alltoall" in s:
+        return CommType.all_to_all
+    if "broadcast" in s:
+        return CommType.broadcast
+    if "barrier" in s:
+        return CommType.barrier
+    if "reduce" in s:
+        return CommType.reduce
+    if "send" in s:
+        return CommType.isend
+    if "recv" in s:
+        return CommType.irecv
+    return None
+
+
+def _parse_pg_configs(node):
+    """{pg_name: (ranks, group_size)} from a "## process_group:init ##" node."""
+    values = node.get("inputs", {})
+    values = values.get("values", []) if isinstance(values, dict) else values
+    if not values:
+        return {}
+    configs = json.loads(values[0]) if isinstance(values[0], str) else values[0]
+    if isinstance(configs, dict):
+        configs = [dict(config, pg_name=config.get("pg_name", name)) for name, config in configs.items()]
+    pgs = {}
+    for config in configs:
+        ranks = config.get("ranks", [])
+        if isinstance(ranks, str):
+            ranks = [int(r) for r in re.findall(r"\d+", ranks)]
+        size = config.get("group_size", config.get("pg_size", len(ranks)))
+        pgs[str(config.get("pg_name"))] = (list(ranks), size)
+    return pgs
+
+
+def _parse_comm_node(node):
+    """(op_name, comm_type, pg_name, group_size, msg_size, rank) of a comm node, comm_type None if unknown.
+
+    rank is the group rank recorded with the op: the peer of send/recv, the
+    root of reduce/broadcast and the trace's own rank for other collectives.
+    """
+    name = node.get("name", "")
+    attrs = dict((a.get("name"), a.get("value")) for a in node.get("attrs", []) if isinstance(a, dict))
+    inputs = node.get("inputs")
+    if isinstance(inputs, list):
+        # schema < 1.0.2: nodes named nccl:<op>, tensors as [id, storage_id, offset, numel, itemsize, device]
+        op_name = name.split(":", 1)[-1]
+        msg_size = int(inputs[0][3]) * int(inputs[0][4]) if inputs and isinstance(inputs[0], list) else 0
+        return op_name, string2comm_type(op_name), None, None, msg_size, None
+    op_name = str(attrs.get("collective_name", name.split(":", 1)[-1]))
+    comm_type = string2comm_type(op_name)
+    item_size = DTYPE_SIZE.get(str(attrs.get("dtype", "bfloat16")).lower().split(".")[-1], 2)
+    in_nelems, out_nelems = int(attrs.get("in_msg_nelems", 0) or 0), int(attrs.get("out_msg_nelems", 0) or 0)
+    # like the generated workloads, all_gather/reduce_scatter sizes are the full (unsharded) buffer
+    if comm_type in (CommType.all_gather, CommType.reduce_scatter):
+        nelems = max(in_nelems, out_nelems)
+    else:
+        nelems = in_nelems or out_nelems
+    pg_name = attrs.get("pg_name")
+    if pg_name is None and isinstance(attrs.get("process_group"), (list, tuple)):
+        pg_name = attrs["process_group"][0]
+    group_size = attrs.get("group_size", attrs.get("pg_size"))
+    rank = attrs.get("rank")
+    return (
+        op_name, comm_type, None if pg_name is None else str(pg_name), group_size, nelems * item_size,
+        None if rank is None else int(rank),
+    )
+
+
+def parse_pytorch_trace(filename):
+    """Stream an execution trace into (pg_configs, comm records).
+
+    Records are (comm_type, pg_name, group_size, msg_size, rank) tuples in
+    trace order; unknown comm ops are counted and skipped.
+    """
+    pg_configs, records, unknown = {}, [], {}
+    with open(filename) as f:
+        for node in iter_json_array(f, "nodes"):
+            name = node.get("name", "")
+            if name == PG_INIT_NODE:
+                pg_configs.update(_parse_pg_configs(node))
+                continue
+            if name != COMM_NODE and not name.startswith("nccl:"):
+                continue
+            op_name, comm_type, pg_name, group_size, msg_size, rank = _parse_comm_node(node)
+            if comm_type is None:
+                unknown[op_name] = unknown.get(op_name, 0) + 1
+                continue
+            records.append((comm_type, pg_name, group_size, msg_size, rank))
+    for op_name, count in unknown.items():
+        print(f"WARNING: skip {count} comm op(s) {op_name} that cannot be converted to any comm type")
+    return pg_configs, records
+
+
+class ParallelGroupMapper:
+    """Map process-group ranks to the Megatron comm groups WorkloadApplyer builds."""
+
+    def __init__(self, args):
+        tp, pp = args.tensor_model_parallel_size, args.pipeline_model_parallel
+        cp = getattr(args, "context_parallel_size", 1)
+        ep = getattr(args, "expert_model_parallel_size", 1)
+        self.world_size = args.world_size
+        rank_generator = RankGenerator(
+            tp=tp, ep=ep, dp=args.world_size // (tp * pp * cp), pp=pp, cp=cp, order="tp-cp-ep-dp-pp"
+        )
+        self.group_of_ranks = {}
+        self.group_sizes = {}
+        for comm_group, token, independent_ep in GROUP_FAMILIES:
+            for ranks in rank_generator.get_ranks(token, independent_ep=independent_ep):
+                self.group_of_ranks.setdefault(frozenset(ranks), comm_group)
+                self.group_sizes.setdefault(len(ranks), comm_group)
+        self._warned = set()
+
+    def map(self, ranks=None, group_size=None):
+        """CommGroup for a process group given by its ranks (empty means the world) or, failing that, its size."""
+        if ranks is not None:
+            ranks = frozenset(ranks) if ranks else frozenset(range(self.world_size))
+            if ranks in self.group_of_ranks:
+                return self.group_of_ranks[ranks]
+            group_size = len(ranks)
+        if group_size is not None and int(group_size) in self.group_sizes:
+            return self.group_sizes[int(group_size)]
+        if (ranks, group_size) not in self._warned:
+            self._warned.add((ranks, group_size))
+            print(f"WARNING: process group of size {group_size} matches no parallel group, use dp_group")
+        return CommGroup.dp_group
 
 
 class Pytorch_trace_analyer(WorkloadGenerator):
+    """Replay the comm ops of one iteration of a PyTorch execution trace."""
+
     def __init__(self, args, model, filename):
         super().__init__(args, model)
         self.name = "pytorch_trace"
         self.filename = filename
+        self.trace_items = None
 
     def init(self):
-        pass
-
-    def string2comm_type(self, s):
-        if "all_gather" in s or "_all_gather_base" in s or "_allgather_base" in s:
-            return CommType.all_gather
-        if "reduce_scatter" in s or "_reduce_scatter_base" in s:
-            return CommType.reduce_scatter
-        if "all_reduce" in s:
-            return CommType.all_reduce
-        if "broadcast" in s:
-            return CommType.broadcast
-        if "barrier" in s:
-            return CommType.barrier
-        if "reduce" in s:
-            return CommType.reduce
-        else:
-            print(f"can not convert {s} to any comm type")
-            exit(0)
+        if self.trace_items is not None:
+            return
+        pg_configs, records = parse_pytorch_trace(self.filename)
+        mapper = ParallelGroupMapper(self.args)
+        world_size = self.args.world_size
+
+        def global_rank(pg_name, group_size, rank):
+            """Global rank of group rank `rank`, None when the group's ranks are unknown."""
+            ranks = pg_configs[pg_name][0] if pg_name in pg_configs else None
+            if rank is None:
+                return None
+            if ranks:
+                return ranks[rank] if rank < len(ranks) else None
+            # an empty rank list is the default (world) group
+            if ranks is not None or (group_size and int(group_size) == world_size):
+                return rank
+            return None
+
+        # collectives record the trace's own group rank, which locates the trace in the pipeline
+        trace_rank = None
+        for comm_type, pg_name, group_size, _, rank in records:
+            if comm_type not in (CommType.isend, CommType.irecv, CommType.reduce, CommType.broadcast):
+                trace_rank = global_rank(pg_name, group_size, rank)
+                if trace_rank is not None:
+                    break
+        stage_size = world_size // self.args.pipeline_model_parallel
+
+        def p2p_direction(peer):
+            if trace_rank is None or peer is None or peer % stage_size != trace_rank % stage_size:
+                return None
+            # WorkloadApplyer does not wrap around, the last stage has no next one
+            return {1: "next", -1: "prev"}.get(peer // stage_size - trace_rank // stage_size)
+
+        self.trace_items = []
+        skipped = {}
+        for comm_type, pg_name, group_size, msg_size, rank in records:
+            if pg_name in pg_configs:
+                ranks, size = pg_configs[pg_name]
+                comm_group = mapper.map(ranks, size)
+                group_size = size or len(ranks) or world_size
+            else:
+                comm_group = mapper.map(group_size=group_size)
+            dst, additional = None, None
+            if comm_type in (CommType.isend, CommType.irecv):
+                direction = p2p_direction(global_rank(pg_name, group_size, rank))
+                if direction is None:
+                    skipped[comm_type] = skipped.get(comm_type, 0) + 1
+                    continue
+                comm_group = CommGroup.pp_group
+                additional = ("send_" if comm_type == CommType.isend else "recv_") + direction
+            elif comm_type == CommType.reduce:
+                dst = global_rank(pg_name, group_size, rank)
+                if dst is None:
+                    skipped[comm_type] = skipped.get(comm_type, 0) + 1
+                    continue
+            self.trace_items.append((comm_type, comm_group, group_size, msg_size, dst, additional))
+        for comm_type, count in skipped.items():
+            missing = "pipeline peer" if comm_type in (CommType.isend, CommType.irecv) else "root rank"
+            print(f"WARNING: skip {count} {comm_type.value} op(s) with no {missing} in the trace")
+
+    def __call__(self):
+        # the trace holds one iteration, replay it epoch_num times
+        self.workload = Workload()
+        self.init()
+        self.workload.append(LogItem(comm_type=CommType.epoch_end))
+        for _ in range(self.args.epoch_num):
+            self.step()
+            self.workload.append(LogItem(comm_type=CommType.epoch_end))
+        return self.workload
 
     def step(self):
-        item = LogItem()
-        with open(self.filename) as f:
-            data = json.load(f)
-
-        nodes_list = data["nodes"]
-        for node in nodes_list:
-            if node["name"].startswith("nccl:"):
-                name = node["name"].split(":")[1]
-                comm_type = self.string2comm_type(name)
-                item.comm_type = comm_type
-                # TODO: set group in default dp_group , get group in trace info
-                item.comm_group = CommGroup.dp_group
-                input = node.get("inputs")
-                item.msg_size = input[0][3]
-                item.item_size = input[0][4]
-                self.workload.append(item)
-
-
-# if __name__ == "__main__":
-# a = parse_pytorch_trace_log("llama7b_zero3_rank8.json")
-# json_parse("test_json.json")
-# panda_parse("test_json.json")
+        for comm_type, comm_group, group_size, msg_size, dst, additional in self.trace_items:
+            self.workload.append(
+                LogItem(
+                    comm_type=comm_type,
+                    comm_group=comm_group,
+                    comm_group_size=int(group_size) if group_size else None,
+                    msg_size=int(msg_size),
+                    stage="trace",
+                    dst=dst,
+                    additional=additional or "",
+                )
+            )
+
+
+if __name__ == "__main__":
+    args = get_params()
+    assert args.trace_file, "--trace_file is required"
+    workload_generator = Pytorch_trace_analyer(args, None, args.trace_file)
+    workload = workload_generator()
+    filename = f"{workload_generator.name}_{args.model_name}_sp_{args.enable_sequence_parallel}_iteration_{args.epoch_num}_computationEnable_{args.computation_enable}_{args.world_size}n.csv"
+    workload.dump(filename)
+    # WorkloadApplyer(filename=...) loads the pickle next to the workload csv
+    pkl_filename = os.path.join("results/mocked_workload/", filename.split(".")[0] + "_workload.pkl")
+    with open(pkl_filename, "wb") as f:
+        pickle.dump((workload, args), f)
@@ -0,0 +1,464 @@
+"""
+Copyright (c) 2021, Alibaba Group;
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Per-iteration communication volume computed from the model dimensions.
+
+python -m workload_generator.comm_volume --frame Megatron --world_size 64 \
+  --tensor_model_parallel_size 8 --num_layers 40 --hidden_size 5120 --num_attention_heads 40 \
+  --enable_sequence_parallel --use-distributed-optimizer --global_batch 1024 [--validate]
+
+estimate_comm_volume(args) returns the same {(comm_type, comm_group,
+comm_group_size, msg_size): count} aggregate of one training iteration
+that workload_volume() computes from a generated Workload, without
+building the mocked model or the Workload.
+
+Megatron (TP/SP/PP/EP/DP, distributed optimizer) and ZeRO-1/2 reproduce the
+generators exactly; ZeRO-1/2/3 gradient buckets are packed per transformer
+layer and per micro batch with the repeating bucket states folded. How
+ZeRO-3 splits its parameter all-gathers depends on the generator's
+prefetch heuristics, so only their bytes (every parameter once per forward
+and once per backward) are modelled, not their exact count.
+--validate compares an estimate with the generated workload.
+"""
+
+import math
+import time
+import argparse
+from collections import Counter
+from utils.utils import CommGroup, CommType, divide, get_params
+
+ELEM_SIZE = 2
+# relative error tolerated by validate() where the estimate is not exact
+ZERO3_ALLGATHER_TOLERANCE = 0.2
+
+
+def workload_volume(workload, iteration=1):
+    """{(comm_type, comm_group, comm_group_size, msg_size): count} of one iteration of a Workload.
+
+    The first epoch_end closes the init stage, so iteration 1 is the first training iteration.
+    """
+    volume, epochs = Counter(), 0
+    for item in workload.workload:
+        if item.comm_type == CommType.epoch_end:
+            epochs += 1
+            if epochs > iteration:
+                break
+            continue
+        if epochs != iteration or item.comm_type == CommType.computation or item.comm_group is None:
+            continue
+        volume[(item.comm_type, item.comm_group, item.comm_group_size, item.msg_size)] += 1
+    return volume
+
+
+def group_totals(volume):
+    """{comm_group: (count, bytes)} of a volume."""
+    totals = {}
+    for (_, comm_group, _, msg_size), count in volume.items():
+        n, nbytes = totals.get(comm_group, (0, 0))
+        totals[comm_group] = (n + count, nbytes + count * msg_size)
+    return totals
+
+
+def _scale(counter, n):
+    return Counter({k: v * n for k, v in counter.items()}) if n else Counter()
+
+
+def _repeat(step, state, n):
+    """Apply step(state) -> (state, Counter) n times, folding cycles of repeating states."""
+    total, seen, states, counters = Counter(), {}, [], []
+    for i in range(n):
+        if state in seen:
+            j = seen[state]
+            cycle = Counter()
+            for c in counters[j:]:
+                cycle.update(c)
+            q, r = divmod(n - i, i - j)
+            total.update(_scale(cycle, q))
+            for c in counters[j:j + r]:
+                total.update(c)
+            return states[j + r] if r else state, total
+        seen[state] = i
+        states.append(state)
+        state, counter = step(state)
+        counters.append(counter)
+        total.update(counter)
+    return state, total
+
+
+# Megatron
+
+
+def megatron_num_params(args):
+    """Parameters of MegatronModel(args), i.e. of one tensor/pipeline parallel rank."""
+    tp, h = args.tensor_model_parallel_size, args.hidden_size
+    bias = 1 if args.add_bias_linear else 0
+    vocab_per_partition = divide(args.padded_vocab_size, tp)
+    query_projection_size = (h // args.num_attention_heads) * args.num_attention_heads
+    qkv_per_partition = divide(3 * query_projection_size, tp)
+    dense_per_partition = divide(query_projection_size, tp)
+    layer = h * qkv_per_partition + bias * qkv_per_partition
+    layer += h * dense_per_partition + bias * h
+    # pre_mlp_layernorm weight and bias, post_attention_layernorm_bias
+    layer += 3 * h
+    if args.moe_enable:
+        fc_per_partition = divide(args.ffn_hidden_size * (args.num_experts // args.expert_model_parallel_size), tp)
+        layer += 2 * h * fc_per_partition
+    else:
+        ffn_per_partition = divide(args.ffn_hidden_size, tp)
+        layer += 2 * h * ffn_per_partition + bias * (ffn_per_partition + h)
+    embedding = 4 * vocab_per_partition * h + args.seq_length * h
+    final_norm = h * vocab_per_partition + bias * vocab_per_partition
+    return embedding + args.num_layers * layer + final_norm
+
+
+def _megatron_model_volume(args):
+    """(forward, backward) volume of one micro batch through MegatronModel."""
+    tp, h, s, b = args.tensor_model_parallel_size, args.hidden_size, args.seq_length, args.micro_batch
+    sp = args.enable_sequence_parallel
+    tp_group = CommGroup.tp_group
+    x = 2 * s * b * h
+    embedding, attention_fwd, attention_bwd = Counter(), Counter(), Counter()
+    if tp > 1:
+        embedding[(CommType.all_reduce, tp_group, tp, x)] = 1
+        if sp:
+            attention_fwd[(CommType.all_gather, tp_group, tp, x)] = 1
+            attention_fwd[(CommType.reduce_scatter, tp_group, tp, x)] = 1
+            # column: all_gather + reduce_scatter, row: all_gather
+            attention_bwd[(CommType.all_gather, tp_group, tp, x)] = 2
+            attention_bwd[(CommType.reduce_scatter, tp_group, tp, x)] = 1
+        else:
+            attention_fwd[(CommType.all_reduce, tp_group, tp, x)] = 1
+            attention_bwd[(CommType.all_reduce, tp_group, tp, x)] = 1
+    if args.moe_enable:
+        topk = args.moe_router_topk
+        mlp_fwd = Counter({(CommType.all_gather, tp_group, None, 2 * h * b * s): 1})
+        mlp_fwd[(CommType.all_to_all, CommGroup.ep_group, None, s * h * b // tp * 2)] += 1
+        mlp_fwd[(CommType.all_to_all, CommGroup.ep_group, None, s * h * b * topk // tp * 2)] += 1
+        if tp > 1:
+            mlp_fwd[(CommType.all_to_all, tp_group, tp, s * h * b // tp * 2)] += 1
+            mlp_fwd[(CommType.all_gather, tp_group, None, 2 * h * topk * b * s)] += 1
+            mlp_fwd[(CommType.reduce_scatter, tp_group, None, 2 * h * b * topk * s)] += 1
+            mlp_fwd[(CommType.all_to_all, tp_group, None, 2 * h * s * b // tp)] += 1
+        # MOEMLP.backward emits no comm
+        mlp_bwd = Counter()
+    else:
+        mlp_fwd, mlp_bwd = attention_fwd, attention_bwd
+    layers = args.num_layers
+    forward = _scale(attention_fwd, layers) + _scale(mlp_fwd, layers)
+    forward.update(embedding)
+    backward = _scale(attention_bwd, layers) + _scale(mlp_bwd, layers)
+    backward.update(embedding)
+    return forward, backward
+
+
+def estimate_megatron(args, pp_rank=0):
+    """Volume of one MegatronWorkload iteration on pipeline stage pp_rank."""
+    tp, pp, dp = args.tensor_model_parallel_size, args.pipeline_model_parallel, args.dp_num
+    nmb = args.num_microbatches
+    forward, backward = _megatron_model_volume(args)
+    volume = Counter()
+    broadcasts = Counter({
+        (CommType.broadcast, CommGroup.tp_group, tp, 5 * 8): 1,
+        (CommType.broadcast, CommGroup.tp_group, tp, 8 * (args.world_size + args.seq_length * args.micro_batch)): 1,
+    })
+    if pp > 1:
+        p2p_size = 2 * args.hidden_size * args.seq_length * args.micro_batch
+        warmup = min(pp - pp_rank - 1, nmb)
+        remaining = nmb - warmup
+        first, last = pp_rank == 0, pp_rank == pp - 1
+        recv = (0 if first else warmup + (1 if remaining > 0 else 0) + max(remaining - 1, 0))
+        recv += 0 if last else remaining + warmup
+        send = (0 if last else warmup + remaining) + (0 if first else remaining + warmup)
+        volume.update(_scale(broadcasts, nmb))
+        volume.update(_scale(forward, nmb))
+        volume.update(_scale(backward, nmb))
+        if recv:
+            volume[(CommType.irecv, CommGroup.pp_group, 1, p2p_size)] += recv
+        if send:
+            volume[(CommType.isend, CommGroup.pp_group, 1, p2p_size)] += send
+    else:
+        micro_batch = Counter() if tp <= 1 else Counter(broadcasts)
+        micro_batch.update(forward)
+        micro_batch[(CommType.all_reduce, CommGroup.tp_group, tp, args.micro_batch * args.seq_length * 4)] += 3
+        micro_batch[(CommType.all_reduce, CommGroup.dp_group, dp, 4)] += 1
+        micro_batch.update(backward)
+        volume.update(_scale(micro_batch, nmb))
+    num_params = megatron_num_params(args)
+    if args.use_distributed_optimizer:
+        volume[(CommType.reduce_scatter, CommGroup.dp_group, dp, 4 * num_params // pp)] += 1
+        volume[(CommType.all_gather, CommGroup.dp_group, dp, 2 * num_params // pp)] += 1
+    else:
+        volume[(CommType.all_reduce, CommGroup.dp_group, dp, 4 * num_params // pp)] += 1
+    # no mocked parameter is marked sequence_parallel, the layernorm all-reduce is empty
+    volume[(CommType.all_reduce, CommGroup.tp_group, tp, 0)] += 1
+    volume[(CommType.all_reduce, CommGroup.tp_group, tp, 4)] += 1
+    return volume
+
+
+# DeepSpeed
+
+
+def deepspeed_param_blocks(args):
+    """Parameter sizes of DeepspeedForCausalLM(args) as (embedding, [one decoder layer], head)."""
+    h, f = args.hidden_size, args.ffn_hidden_size
+    attention = h * (args.num_attention_heads * (h // args.num_attention_heads))
+    layer = [h, attention, attention, attention, attention, h, h * f, f * h, h * f]
+    return [args.vocab_size * h], layer, [h, h * args.vocab_size]
+
+
+def _bucket_step(sizes, bucket_size):
+    """Greedy gradient bucketing over sizes; returns step(fill) -> (fill, Counter of emitted fills).
+
+    As in the generators, a parameter that does not fit flushes the bucket
+    first, even an empty one.
+    """
+    def step(fill):
+        emitted = Counter()
+        for size in sizes:
+            if size + fill > bucket_size:
+                emitted[fill] += 1
+                fill = 0
+            fill += size
+        return fill, emitted
+    return step
+
+
+def _backward_buckets(args, bucket_size):
+    """(fill left for step, Counter of bucket fills) over the micro batches of one iteration."""
+    embedding, layer, head = deepspeed_param_blocks(args)
+    head_step = _bucket_step(head[::-1], bucket_size)
+    layer_step = _bucket_step(layer[::-1], bucket_size)
+    embedding_step = _bucket_step(embedding[::-1], bucket_size)
+
+    def backward(fill):
+        fill, emitted = head_step(fill)
+        fill, layers = _repeat(layer_step, fill, args.num_layers)
+        emitted.update(layers)
+        fill, tail = embedding_step(fill)
+        emitted.update(tail)
+        return fill, emitted
+
+    passes = args.num_microbatches if args.pipeline_model_parallel == 1 else 0
+    return _repeat(backward, 0, passes)
+
+
+def _contiguous_reduces(intervals, total, dp):
+    """Reduce ops of a ZeRO-2 contiguous-gradient bucket made of gbuf intervals, as (dst, elements)."""
+    partition = int(math.ceil(total / dp))
+
+    def end_of(r):
+        return min(total, (r + 1) * partition)
+
+    runs = []
+    for lo, hi in intervals:
+        r = 0 if lo == 0 else (lo + partition - 1) // partition - 1
+        segments = []
+        if lo > 0 and end_of(r) == lo:
+            segments.append((r, lo, lo))
+            r += 1
+        start = lo
+        while end_of(r) < hi:
+            segments.append((r, start, end_of(r)))
+            start = end_of(r)
+            r += 1
+        segments.append((r, start, hi))
+        for rank, seg_start, seg_end in segments:
+            if runs and runs[-1][0] == rank:
+                runs[-1][2] = seg_end
+            else:
+                runs.append([rank, seg_start, seg_end])
+    return [(rank, end - start) for rank, start, end in runs]
+
+
+def _contiguous_backward_buckets(args, bucket_size):
+    """Like _backward_buckets for ZeRO-2 with contiguous gradients, whose reduces depend on gbuf positions."""
+    embedding, layer, head = deepspeed_param_blocks(args)
+    sizes = embedding + layer * args.num_layers + head
+    total, dp = sum(sizes), args.dp_num
+    offsets = [0]
+    for size in sizes:
+        offsets.append(offsets[-1] + size)
+    emitted_cache = {}
+
+    def flush(intervals):
+        if intervals not in emitted_cache:
+            emitted = Counter()
+            # the bucket is reduced newest parameter first, i.e. newest interval first in gbuf order
+            for _, elements in _contiguous_reduces(intervals[::-1], total, dp):
+                emitted[elements] += 1
+            emitted_cache[intervals] = emitted
+        return emitted_cache[intervals]
+
+    def backward(intervals):
+        emitted = Counter()
+        fill = sum(hi - lo for lo, hi in intervals)
+        intervals = list(intervals)
+        for i in range(len(sizes) - 1, -1, -1):
+            size = sizes[i]
+            if size + fill > bucket_size:
+                emitted.update(flush(tuple(intervals)))
+                intervals, fill = [], 0
+            lo, hi = offsets[i], offsets[i + 1]
+            # parameters come in decreasing gbuf order, extend the interval they continue
+            if intervals and intervals[-1][0] == hi:
+                intervals[-1] = (lo, intervals[-1][1])
+            else:
+                intervals.append((lo, hi))
+            fill += size
+        return tuple(intervals), emitted
+
+    passes = args.num_microbatches if args.pipeline_model_parallel == 1 else 0
+    intervals, emitted = _repeat(backward, (), passes)
+    return intervals, emitted, flush
+
+
+def _persistent_params(args):
+    """Sizes of the parameters ZeRO-3 keeps persistent, in model order."""
+    embedding, layer, head = deepspeed_param_blocks(args)
+    persistent, total = [], 0
+    for size in embedding + layer * args.num_layers + head:
+        if size + total > args.model_persistence_threshold:
+            continue
+        if size <= args.param_persistence_threshold:
+            persistent.append(size)
+            total += size
+    return persistent
+
+
+def estimate_deepspeed(args):
+    """Volume of one DeepSpeedStage1/2/3 iteration."""
+    dp = args.dp_num
+    dp_group = CommGroup.dp_group
+    volume = Counter()
+    embedding, layer, head = deepspeed_param_blocks(args)
+    num_params = sum(embedding) + sum(layer) * args.num_layers + sum(head)
+    if args.stage in (1, 2):
+        if args.stage == 2 and args.contiguous_gradients:
+            intervals, emitted, flush = _contiguous_backward_buckets(args, args.reduce_bucket_size)
+            emitted.update(flush(intervals))
+            for elements, count in emitted.items():
+                volume[(CommType.reduce, dp_group, dp, elements * ELEM_SIZE)] += count
+        else:
+            fill, emitted = _backward_buckets(args, args.reduce_bucket_size)
+            emitted[fill] += 1
+            for elements, count in emitted.items():
+                volume[(CommType.all_reduce, dp_group, dp, elements * ELEM_SIZE)] += count
+        volume[(CommType.all_reduce, dp_group, dp, 1)] += 1
+        num_shards = max(num_params // args.allgather_bucket_size, 1)
+        shard_size = num_params // num_shards
+        shards = Counter({shard_size: num_shards - 1})
+        shards[num_params - (num_shards - 1) * shard_size] += 1
+        for num_elements, count in shards.items():
+            if count:
+                padded = num_elements + ((dp - num_elements % dp) if num_elements % dp else 0)
+                volume[(CommType.all_gather, dp_group, dp, padded * ELEM_SIZE)] += count
+        return volume
+
+    assert args.stage == 3, f"unknown ZeRO stage {args.stage}"
+    fill, emitted = _backward_buckets(args, args.reduce_bucket_size)
+    for elements, count in emitted.items():
+        volume[(CommType.reduce_scatter, dp_group, dp, elements * ELEM_SIZE)] += count
+    volume[(CommType.reduce_scatter, dp_group, dp, fill * ELEM_SIZE)] += 1
+    volume[(CommType.all_reduce, dp_group, dp, 1)] += 1
+    volume[(CommType.all_reduce, dp_group, dp, 8)] += 1
+    persistent = _persistent_params(args)
+    for size in persistent:
+        volume[(CommType.all_gather, dp_group, dp, size * ELEM_SIZE)] += 1
+    passes = args.num_microbatches if args.pipeline_model_parallel == 1 else 0
+    if passes:
+        # estimated: every parameter is gathered in each forward and backward, tensor by tensor in the
+        # first micro batch (empty prefetch queue) and in prefetch buckets afterwards
+        for size in embedding + layer * args.num_layers + head:
+            volume[(CommType.all_gather, dp_group, dp, size * ELEM_SIZE)] += 2
+        num_buckets = int(math.ceil(num_params / max(args.prefetch_bucket_size, 1)))
+        base, extra = divmod(num_params, num_buckets)
+        if extra:
+            volume[(CommType.all_gather, dp_group, dp, (base + 1) * ELEM_SIZE)] += 2 * extra * (passes - 1)
+        volume[(CommType.all_gather, dp_group, dp, base * ELEM_SIZE)] += 2 * (num_buckets - extra) * (passes - 1)
+    return volume
+
+
+def estimate_comm_volume(args, pp_rank=0):
+    if args.frame == "Megatron":
+        return estimate_megatron(args, pp_rank)
+    if args.frame == "DeepSpeed":
+        return estimate_deepspeed(args)
+    raise ValueError(f"no comm volume estimate for frame {args.frame}")
+
+
+def _is_estimated(args, key):
+    return args.frame == "DeepSpeed" and args.stage == 3 and key[0] == CommType.all_gather
+
+
+def validate(args):
+    """Compare estimate_comm_volume with the generated workload.
+
+    Returns [(comm_type, comm_group, estimated count, estimated bytes, generated
+    count, generated bytes, ok)]; exact parts must match exactly, estimated
+    ones within ZERO3_ALLGATHER_TOLERANCE in bytes.
+    """
+    if args.frame == "Megatron":
+        from workload_generator.mocked_model.MockedMegatron import MegatronModel
+        from workload_generator.generate_megatron_workload import MegatronWorkload
+
+        model = MegatronModel(args)
+        generator = MegatronWorkload(args, model)
+        assert megatron_num_params(args) == sum(p.numel() for p in model.parameters()), "parameter count mismatch"
+    else:
+        from workload_generator.mocked_model.MockedDeepspeed import DeepspeedForCausalLM
+        from workload_generator.generate_deepspeed_stage1_2_workload import DeepSpeedStage1, DeepSpeedStage2
+        from workload_generator.generate_deepspeed_stage3_workload import DeepSpeedStage3
+
+        model = DeepspeedForCausalLM(args)
+        generator = {1: DeepSpeedStage1, 2: DeepSpeedStage2, 3: DeepSpeedStage3}[args.stage](args, model)
+    generated = workload_volume(generator())
+    estimated = estimate_comm_volume(args)
+    rows = []
+    for comm_type, comm_group in sorted({k[:2] for k in list(generated) + list(estimated)}):
+        est = Counter({k: v for k, v in estimated.items() if k[:2] == (comm_type, comm_group)})
+        gen = Counter({k: v for k, v in generated.items() if k[:2] == (comm_type, comm_group)})
+        est_count, est_bytes = sum(est.values()), sum(k[3] * v for k, v in est.items())
+        gen_count, gen_bytes = sum(gen.values()), sum(k[3] * v for k, v in gen.items())
+        if _is_estimated(args, (comm_type,)):
+            ok = abs(est_bytes - gen_bytes) <= ZERO3_ALLGATHER_TOLERANCE * max(gen_bytes, 1)
+        else:
+            ok = est == gen
+        rows.append((comm_type, comm_group, est_count, est_bytes, gen_count, gen_bytes, ok))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate per-iteration comm volume per group", add_help=False)
+    parser.add_argument("--validate", action="store_true", help="Compare with the generated workload")
+    parser.add_argument("--repeat", type=int, default=1000, help="Estimates timed")
+    volume_args, argv = parser.parse_known_args()
+    args = get_params(argv + ["--workload_only"])
+    args.epoch_num = 1
+    start = time.perf_counter()
+    for _ in range(volume_args.repeat):
+        volume = estimate_comm_volume(args)
+    elapsed = (time.perf_counter() - start) / max(volume_args.repeat, 1)
+    for comm_group, (count, nbytes) in sorted(group_totals(volume).items()):
+        print(f"{comm_group.value:<12} count: {count:<10} bytes: {nbytes}")
+    print(f"estimated in {elapsed * 1e6:.1f} us")
+    if volume_args.validate:
+        failed = 0
+        for comm_type, comm_group, est_count, est_bytes, gen_count, gen_bytes, ok in validate(args):
+            failed += not ok
+            print(f"{'ok  ' if ok else 'FAIL'} {comm_type.value:<15} {comm_group.value:<12} "
+                  f"estimated {est_count} / {est_bytes} B, generated {gen_count} / {gen_bytes} B")
+        assert not failed, f"{failed} comm volume(s) differ from the generated workload"
+
+
+if __name__ == "__main__":
+    main()
@@ -11,46 +11,120 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import re
-from utils.utils import CommType, CommGroup, WorkloadWriter, get_params
+"""Replay the communication sequence of a DeepSpeed job from its comm logs.
+
+torchrun --nnodes ... -m workload_generator.generate_ds_trace_replay_workload \
+  --trace_file <log file or directory>[,<log file>...] --world_size 64 --tensor_model_parallel_size 1
+
+The DeepSpeed comm logs (`comm op: ... | msg size: ... | group: [...]`) of
+one rank are parsed in streaming fashion, "microstep" lines become epoch
+markers, and the resulting Workload is dumped to results/mocked_workload
+and, unless --workload_only is set, applied through WorkloadApplyer.
+"""
+
+import os
+import pickle
+from utils.utils import CommType, CommGroup, get_params
+from log_analyzer.log import LogItem, Workload
+from log_analyzer.ds_comm_log_analyzer import parse_ds_comm_log_columns
 
 
 class TraceParser:
-    def __init__(self, input_file):
-        self.input_file = input_file
-        self.comm_workload = []
-
-    def prase_trace(self):
-
-        pattern = r"comm op: (.*?) \|.*?msg size: (.*?) \|.*?algbw \(Gbps\): (.*?) "
-
-        with open(self.input_file, "r") as file:
-            for line in file:
-                match = re.search(pattern, line)
-                if match:
-                    op = match.group(1)
-                    comm_op = CommType.get_comm_type(op)
-                    msg_size = match.group(2)
-                    self.comm_workload.append(
-                        {
-                            "operation": "trace",
-                            "comm_type": comm_op,
-                            "msg_size": msg_size,
-                            "comm_group": CommGroup.dp_group,
-                            "bw": match.group(3),
-                        }
+    def __init__(self, input_files, args, rank=0):
+        if isinstance(input_files, str):
+            input_files = input_files.split(",")
+        self.input_files = input_files
+        self.args = args
+        self.rank = rank
+        self.comm_workload = Workload()
+        self._warned = False
+
+    def _comm_group(self, comm_group):
+        # WorkloadApplyer has no world group; in a DeepSpeed job it is the DP group
+        if comm_group == CommGroup.all:
+            if self.args.dp_num != self.args.world_size and not self._warned:
+                self._warned = True
+                print("WARNING: world-wide comm ops are replayed on dp_group")
+            return CommGroup.dp_group
+        return comm_group
+
+    def parse_trace(self):
+        args = self.args
+        skipped_reduce = 0
+        for input_file in self.input_files:
+            columns = parse_ds_comm_log_columns(
+                input_file,
+                rank=self.rank,
+                world_size=args.world_size,
+                tp_size=args.tensor_model_parallel_size,
+                dp_size=args.dp_num,
+            )
+            # comm ops before the first marker form the init stage, as in generated workloads
+            for i, is_epoch_end in enumerate(columns["is_epoch_end"]):
+                if is_epoch_end:
+                    last = self.comm_workload.workload[-1] if self.comm_workload.workload else None
+                    if last is not None and not last.is_epoch_end():
+                        self.comm_workload.append(LogItem(comm_type=CommType.epoch_end))
+                    continue
+                # the comm log has no root rank, which the applyer needs for reduce
+                if columns["comm_type"][i] == CommType.reduce:
+                    skipped_reduce += 1
+                    continue
+                self.comm_workload.append(
+                    LogItem(
+                        comm_type=columns["comm_type"][i],
+                        comm_group=self._comm_group(columns["comm_group"][i]),
+                        comm_group_size=columns["group_size"][i] or None,
+                        msg_size=int(columns["msg_size"][i] or 0),
+                        stage=columns["stage"][i] or "trace",
                     )
+                )
+        if skipped_reduce:
+            print(f"WARNING: skip {skipped_reduce} reduce op(s) with no root rank in the DeepSpeed log")
+        if self.comm_workload.workload and not self.comm_workload.workload[-1].is_epoch_end():
+            self.comm_workload.append(LogItem(comm_type=CommType.epoch_end))
+        return self.comm_workload
 
     def get_trace_workload(self):
         return self.comm_workload
 
 
+def dump_workload(workload, args, filename):
+    workload.dump(filename)
+    pkl_filename = os.path.join("results/mocked_workload/", filename.split(".")[0] + "_workload.pkl")
+    with open(pkl_filename, "wb") as f:
+        pickle.dump((workload, args), f)
+
+
 if __name__ == "__main__":
     args = get_params()
-    output_file = "model_workload/deepspeed_trace.csv"
-    paser = TraceParser(
-        "llama-7b-ga8-seq2048-bs3_dlcfw77d07c87pho-master-0_2023-07-05 21_48_38.txt"
-    )
-    paser.prase_trace()
-    workload = paser.get_trace_workload()
-    WorkloadWriter().write_workload(workload, args, output_file)
+    assert args.trace_file, "--trace_file is required"
+    # every rank replays the same workload, so every rank parses the trace
+    paser = TraceParser(args.trace_file, args)
+    workload = paser.parse_trace()
+    num_epochs = sum(1 for item in workload.workload if item.is_epoch_end())
+    print(f"parsed {len(workload.workload) - num_epochs} comm ops in {num_epochs} epochs from {args.trace_file}")
+    filename = f"deepspeed_trace_replay_{args.model_name}_{args.world_size}n.csv"
+
+    if args.workload_only:
+        dump_workload(workload, args, filename)
+    else:
+        import torch
+        from workload_applyer import WorkloadApplyer
+        from utils.benchmark_logger import bench_logger
+
+        if not hasattr(args, "backend"):
+            args.backend = "nccl"
+        torch.distributed.init_process_group(backend=args.backend)
+        args.world_size = torch.distributed.get_world_size()
+        args.rank = torch.distributed.get_rank()
+        # only rank 0 writes the workload files, as in aicb.py
+        if args.rank == 0:
+            dump_workload(workload, args, filename)
+        applyer = WorkloadApplyer(workload=workload, args=args)
+        cpu_time = applyer.apply_workload()
+        if torch.distributed.get_rank() == 0:
+            bench_logger.analyze_comm_log()
+            bench_logger.analyze_comm_time()
+            bench_logger.dump_log(filename)
+            print(f"total time for DeepSpeed trace replay is {cpu_time:.4f} s")
@@ -0,0 +1,272 @@
+"""
+Copyright (c) 2021, Alibaba Group;
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Generate the SimAI workloads of a whole benchmark suite in a process pool.
+
+python -m workload_generator.generate_simai_batch --spec workload/Workload_spec_v1.1.csv \
+  --world_sizes 64,128,256 --tp 1,2,4,8 --pp 1,2 --num_workers 16 --global_batch 1024
+
+Every Megatron row of the spec (optionally crossed with the --world_sizes /
+--tp / --pp / --ep grid) becomes one configuration; any other option is
+passed to every configuration as for AIOB_simAI_workload_generator. The
+mocked model only depends on the per-rank shape, so configurations that
+differ only in world size or global batch share one MegatronModel (and
+AIOB compute cache) and are generated by the same worker.
+"""
+
+import os
+import csv
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from utils.utils import get_params
+from workload_generator.mocked_model.MockedMegatron import MegatronModel
+from workload_generator.AIOB_simAI_workload_generator import (
+    get_simai_filename,
+    generate_simai_workload,
+    get_compute_cache,
+)
+
+DEFAULT_SPEC = "workload/Workload_spec_v1.1.csv"
+DEFAULT_REPORT = "results/workload/batch_report.csv"
+MEGATRON_FRAMES = ("megatron", "megetron")
+# spec column -> SimAI generator option
+SPEC_OPTIONS = [
+    ("Hidden_size", "--hidden_size"),
+    ("Num_of_layers", "--num_layers"),
+    ("Attention_heads", "--num_attention_heads"),
+    ("Sequence_length", "--seq_length"),
+    ("FFN_hidden_size", "--ffn_hidden_size"),
+    ("World_size", "--world_size"),
+    ("TP", "--tensor_model_parallel_size"),
+    ("PP", "--pipeline_model_parallel"),
+    ("expert parallel number", "--expert_model_parallel_size"),
+    ("Expert num", "--num_experts"),
+    ("TopK", "--moe_router_topk"),
+]
+GRID_OPTIONS = [
+    ("world_sizes", "--world_size"),
+    ("tp", "--tensor_model_parallel_size"),
+    ("pp", "--pipeline_model_parallel"),
+    ("ep", "--expert_model_parallel_size"),
+]
+# args that do not change the mocked model, configurations differing only in these share it
+SHARED_MODEL_FIELDS = {"world_size", "dp_num", "global_batch", "num_microbatches", "epoch_num"}
+
+
+def _spec_value(value):
+    value = (value or "").strip()
+    return None if value in ("", "-") else value
+
+
+def load_spec_configs(filename=DEFAULT_SPEC):
+    """Configurations of the Megatron rows of a workload spec, as {option: value} dicts."""
+    configs, seen = [], {}
+    with open(filename, newline="") as f:
+        reader = csv.reader(f, delimiter="\t")
+        header = [h.strip() for h in next(reader)]
+        # the spec has two "Name" columns, the model name and the framework
+        frame_index = len(header) - 1 - header[::-1].index("Name")
+        for row in reader:
+            if not any(cell.strip() for cell in row):
+                continue
+            values = dict(zip(header, row))
+            frame = _spec_value(row[frame_index]) or ""
+            model_name = row[header.index("Name")].strip().replace(" ", "_")
+            if frame.lower() not in MEGATRON_FRAMES:
+                print(f"WARNING: skip spec row {values.get('id')} {model_name}, {frame} has no SimAI workload")
+                continue
+            # rows of the same model (e.g. with and without SP) would share the output file
+            if model_name in seen:
+                model_name = f"{model_name}_{values.get('id', len(configs)).strip()}"
+            seen[model_name] = True
+            config = {"--model_name": model_name}
+            for column, option in SPEC_OPTIONS:
+                value = _spec_value(values.get(column))
+                if value is not None:
+                    config[option] = int(float(value))
+            if (_spec_value(values.get("SP")) or "").lower() == "enable":
+                config["--enable_sequence_parallel"] = True
+            if config.get("--num_experts", 1) > 1:
+                config["--moe_enable"] = True
+                config["--enable_sequence_parallel"] = True
+            if (_spec_value(values.get("group_gemm")) or "").lower() == "true":
+                config["--moe_grouped_gemm"] = True
+            configs.append(config)
+    return configs
+
+
+def expand_grid(configs, **grid):
+    """Cross every configuration with the given {grid name: [values]} overrides (ep: MoE configurations only)."""
+    for name, option in GRID_OPTIONS:
+        values = grid.get(name)
+        if not values:
+            continue
+        expanded = []
+        for config in configs:
+            # expert parallelism only applies to MoE models
+            if name == "ep" and not config.get("--moe_enable"):
+                expanded.append(config)
+                continue
+            expanded.extend(dict(config, **{option: value}) for value in values)
+        configs = expanded
+    return configs
+
+
+def config_to_argv(config):
+    argv = []
+    for option, value in config.items():
+        if value is True:
+            argv.append(option)
+        elif value is not None and value is not False:
+            argv.extend([option, str(value)])
+    return argv
+
+
+def model_key(args):
+    return tuple(
+        (k, repr(v)) for k, v in sorted(vars(args).items()) if k not in SHARED_MODEL_FIELDS
+    )
+
+
+def _layout(config, args):
+    """(world_size, tp, pp, ep) of a configuration, from its args once parsed."""
+    if args is not None:
+        return (
+            args.world_size,
+            args.tensor_model_parallel_size,
+            args.pipeline_model_parallel,
+            args.expert_model_parallel_size,
+        )
+    return tuple(config.get(option) for _, option in GRID_OPTIONS)
+
+
+def _generate_group(tasks):
+    """Generate the workloads of configurations sharing one model.
+
+    Returns (index, filepath, seconds, error) per configuration; the model
+    build time is charged to the first one.
+    """
+    results = []
+    model, compute_cache = None, None
+    for index, args in tasks:
+        start = time.perf_counter()
+        try:
+            if model is None:
+                model = MegatronModel(args)
+            if args.aiob_enable and compute_cache is None:
+                args.model_param = sum(p.numel() for p in model.parameters())
+                compute_cache = get_compute_cache(args, verbose=False)
+            filepath = generate_simai_workload(args, model, compute_cache, verbose=False)
+            results.append((index, filepath + ".txt", time.perf_counter() - start, None))
+        except Exception as e:
+            results.append((index, None, time.perf_counter() - start, f"{type(e).__name__}: {e}"))
+    return results
+
+
+def generate_batch(configs, base_argv=(), num_workers=None):
+    """Generate the SimAI workload of every configuration.
+
+    Returns one report row per configuration, in input order:
+    (config index, model_name, world_size, tp, pp, ep, filepath, seconds, error).
+    """
+    parsed, groups, filenames = [], {}, {}
+    for index, config in enumerate(configs):
+        try:
+            args = get_params(list(base_argv) + config_to_argv(config))
+        except (AssertionError, SystemExit) as e:
+            parsed.append((index, config, None, f"invalid configuration: {e}"))
+            continue
+        filename = get_simai_filename(args)
+        if filename in filenames:
+            parsed.append((index, config, None, f"same workload file as config {filenames[filename]}"))
+            continue
+        filenames[filename] = index
+        parsed.append((index, config, args, None))
+        groups.setdefault(model_key(args), []).append((index, args))
+
+    outcomes = {index: (None, 0.0, error) for index, _, args, error in parsed if args is None}
+    # biggest groups first so the pool drains evenly
+    tasks = sorted(groups.values(), key=len, reverse=True)
+    print(f"generating {len(parsed) - len(outcomes)} SimAI workloads with {len(tasks)} distinct models")
+    if num_workers == 1 or len(tasks) <= 1:
+        for task in tasks:
+            for index, filepath, seconds, error in _generate_group(task):
+                outcomes[index] = (filepath, seconds, error)
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(_generate_group, task) for task in tasks]
+            for future in as_completed(futures):
+                for index, filepath, seconds, error in future.result():
+                    outcomes[index] = (filepath, seconds, error)
+
+    report = []
+    for index, config, args, _ in parsed:
+        filepath, seconds, error = outcomes[index]
+        report.append((index, config.get("--model_name")) + _layout(config, args) + (filepath, seconds, error))
+    return report
+
+
+REPORT_HEADER = ["index", "model_name", "world_size", "tp", "pp", "ep", "filepath", "seconds", "error"]
+
+
+def dump_report(report, filename=DEFAULT_REPORT):
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    with open(filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(REPORT_HEADER)
+        for row in report:
+            writer.writerow(row[:7] + (f"{row[7]:.4f}",) + (row[8] or "",))
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate SimAI workloads for a workload spec / parallelism grid in parallel. "
+        "Unrecognized options are passed to every configuration."
+    )
+    parser.add_argument("--spec", default=DEFAULT_SPEC, help="Tab separated workload spec")
+    parser.add_argument("--world_sizes", type=_int_list, default=None, help="Comma separated world sizes")
+    parser.add_argument("--tp", type=_int_list, default=None, help="Comma separated tensor parallel sizes")
+    parser.add_argument("--pp", type=_int_list, default=None, help="Comma separated pipeline parallel sizes")
+    parser.add_argument("--ep", type=_int_list, default=None, help="Comma separated expert parallel sizes")
+    parser.add_argument("--num_workers", type=int, default=None, help="Worker processes, defaults to the CPU count")
+    parser.add_argument("--report", default=DEFAULT_REPORT, help="Per-config timing report")
+    batch_args, base_argv = parser.parse_known_args()
+
+    configs = expand_grid(
+        load_spec_configs(batch_args.spec),
+        world_sizes=batch_args.world_sizes,
+        tp=batch_args.tp,
+        pp=batch_args.pp,
+        ep=batch_args.ep,
+    )
+    start = time.perf_counter()
+    report = generate_batch(configs, base_argv, batch_args.num_workers)
+    elapsed = time.perf_counter() - start
+    dump_report(report, batch_args.report)
+
+    failed = [row for row in report if row[8]]
+    for row in failed:
+        print(f"WARNING: {row[1]} world_size {row[2]} tp {row[3]} pp {row[4]} ep {row[5]}: {row[8]}")
+    generated = [row for row in report if not row[8]]
+    if generated:
+        slowest = max(generated, key=lambda row: row[7])
+        print(f"slowest: {slowest[6]} {slowest[7]:.2f} s")
+    print(
+        f"generated {len(generated)}/{len(report)} SimAI workloads in {elapsed:.2f} s, "
+        f"per-config timing in {batch_args.report}"
+    )
@@ -15,11 +15,19 @@ import torch
 import time
 import warnings
 import torch.nn.functional as F
-from apex.contrib.layer_norm.layer_norm import FastLayerNormFN
 import math
-import scaled_upper_triang_masked_softmax_cuda
+# the fused CUDA kernels are not needed with --aiob_device cpu
+try:
+    from apex.contrib.layer_norm.layer_norm import FastLayerNormFN
+except ImportError:
+    FastLayerNormFN = None
+try:
+    import scaled_upper_triang_masked_softmax_cuda
+except ImportError:
+    scaled_upper_triang_masked_softmax_cuda = None
 from torch.cuda.amp import custom_bwd, custom_fwd
 from utils.utils import *
+from utils.aiob_profile import AIOBRecorder, AIOBSampler
 from core import grouped_gemm_util as gg
 try:
     from einops import rearrange
@@ -42,7 +50,6 @@ except ImportError:
 class MegatronModel(torch.nn.Module):
     def __init__(self, args=None):
         super(MegatronModel, self).__init__()
-        self.time_list = {}
         self.args = args
 
         self.Embedding = MegatronEmbedding(self.args)
@@ -59,84 +66,75 @@ class MegatronModel(torch.nn.Module):
         self.grad_param = Grad_param(self.args)
 
     def forward(self, input):
-        for _ in range(self.args.epoch_num):
+        # layers are identical, so one layer per iteration is measured, for as
+        # many iterations as the sampler needs; ops whose output is not needed
+        # by the next op stop running once they are converged
+        recorder = AIOBRecorder(get_aiob_path(self.args), self.args)
+        sampler = AIOBSampler.from_args(self.args)
+        samples = recorder.samples
+        Emb_output = None
+        for step in range(sampler.warmup + sampler.max_samples):
+            measuring = step >= sampler.warmup
+
+            def record(op, time_gpu):
+                if measuring:
+                    recorder.record(op, time_gpu)
+
+            def pending(op):
+                return not measuring or not sampler.converged(samples.get(op, ()))
+
             # #Embedding
-            Emb_output, Emb_time = self.Embedding(input)
-            self.time_list.setdefault("Emb", []).append({"time_gpu": Emb_time})
-
-            for _ in range(self.args.num_layers):
-                # #layernorm
-                lay_out, layernorm = self.Layernorm(Emb_output)
-                self.time_list.setdefault("layernorm", []).append(
-                    {"time_gpu": layernorm}
-                )
-                if self.args.use_flash_attn:
-                    atten_output, atten_qkv, atten_core, atten_linear = self.Attention(
-                        lay_out
-                    )
-                    self.time_list.setdefault("atten_qkv", []).append(
-                        {"time_gpu": atten_qkv}
-                    )
-                    self.time_list.setdefault("atten_flash", []).append(
-                        {"time_gpu": atten_core}
-                    )
-                    self.time_list.setdefault("atten_linear", []).append(
-                        {"time_gpu": atten_linear}
-                    )
-                else:
-                    (
-                        atten_output,
-                        atten_qkv,
-                        atten_core_qk,
-                        atten_core_softmax,
-                        atten_core_contex,
-                        atten_linear,
-                    ) = self.Attention(lay_out)
-                    self.time_list.setdefault("atten_qkv", []).append(
-                        {"time_gpu": atten_qkv}
-                    )
-                    self.time_list.setdefault("atten_core_qk", []).append(
-                        {"time_gpu": atten_core_qk}
-                    )
-                    self.time_list.setdefault("atten_core_softmax", []).append(
-                        {"time_gpu": atten_core_softmax}
-                    )
-                    self.time_list.setdefault("atten_core_contex", []).append(
-                        {"time_gpu": atten_core_contex}
-                    )
-                    self.time_list.setdefault("atten_linear", []).append(
-                        {"time_gpu": atten_linear}
-                    )
-                # layernorm
-                lay2_out, layernorm2 = self.Layernorm(atten_output)
-
-                # mlp layer
-                mlp_out, mlp_linear_1, mlp_gelu, mlp_linear_2 = self.Mlp(lay2_out)
-                self.time_list.setdefault("layernorm2", []).append(
-                    {"time_gpu": layernorm2}
+            if Emb_output is None or pending("Emb"):
+                Emb_output, Emb_time = self.Embedding(input)
+                record("Emb", Emb_time)
+
+            # #layernorm
+            lay_out, layernorm = self.Layernorm(Emb_output)
+            record("layernorm", layernorm)
+            if self.args.use_flash_attn:
+                atten_output, atten_qkv, atten_core, atten_linear = self.Attention(
+                    lay_out
                 )
-                self.time_list.setdefault("mlp_linear_1", []).append(
-                    {"time_gpu": mlp_linear_1}
-                )
-                self.time_list.setdefault("mlp_gelu", []).append({"time_gpu": mlp_gelu})
-                self.time_list.setdefault("mlp_linear_2", []).append(
-                    {"time_gpu": mlp_linear_2}
-                )
-
-            lay_post__out, layernorm_post = self.Layernorm(mlp_out)
-            self.time_list.setdefault("layernorm_post", []).append(
-                {"time_gpu": layernorm_post}
-            )
-            logit_out, logit_time = self.logit(lay_post__out)
-            self.time_list.setdefault("logit_time", []).append({"time_gpu": logit_time})
-            _, param_time = self.grad_param._apply()
-
-            self.time_list.setdefault("param_time", []).append({"time_gpu": param_time})
-        
-        filepath = write_op(self.time_list, self.args)
-        process_all_keys(filepath)
-        
-        return filepath
+                record("atten_qkv", atten_qkv)
+                record("atten_flash", atten_core)
+                record("atten_linear", atten_linear)
+            else:
+                (
+                    atten_output,
+                    atten_qkv,
+                    atten_core_qk,
+                    atten_core_softmax,
+                    atten_core_contex,
+                    atten_linear,
+                ) = self.Attention(lay_out)
+                record("atten_qkv", atten_qkv)
+                record("atten_core_qk", atten_core_qk)
+                record("atten_core_softmax", atten_core_softmax)
+                record("atten_core_contex", atten_core_contex)
+                record("atten_linear", atten_linear)
+            # layernorm
+            lay2_out, layernorm2 = self.Layernorm(atten_output)
+
+            # mlp layer
+            mlp_out, mlp_linear_1, mlp_gelu, mlp_linear_2 = self.Mlp(lay2_out)
+            record("layernorm2", layernorm2)
+            record("mlp_linear_1", mlp_linear_1)
+            record("mlp_gelu", mlp_gelu)
+            record("mlp_linear_2", mlp_linear_2)
+
+            if pending("layernorm_post") or pending("logit_time"):
+                lay_post__out, layernorm_post = self.Layernorm(mlp_out)
+                record("layernorm_post", layernorm_post)
+                logit_out, logit_time = self.logit(lay_post__out)
+                record("logit_time", logit_time)
+            if pending("param_time"):
+                _, param_time = self.grad_param._apply()
+                record("param_time", param_time)
+
+            if measuring and sampler.done(samples):
+                break
+
+        return recorder.close(train_iter=step + 1 - sampler.warmup)
 
 
 class LinearWithGradAccumulationAndAsyncCommunication(torch.autograd.Function):
@@ -260,7 +258,8 @@ class MegatronEmbedding(torch.nn.Module):
         hidden_size = args.hidden_size
         max_position_embeddings = args.max_position_embeddings
         self.vocab_size = args.padded_vocab_size
-        device = torch.cuda.current_device()
+        device = aiob_device(args)
+        self.device = device
         if args.dtype == "bfloat16":
             self.dtype = torch.bfloat16
         elif args.dtype == "float16":
@@ -320,7 +319,8 @@ class MegatronLayernorm(torch.nn.Module):
         self.tp = args.tensor_model_parallel_size
         self.enable_sequence_parallel = args.enable_sequence_parallel
         hidden_size = args.hidden_size
-        device = torch.cuda.current_device()
+        device = aiob_device(args)
+        self.device = device
         if args.dtype == "bfloat16":
             self.dtype = torch.bfloat16
         elif args.dtype == "float16":
@@ -336,9 +336,14 @@ class MegatronLayernorm(torch.nn.Module):
 
     @cuda_timing_decorator
     def _apply(self, hidden_states):
-        output_lay = FastLayerNormFN.apply(
-            hidden_states, self.lay_weight, self.bias, 1e-05
-        )
+        if self.device.type == "cpu" or FastLayerNormFN is None:
+            output_lay = F.layer_norm(
+                hidden_states, self.lay_weight.shape, self.lay_weight, self.bias, 1e-05
+            )
+        else:
+            output_lay = FastLayerNormFN.apply(
+                hidden_states, self.lay_weight, self.bias, 1e-05
+            )
 
         return output_lay
 
@@ -372,7 +377,8 @@ class MegatronAtten(torch.nn.Module):
             self.input_in_float16 = True
         else:
             dtype = torch.float32
-        device = torch.cuda.current_device()
+        device = aiob_device(args)
+        self.device = device
         # self.atten_total_input_1 = torch.rand(seq_len,
         #                                       micro_batch,
         #                                       hidden_size,
@@ -436,7 +442,8 @@ class MegatronAtten(torch.nn.Module):
         attn_batches = b * np
 
         if (
-            self.input_in_float16  # input must be fp16
+            scaled_upper_triang_masked_softmax_cuda is not None
+            and self.input_in_float16  # input must be fp16
             and 16 < sk <= 16384  # sk must be 16 ~ 16384
             and sq % 4 == 0  # sq must be divisor of 4
             and sk % 4 == 0  # sk must be divisor of 4
@@ -589,7 +596,8 @@ class MegatronFlashAtten(torch.nn.Module):
             dtype = torch.float16
         else:
             dtype = torch.float32
-        device = torch.cuda.current_device()
+        device = aiob_device(args)
+        self.device = device
 
         self.atten_weight_1 = torch.rand(
             divide((3 * hidden_size), self.tp), hidden_size, device=device
@@ -648,6 +656,13 @@ class MegatronFlashAtten(torch.nn.Module):
 
     @cuda_timing_decorator
     def _apply_flash_atten(self, q, k, v):
+        if self.device.type == "cpu":
+            # the same causal attention with the fused attention of torch
+            q, k, v = [
+                rearrange(x, "(b s) h d -> b h s d", b=self.micro_batch) for x in (q, k, v)
+            ]
+            output = F.scaled_dot_product_attention(q, k, v, is_causal=True)
+            return rearrange(output, "b h s d -> b s h d")
 
         output = flash_attn_unpadded_func(
             q,
@@ -725,7 +740,8 @@ class MegatronMlp(torch.nn.Module):
         if args.gated_linear_unit:
             ffn_hidden_size *= 2
         num_attention_heads = args.num_attention_heads
-        device = torch.cuda.current_device()
+        device = aiob_device(args)
+        self.device = device
         if args.dtype == "bfloat16":
             dtype = torch.bfloat16
         elif args.dtype == "float16":
@@ -822,7 +838,8 @@ class logit(torch.nn.Module):
         if args.gated_linear_unit:
             ffn_hidden_size *= 2
         num_attention_heads = args.num_attention_heads
-        device = torch.cuda.current_device()
+        device = aiob_device(args)
+        self.device = device
         if args.dtype == "bfloat16":
             dtype = torch.bfloat16
         elif args.dtype == "float16":
@@ -859,7 +876,8 @@ class Grad_param:
         param = args.model_param
         self.dp = args.dp_num
 
-        device = torch.cuda.current_device()
+        device = aiob_device(args)
+        self.device = device
         dtype = torch.float32
         self.data = torch.rand(param//tp, device=device).to(dtype)
 
@@ -935,11 +953,13 @@ class GroupedMLP(torch.nn.Module):
     def __init__(self, num_local_experts,args=None):
         super(GroupedMLP,self).__init__()
         self.num_local_experts = num_local_experts
-        gg.assert_grouped_gemm_is_available()
         tp = args.tensor_model_parallel_size
         self.hidden_size = args.hidden_size
         self.expert_parallel = args.expert_model_parallel_size > 1
-        device = torch.cuda.current_device()
+        device = aiob_device(args)
+        self.device = device
+        if device.type != "cpu":
+            gg.assert_grouped_gemm_is_available()
         if args.dtype == "bfloat16":
             dtype = torch.bfloat16
         elif args.dtype == "float16":
@@ -1000,14 +1020,19 @@ class GroupedMLP(torch.nn.Module):
         self.weight2 = torch.rand(fc2_input_size_per_partition, 
                                    self.hidden_size ,
                                    device=device).to(dtype)
+    def _gmm(self, hidden_states, w, tokens_per_expert):
+        if self.device.type != "cpu":
+            return gg.ops.gmm(hidden_states, w, tokens_per_expert, trans_b=False)
+        # one matmul per local expert without the grouped GEMM kernel
+        chunks = torch.split(hidden_states, tokens_per_expert.tolist())
+        return torch.cat([torch.matmul(chunk, w[i]) for i, chunk in enumerate(chunks)])
+
     @cuda_timing_decorator 
     def _apply_Linear1(self,permuted_local_hidden_states,tokens_per_expert,w1):
         
         
 
-        fc1_output = gg.ops.gmm(
-            permuted_local_hidden_states, w1, tokens_per_expert, trans_b=False
-        )
+        fc1_output = self._gmm(permuted_local_hidden_states, w1, tokens_per_expert)
         return fc1_output
     
     @cuda_timing_decorator
@@ -1021,7 +1046,7 @@ class GroupedMLP(torch.nn.Module):
     def _apply_Linear2(self,intermediate_parallel,tokens_per_expert,w2):
 
         
-        fc2_output = gg.ops.gmm(intermediate_parallel, w2, tokens_per_expert, trans_b=False)
+        fc2_output = self._gmm(intermediate_parallel, w2, tokens_per_expert)
 
         return fc2_output
     def forward(self, permuted_local_hidden_states, tokens_per_expert):
@@ -1050,15 +1075,17 @@ class MoELayer(torch.nn.Module):
             dtype = torch.float16
         else:
             dtype = torch.float32
-        device = torch.cuda.current_device()
+        device = aiob_device(args)
+        self.device = device
         if args.moe_grouped_gemm:
             self.experts = GroupedMLP(self.num_local_experts, args)
         else:
             self.experts = SequentialMLP(self.num_local_experts, args)
         # print("aa",seq_len*micro_batch*topk*dp/num_experts*self.num_local_experts)
-        self.dispatched_input = torch.rand(int(seq_len*micro_batch*topk*ep/num_experts*self.num_local_experts), hidden_size
-                                  ,device = device).to(dtype)
         temp_val = int(seq_len*micro_batch*topk*ep/num_experts)
+        # as many rows as tokens_per_expert holds, the per-expert split on CPU needs them to match
+        self.dispatched_input = torch.rand(temp_val*self.num_local_experts, hidden_size
+                                  ,device = device).to(dtype)
         # self.tokens_per_expert = torch.tensor([temp,temp],device = device)
                                   
         self.tokens_per_expert = torch.full((self.num_local_experts,), temp_val)
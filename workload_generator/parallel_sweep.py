@@ -0,0 +1,331 @@
+"""
+Copyright (c) 2021, Alibaba Group;
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Sweep the parallel layouts of a Megatron model on a given world size.
+
+python -m workload_generator.parallel_sweep --model_name GPT_13B --world_size 256 \
+  --num_layers 40 --hidden_size 5120 --num_attention_heads 40 --seq_length 2048 \
+  --enable_sequence_parallel --use-distributed-optimizer \
+  --global_batches 1024,2048 --micro_batches 1,2 --memory_budget 80 --top_k 3
+
+Every tp/pp/ep/mbs/gbs combination is checked with get_params, RankGenerator
+and the mocked model's own divisibility checks. Layouts whose estimated
+per-GPU memory exceeds --memory_budget are pruned, the others are ranked by
+their per-iteration communication volume, computed in closed form by
+workload_generator.comm_volume (or, with --alpha_beta, its predicted comm
+time). Workload files are generated for the top-K layouts only. Options not listed here are passed to every layout.
+"""
+
+import os
+import csv
+import math
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from utils.utils import CommGroup, CommType, RankGenerator, get_params
+from workload_generator.mocked_model.MockedMegatron import MegatronModel
+from workload_generator.generate_megatron_workload import MegatronWorkload
+from workload_generator.generate_simai_batch import config_to_argv, model_key
+from workload_generator.comm_volume import estimate_megatron
+
+RANK_ORDER = "tp-cp-ep-dp-pp"
+GB = 1024 ** 3
+# bf16 weight + fp32 main grad; fp32 master weight + two Adam moments
+WEIGHT_GRAD_BYTES = 2 + 4
+OPTIMIZER_BYTES = 12
+ACTIVATION_BYTES = 2
+VOLUME_GROUPS = [
+    CommGroup.tp_group,
+    CommGroup.dp_group,
+    CommGroup.pp_group,
+    CommGroup.ep_group,
+    CommGroup.ep_dp_group,
+    CommGroup.ep_tp_group,
+]
+COLUMNS = [
+    "rank", "tp", "pp", "ep", "dp", "micro_batch", "global_batch", "num_microbatches",
+    "params_per_gpu", "memory_gb", "bubble",
+] + [f"{g.value}_bytes" for g in VOLUME_GROUPS] + ["total_bytes", "comm_time_ms", "status"]
+
+
+def _divisors(n, limit=None):
+    return [d for d in range(1, n + 1) if n % d == 0 and (limit is None or d <= limit)]
+
+
+def _powers_of_two(limit):
+    values, v = [], 1
+    while v <= limit:
+        values.append(v)
+        v *= 2
+    return values
+
+
+def check_layout(args, num_layers):
+    """None if the parsed layout of a num_layers model is valid, else the reason it is not."""
+    tp, pp = args.tensor_model_parallel_size, args.pipeline_model_parallel
+    ep = args.expert_model_parallel_size
+    # get_params divides num_layers by pp in place
+    if args.num_layers * pp != num_layers:
+        return f"num_layers {num_layers} not divisible by pp {pp}"
+    if args.global_batch % (args.dp_num * args.micro_batch):
+        return f"global_batch {args.global_batch} not divisible by dp {args.dp_num} * micro_batch {args.micro_batch}"
+    for name in ("hidden_size", "num_attention_heads", "ffn_hidden_size"):
+        if getattr(args, name) % tp:
+            return f"{name} {getattr(args, name)} not divisible by tp {tp}"
+    try:
+        rank_generator = RankGenerator(
+            tp=tp, ep=ep, dp=args.dp_num, pp=pp, cp=getattr(args, "context_parallel_size", 1), order=RANK_ORDER
+        )
+    except RuntimeError as e:
+        return str(e)
+    if math.prod(rank_generator.ordered_size_w_ep) != rank_generator.world_size:
+        return f"dp {args.dp_num} not divisible by ep {ep}"
+    return None
+
+
+def enumerate_layouts(base_argv, tps=None, pps=None, eps=None, micro_batches=None, global_batches=None):
+    """Parse every candidate layout; returns [(config, args or None, reason)]."""
+    base = get_params(list(base_argv))
+    world_size = base.world_size
+    tps = tps or _powers_of_two(min(8, world_size))
+    pps = pps or _divisors(world_size, base.num_layers)
+    eps = eps or (_divisors(base.num_experts) if base.moe_enable else [1])
+    micro_batches = micro_batches or [base.micro_batch]
+    global_batches = global_batches or [base.global_batch]
+    layouts = []
+    for tp in tps:
+        for pp in pps:
+            for ep in eps:
+                for mbs in micro_batches:
+                    for gbs in global_batches:
+                        config = {
+                            "--tensor_model_parallel_size": tp,
+                            "--pipeline_model_parallel": pp,
+                            "--expert_model_parallel_size": ep,
+                            "--micro_batch": mbs,
+                            "--global_batch": gbs,
+                        }
+                        try:
+                            args = get_params(list(base_argv) + config_to_argv(config) + ["--workload_only"])
+                        except (AssertionError, SystemExit) as e:
+                            layouts.append((config, None, f"invalid: {e}"))
+                            continue
+                        args.epoch_num = 1
+                        reason = check_layout(args, base.num_layers)
+                        layouts.append((config, None if reason else args, reason and f"invalid: {reason}"))
+    return layouts
+
+
+def _all_modules(model):
+    visited, stack, modules = set(), [model], []
+    while stack:
+        module = stack.pop()
+        if id(module) in visited:
+            continue
+        visited.add(id(module))
+        modules.append(module)
+        stack.extend(module.child_modules())
+    return modules
+
+
+def model_stats(model):
+    """(parameters, activation elements per sample) of one pipeline stage of the mocked model."""
+    params = sum(p.numel() for p in model.parameters())
+    activation = sum(m.activation_memory() for m in _all_modules(model) if hasattr(m, "activation_memory"))
+    return params, activation
+
+
+def estimate_memory(args, params, activation):
+    """Estimated bytes per GPU on the first pipeline stage, which holds the most in-flight micro batches."""
+    optimizer = OPTIMIZER_BYTES * params
+    if args.use_distributed_optimizer:
+        optimizer /= args.dp_num
+    in_flight = min(args.pipeline_model_parallel, args.num_microbatches) if args.pipeline_model_parallel > 1 else 1
+    activations = ACTIVATION_BYTES * activation * args.micro_batch * in_flight
+    return WEIGHT_GRAD_BYTES * params + optimizer + activations
+
+
+def moved_volume(volume):
+    """Drop the collectives of single-rank groups (e.g. tp_group with tp 1), they move no data."""
+    return {
+        key: count
+        for key, count in volume.items()
+        if key[2] != 1 or key[0] in (CommType.isend, CommType.irecv)
+    }
+
+
+def _evaluate_group(tasks, memory_budget, alpha_beta_file=None):
+    """Evaluate layouts sharing one mocked model; returns [(index, row dict)]."""
+    alpha_beta = None
+    if alpha_beta_file:
+        from log_analyzer.alpha_beta import AlphaBetaModels
+
+        alpha_beta = AlphaBetaModels.load(alpha_beta_file)
+    model, stats, results = None, None, []
+    for index, args in tasks:
+        row = {
+            "tp": args.tensor_model_parallel_size,
+            "pp": args.pipeline_model_parallel,
+            "ep": args.expert_model_parallel_size,
+            "dp": args.dp_num,
+            "micro_batch": args.micro_batch,
+            "global_batch": args.global_batch,
+            "num_microbatches": args.num_microbatches,
+            "bubble": round((args.pipeline_model_parallel - 1) / (args.num_microbatches + args.pipeline_model_parallel - 1), 4),
+        }
+        try:
+            if model is None:
+                model = MegatronModel(args)
+                stats = model_stats(model)
+            memory = estimate_memory(args, *stats)
+            row.update(params_per_gpu=stats[0], memory_gb=round(memory / GB, 2))
+            if memory > memory_budget * GB:
+                row["status"] = f"pruned: memory > {memory_budget} GB"
+                results.append((index, row))
+                continue
+            volume = moved_volume(estimate_megatron(args))
+        except Exception as e:
+            row["status"] = f"invalid: {type(e).__name__}: {e}"
+            results.append((index, row))
+            continue
+        total = 0
+        for group in VOLUME_GROUPS:
+            row[f"{group.value}_bytes"] = 0
+        for (comm_type, comm_group, group_size, msg_size), count in volume.items():
+            nbytes = count * msg_size
+            row[f"{comm_group.value}_bytes"] = row.get(f"{comm_group.value}_bytes", 0) + nbytes
+            total += nbytes
+        row["total_bytes"] = total
+        if alpha_beta is not None:
+            items = [
+                {"comm_type": t, "comm_group": g, "comm_group_size": s, "msg_size": m, "count": c}
+                for (t, g, s, m), c in volume.items()
+            ]
+            row["comm_time_ms"] = round(alpha_beta.estimate_workload(items)[0], 3)
+        row["status"] = "ok"
+        results.append((index, row))
+    return results
+
+
+def sweep(layouts, memory_budget=80, num_workers=None, alpha_beta_file=None):
+    """Evaluate the valid layouts in a process pool; returns rows ranked best first."""
+    rows, groups = {}, {}
+    for index, (config, args, reason) in enumerate(layouts):
+        if args is None:
+            rows[index] = {
+                "tp": config["--tensor_model_parallel_size"],
+                "pp": config["--pipeline_model_parallel"],
+                "ep": config["--expert_model_parallel_size"],
+                "micro_batch": config["--micro_batch"],
+                "global_batch": config["--global_batch"],
+                "status": reason,
+            }
+            continue
+        groups.setdefault(model_key(args), []).append((index, args))
+    tasks = sorted(groups.values(), key=len, reverse=True)
+    print(f"evaluating {sum(len(t) for t in tasks)} valid layouts ({len(layouts)} candidates, {len(tasks)} distinct models)")
+    if num_workers == 1 or len(tasks) <= 1:
+        for task in tasks:
+            rows.update(_evaluate_group(task, memory_budget, alpha_beta_file))
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(_evaluate_group, task, memory_budget, alpha_beta_file) for task in tasks]
+            for future in as_completed(futures):
+                rows.update(future.result())
+
+    def rank_key(row):
+        ok = row.get("status") == "ok"
+        cost = row.get("comm_time_ms") if alpha_beta_file else row.get("total_bytes")
+        return (not ok, cost if ok else 0, row.get("bubble") or 0, row.get("memory_gb") or 0)
+
+    ranked = sorted(rows.values(), key=rank_key)
+    for i, row in enumerate(ranked):
+        row["rank"] = i + 1 if row.get("status") == "ok" else None
+    return ranked
+
+
+def dump_table(ranked, filename):
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    with open(filename, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(ranked)
+    return filename
+
+
+def generate_top_k(ranked, layouts_args, k, simai=False):
+    """Dump the Megatron workload (and optionally the SimAI workload) of the k best layouts."""
+    filenames = []
+    for row in [r for r in ranked if r.get("status") == "ok"][:k]:
+        args = layouts_args[(row["tp"], row["pp"], row["ep"], row["micro_batch"], row["global_batch"])]
+        model = MegatronModel(args)
+        workload_generator = MegatronWorkload(args, model)
+        workload = workload_generator()
+        layout = f"tp{row['tp']}_pp{row['pp']}_ep{row['ep']}_mbs{row['micro_batch']}_gbs{row['global_batch']}"
+        filename = f"{workload_generator.name}_{args.model_name}_{layout}_sp_{args.enable_sequence_parallel}_iteration_{args.epoch_num}_computationEnable_{args.computation_enable}_{args.world_size}n.csv"
+        workload.dump(filename)
+        filenames.append(filename)
+        if simai:
+            from workload_generator.AIOB_simAI_workload_generator import generate_simai_workload
+
+            filepath = generate_simai_workload(args, model, verbose=False)
+            print(f"workload save in : {filepath}.txt")
+            filenames.append(filepath + ".txt")
+    return filenames
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rank the valid parallel layouts of a model on a world size. "
+        "Unrecognized options (model dimensions, --world_size, ...) are passed to every layout."
+    )
+    parser.add_argument("--tp", type=_int_list, default=None, help="Tensor parallel sizes, defaults to powers of two up to 8")
+    parser.add_argument("--pp", type=_int_list, default=None, help="Pipeline parallel sizes, defaults to the divisors of world_size")
+    parser.add_argument("--ep", type=_int_list, default=None, help="Expert parallel sizes, defaults to the divisors of num_experts")
+    parser.add_argument("--micro_batches", type=_int_list, default=None)
+    parser.add_argument("--global_batches", type=_int_list, default=None)
+    parser.add_argument("--memory_budget", type=float, default=80, help="Per-GPU memory budget in GB")
+    parser.add_argument("--alpha_beta", default=None, help="Rank by comm time predicted from log_analyzer.alpha_beta models")
+    parser.add_argument("--top_k", type=int, default=3, help="Generate workload files for the k best layouts")
+    parser.add_argument("--simai", action="store_true", help="Also generate SimAI workloads for the top-K layouts")
+    parser.add_argument("--num_workers", type=int, default=None)
+    parser.add_argument("--output", default=None, help="Ranked table, defaults to results/sweep/<model>_<world_size>n_sweep.csv")
+    sweep_args, base_argv = parser.parse_known_args()
+
+    start = time.perf_counter()
+    layouts = enumerate_layouts(
+        base_argv, sweep_args.tp, sweep_args.pp, sweep_args.ep, sweep_args.micro_batches, sweep_args.global_batches
+    )
+    ranked = sweep(layouts, sweep_args.memory_budget, sweep_args.num_workers, sweep_args.alpha_beta)
+    base = get_params(list(base_argv))
+    output = sweep_args.output or f"results/sweep/{base.model_name}_{base.world_size}n_sweep.csv"
+    dump_table(ranked, output)
+
+    ok = [row for row in ranked if row.get("status") == "ok"]
+    pruned = sum(1 for row in ranked if str(row.get("status")).startswith("pruned"))
+    print(f"{len(ok)} layouts ranked, {pruned} pruned by memory, {len(ranked) - len(ok) - pruned} invalid "
+          f"in {time.perf_counter() - start:.2f} s, table saved in {output}")
+    shown = ["rank", "tp", "pp", "ep", "dp", "micro_batch", "global_batch", "memory_gb", "bubble", "total_bytes", "comm_time_ms"]
+    for row in ok[:max(sweep_args.top_k, 10)]:
+        print("  ".join(f"{c}={row.get(c)}" for c in shown if row.get(c) is not None))
+    if sweep_args.top_k > 0 and ok:
+        layouts_args = dict(
+            ((args.tensor_model_parallel_size, args.pipeline_model_parallel, args.expert_model_parallel_size,
+              args.micro_batch, args.global_batch), args)
+            for _, args, _ in layouts if args is not None
+        )
+        generate_top_k(ranked, layouts_args, sweep_args.top_k, sweep_args.simai)
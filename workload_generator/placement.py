@@ -0,0 +1,351 @@
+"""
+Copyright (c) 2021, Alibaba Group;
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Rank placement on a cluster topology and the traffic it puts on each link.
+
+python -m workload_generator.placement --world_size 256 --tensor_model_parallel_size 4 \
+  --pipeline_model_parallel 4 --num_layers 32 --hidden_size 4096 --num_attention_heads 32 \
+  --global_batch 512 --gpus_per_node 8 --nodes_per_leaf 4 --policy order:pp-tp-dp-cp
+python -m workload_generator.placement ... --search --random 1000
+python -m workload_generator.placement --workload results/mocked_workload/<workload>.pkl ...
+
+A Topology has nodes of gpus_per_node GPUs sharing nics_per_node NICs
+(one rail per NIC, GPU i uses NIC i * nics / gpus) and leaf switches of
+nodes_per_leaf nodes each, connected by spine uplinks. A placement maps
+every rank of RankGenerator('tp-cp-ep-dp-pp') to a device:
+- linear: rank r on device r, as launchers place them
+- round_robin: consecutive ranks on consecutive nodes
+- order:<order>: devices enumerate the parallel dims in another order,
+  e.g. order:pp-tp-dp-cp keeps pipeline stages within a node
+- random:<seed>: a random permutation
+
+The per-rank volume of one iteration (comm_volume.estimate_comm_volume,
+or the volume of a generated Workload) is replayed on every group of
+every comm group type. Ring collectives run on the group's devices
+sorted by device, so a group spread over k nodes crosses k node
+boundaries; all_to_all sends msg_size / n to every peer; isend goes to
+the next stage. The report holds the intra-node and inter-node bytes of
+every comm group type, the bytes each NIC sends and the bytes each leaf
+sends up to the spine. Everything is vectorized over the groups, so a
+search evaluates thousands of placements in seconds.
+"""
+
+import os
+import time
+import random
+import argparse
+import itertools
+import dataclasses
+from typing import Dict
+import numpy as np
+from utils.utils import CommGroup, CommType, RankGenerator, get_params
+from workload_generator.comm_volume import estimate_comm_volume, workload_volume
+
+RANK_ORDER = "tp-cp-ep-dp-pp"
+# RankGenerator.get_ranks arguments of each comm group
+GROUP_TOKENS = {
+    CommGroup.tp_group: ("tp", False),
+    CommGroup.dp_group: ("dp", False),
+    CommGroup.pp_group: ("pp", False),
+    CommGroup.ep_group: ("ep", True),
+    CommGroup.ep_tp_group: ("tp-ep", True),
+    CommGroup.ep_dp_group: ("dp", True),
+}
+# bytes each rank sends around the ring per byte of msg_size, for a group of n ranks
+RING_FACTOR = {
+    CommType.all_reduce: lambda n: 2 * (n - 1) / n,
+    CommType.all_gather: lambda n: (n - 1) / n,
+    CommType.reduce_scatter: lambda n: (n - 1) / n,
+    CommType.broadcast: lambda n: 1,
+    CommType.reduce: lambda n: 1,
+}
+
+
+@dataclasses.dataclass
+class Topology:
+    num_nodes: int
+    gpus_per_node: int = 8
+    nics_per_node: int = 8
+    nodes_per_leaf: int = 16
+
+    @classmethod
+    def for_world(cls, world_size, **kwargs):
+        gpus_per_node = kwargs.get("gpus_per_node", cls.gpus_per_node)
+        return cls(-(-world_size // gpus_per_node), **kwargs)
+
+    @property
+    def num_nics(self):
+        return self.num_nodes * self.nics_per_node
+
+    @property
+    def num_leaves(self):
+        return -(-self.num_nodes // self.nodes_per_leaf)
+
+    def node(self, device):
+        return device // self.gpus_per_node
+
+    def nic(self, device):
+        local = device % self.gpus_per_node
+        return self.node(device) * self.nics_per_node + local * self.nics_per_node // self.gpus_per_node
+
+    def leaf(self, device):
+        return self.node(device) // self.nodes_per_leaf
+
+
+@dataclasses.dataclass
+class PlacementReport:
+    intra_bytes: Dict[CommGroup, float]
+    inter_bytes: Dict[CommGroup, float]
+    nic_bytes: np.ndarray
+    uplink_bytes: np.ndarray
+
+    @property
+    def total_inter_bytes(self):
+        return sum(self.inter_bytes.values())
+
+    def summary(self):
+        return {
+            "inter_node_bytes": self.total_inter_bytes,
+            "intra_node_bytes": sum(self.intra_bytes.values()),
+            "max_nic_bytes": float(self.nic_bytes.max(initial=0)),
+            "max_uplink_bytes": float(self.uplink_bytes.max(initial=0)),
+        }
+
+
+def group_traffic(volume, group_sizes):
+    """{comm_group: (ring bytes, all_to_all bytes, p2p bytes)} each rank sends per iteration.
+
+    Items without a comm_group_size (MoE items) use the size in group_sizes.
+    """
+    traffic = {}
+    for (comm_type, comm_group, group_size, msg_size), count in volume.items():
+        if comm_group not in group_sizes:
+            continue
+        group_size = group_size or group_sizes[comm_group]
+        ring, a2a, p2p = traffic.get(comm_group, (0, 0, 0))
+        if comm_type in RING_FACTOR and group_size > 1:
+            ring += count * msg_size * RING_FACTOR[comm_type](group_size)
+        elif comm_type == CommType.all_to_all and group_size > 1:
+            a2a += count * msg_size
+        elif comm_type == CommType.isend:
+            p2p += count * msg_size
+        traffic[comm_group] = (ring, a2a, p2p)
+    return traffic
+
+
+def _same_count(keys):
+    """For each element of a (G, S) array, how many elements of its row are equal to it."""
+    groups, size = keys.shape
+    flat = (np.arange(groups)[:, None] * (keys.max(initial=0) + 1) + keys).ravel()
+    _, inverse, counts = np.unique(flat, return_inverse=True, return_counts=True)
+    return counts[inverse].reshape(keys.shape)
+
+
+class PlacementModel:
+    """Link traffic of placements of one parallel layout and comm volume on one topology."""
+
+    def __init__(self, args, volume, topology):
+        self.topology = topology
+        self.generator = RankGenerator(
+            tp=args.tensor_model_parallel_size,
+            ep=args.expert_model_parallel_size,
+            dp=args.dp_num,
+            pp=args.pipeline_model_parallel,
+            cp=args.context_parallel_size,
+            order=RANK_ORDER,
+        )
+        self.world_size = self.generator.world_size
+        assert self.world_size <= topology.num_nodes * topology.gpus_per_node, "more ranks than GPUs"
+        self.groups = {CommGroup.all: np.arange(self.world_size)[None, :]}
+        for comm_group, (token, independent_ep) in GROUP_TOKENS.items():
+            self.groups[comm_group] = np.array(self.generator.get_ranks(token, independent_ep))
+        self.traffic = group_traffic(volume, {group: ranks.shape[1] for group, ranks in self.groups.items()})
+
+    # placements: int arrays of the device of every rank
+
+    def linear(self):
+        return np.arange(self.world_size)
+
+    def round_robin(self):
+        topo = self.topology
+        ranks = np.arange(self.world_size)
+        return (ranks % topo.num_nodes) * topo.gpus_per_node + ranks // topo.num_nodes
+
+    def order(self, order):
+        """Devices enumerate the dims of RankGenerator (without ep) in `order`, first dim fastest."""
+        dims = self.generator.order_wo_ep.split("-")
+        sizes = dict(zip(dims, self.generator.ordered_size_wo_ep))
+        target = order.split("-")
+        assert sorted(target) == sorted(dims), f"order {order} must be a permutation of {'-'.join(dims)}"
+        coords = np.unravel_index(np.arange(self.world_size), [sizes[d] for d in reversed(dims)])
+        coords = dict(zip(reversed(dims), coords))
+        return np.ravel_multi_index([coords[d] for d in reversed(target)], [sizes[d] for d in reversed(target)])
+
+    def random(self, seed):
+        return np.random.default_rng(seed).permutation(self.world_size)
+
+    def policy(self, name):
+        if name == "linear":
+            return self.linear()
+        if name == "round_robin":
+            return self.round_robin()
+        if name.startswith("order:"):
+            return self.order(name[len("order:"):])
+        if name.startswith("random:"):
+            return self.random(int(name[len("random:"):]))
+        raise ValueError(f"unknown placement policy {name}")
+
+    def candidates(self, num_random=0, seed=0):
+        """{policy name: placement} of the fixed policies, every dim order and num_random permutations."""
+        dims = self.generator.order_wo_ep.split("-")
+        names = ["linear", "round_robin"]
+        names += [f"order:{'-'.join(p)}" for p in itertools.permutations(dims)]
+        names += [f"random:{seed + i}" for i in range(num_random)]
+        placements = {}
+        seen = set()
+        for name in names:
+            placement = self.policy(name)
+            key = placement.tobytes()
+            if key not in seen:
+                seen.add(key)
+                placements[name] = placement
+        return placements
+
+    def evaluate(self, placement):
+        topo = self.topology
+        assert len(np.unique(placement)) == self.world_size, "two ranks are placed on the same device"
+        nic_bytes = np.zeros(topo.num_nics)
+        uplink_bytes = np.zeros(topo.num_leaves)
+        intra, inter = {}, {}
+        for comm_group, (ring, a2a, p2p) in self.traffic.items():
+            devices = placement[self.groups[comm_group]]
+            n = devices.shape[1]
+            intra_bytes = inter_bytes = 0.0
+            if n > 1 and ring:
+                # ring over the devices sorted by device, ring bytes on every hop
+                ordered = np.sort(devices, axis=1)
+                node = topo.node(ordered)
+                leaf = topo.leaf(ordered)
+                crossing = node != np.roll(node, -1, axis=1)
+                crossings = crossing.sum()
+                inter_bytes += ring * crossings
+                intra_bytes += ring * (devices.size - crossings)
+                # a node's outgoing hop is spread over the NICs of the group's GPUs on it
+                spread = np.where(crossing.any(axis=1)[:, None], ring / _same_count(node), 0)
+                np.add.at(nic_bytes, topo.nic(ordered).ravel(), spread.ravel())
+                np.add.at(uplink_bytes, leaf[crossing & (leaf != np.roll(leaf, -1, axis=1))], ring)
+            if n > 1 and a2a:
+                node = topo.node(devices)
+                leaf = topo.leaf(devices)
+                off_node = n - _same_count(node)
+                sent = a2a / n * off_node
+                inter_bytes += sent.sum()
+                intra_bytes += (a2a / n * (n - 1) * devices.size) - sent.sum()
+                np.add.at(nic_bytes, topo.nic(devices).ravel(), sent.ravel())
+                np.add.at(uplink_bytes, leaf.ravel(), (a2a / n * (n - _same_count(leaf))).ravel())
+            if n > 1 and p2p:
+                # every stage sends to the next one, the last to the previous one
+                peer = np.concatenate([devices[:, 1:], devices[:, -2:-1]], axis=1)
+                off_node = topo.node(devices) != topo.node(peer)
+                inter_bytes += p2p * off_node.sum()
+                intra_bytes += p2p * (devices.size - off_node.sum())
+                np.add.at(nic_bytes, topo.nic(devices[off_node]), p2p)
+                off_leaf = topo.leaf(devices) != topo.leaf(peer)
+                np.add.at(uplink_bytes, topo.leaf(devices[off_leaf]), p2p)
+            intra[comm_group], inter[comm_group] = intra_bytes, inter_bytes
+        return PlacementReport(intra, inter, nic_bytes, uplink_bytes)
+
+    def search(self, placements):
+        """[(name, report)] of placements from the least loaded NIC, then the fewest inter-node bytes."""
+        reports = [(name, self.evaluate(placement)) for name, placement in placements.items()]
+        return sorted(reports, key=lambda r: (r[1].nic_bytes.max(initial=0), r[1].total_inter_bytes))
+
+
+def _gb(nbytes):
+    return round(nbytes / 1024 ** 3, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Place ranks on a topology and account the traffic per link. "
+        "Unrecognized options describe the model, as for the workload generators."
+    )
+    parser.add_argument("--workload", type=str, default=None,
+                        help="Workload pickle to account instead of the estimated comm volume")
+    parser.add_argument("--gpus_per_node", type=int, default=8)
+    parser.add_argument("--nics_per_node", type=int, default=8)
+    parser.add_argument("--nodes_per_leaf", type=int, default=16)
+    parser.add_argument("--policy", type=str, default="linear",
+                        help="linear, round_robin, order:<dims>, random:<seed>")
+    parser.add_argument("--search", action="store_true", help="Rank every dim order and the random placements")
+    parser.add_argument("--random", type=int, default=0, help="Random placements added to the search")
+    parser.add_argument("--top_k", type=int, default=10)
+    parser.add_argument("--result_dir", type=str, default="results/placement")
+    placement_args, rest = parser.parse_known_args()
+
+    if placement_args.workload:
+        from log_analyzer.log import Workload
+
+        workload, args = Workload.load(placement_args.workload)
+        volume = workload_volume(workload)
+    else:
+        args = get_params(rest + ["--workload_only"])
+        volume = estimate_comm_volume(args)
+    topology = Topology.for_world(
+        args.world_size,
+        gpus_per_node=placement_args.gpus_per_node,
+        nics_per_node=placement_args.nics_per_node,
+        nodes_per_leaf=placement_args.nodes_per_leaf,
+    )
+    model = PlacementModel(args, volume, topology)
+    from log_analyzer.results_index import print_table
+
+    os.makedirs(placement_args.result_dir, exist_ok=True)
+    if placement_args.search:
+        placements = model.candidates(placement_args.random)
+        start = time.perf_counter()
+        ranked = model.search(placements)
+        elapsed = time.perf_counter() - start
+        columns = ["policy", "inter_node_GB", "intra_node_GB", "max_nic_GB", "max_uplink_GB"]
+        rows = [
+            [name] + [_gb(v) for v in report.summary().values()]
+            for name, report in ranked
+        ]
+        print_table(columns, rows[:placement_args.top_k])
+        print(f"{len(placements)} placements evaluated in {elapsed:.2f} s")
+        filepath = os.path.join(placement_args.result_dir, f"search_world_size{args.world_size}.csv")
+        with open(filepath, "w") as f:
+            f.write(",".join(columns) + "\n")
+            for row in rows:
+                f.write(",".join(str(v) for v in row) + "\n")
+        print(f"search save in : {filepath}")
+        return
+
+    report = model.evaluate(model.policy(placement_args.policy))
+    rows = [
+        [group.value, _gb(report.intra_bytes[group]), _gb(report.inter_bytes[group])]
+        for group in report.intra_bytes
+    ]
+    print_table(["comm_group", "intra_node_GB", "inter_node_GB"], rows)
+    for name, value in report.summary().items():
+        print(f"{name}: {_gb(value)} GB")
+    filepath = os.path.join(placement_args.result_dir, f"nic_bytes_world_size{args.world_size}.csv")
+    with open(filepath, "w") as f:
+        f.write("node,nic,bytes\n")
+        for nic, nbytes in enumerate(report.nic_bytes):
+            f.write(f"{nic // topology.nics_per_node},{nic % topology.nics_per_node},{int(nbytes)}\n")
+    print(f"per NIC bytes save in : {filepath}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Copyright (c) 2021, Alibaba Group;
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Analytic (roofline) estimate of the op times AIOB measures, for hosts without a GPU.
+
+python -m workload_generator.roofline --gpu_type H100 --hidden_size 4096 --num_attention_heads 32 --world_size 8 \
+  --tensor_model_parallel_size 4 --seq_length 4096 --use_flash_attn --swiglu
+python -m workload_generator.roofline --gpu_type A100 ... --compare results/aiob_outputs/<profile>.txt
+
+Every op of AiobMegatron is described by the FLOPs and HBM bytes of its
+kernels on one tensor parallel rank, with the shapes the mocked kernels
+use. Its time is the larger of the compute time at the GPU's peak FLOPS of
+the dtype and the memory time at its HBM bandwidth, each derated by an
+efficiency curve that saturates with the size of the kernel, plus the
+kernel launch overhead. Times are in us like AIOB outputs, so the result
+is a ComputeProfile equivalent to extract_averages of a measured profile.
+"""
+
+import argparse
+from utils.utils import get_params, parse_aiob_times
+from utils.aiob_profile import ComputeProfile
+
+DEFAULT_GPU = "A100"
+DTYPE_BYTES = {"bfloat16": 2, "float16": 2, "float32": 4}
+# dense peak TFLOPS per dtype, HBM bandwidth in GB/s and the best efficiency reached by large kernels
+GPU_SPECS = {
+    "A100": {"bfloat16": 312, "float16": 312, "float32": 19.5, "hbm_gbps": 2039,
+             "gemm_eff": 0.75, "attn_eff": 0.55, "mem_eff": 0.8},
+    "A800": {"bfloat16": 312, "float16": 312, "float32": 19.5, "hbm_gbps": 2039,
+             "gemm_eff": 0.75, "attn_eff": 0.55, "mem_eff": 0.8},
+    "H100": {"bfloat16": 989, "float16": 989, "float32": 67, "hbm_gbps": 3350,
+             "gemm_eff": 0.7, "attn_eff": 0.45, "mem_eff": 0.8},
+    "H800": {"bfloat16": 989, "float16": 989, "float32": 67, "hbm_gbps": 3350,
+             "gemm_eff": 0.7, "attn_eff": 0.45, "mem_eff": 0.8},
+    "H20": {"bfloat16": 148, "float16": 148, "float32": 44, "hbm_gbps": 4000,
+            "gemm_eff": 0.8, "attn_eff": 0.6, "mem_eff": 0.8},
+    "L20": {"bfloat16": 119.5, "float16": 119.5, "float32": 59.8, "hbm_gbps": 864,
+            "gemm_eff": 0.75, "attn_eff": 0.55, "mem_eff": 0.8},
+}
+# a kernel reaches half of its best efficiency when it runs this long at peak,
+# smaller kernels cannot fill the GPU
+COMPUTE_KNEE_US = 20
+MEMORY_KNEE_US = 5
+LAUNCH_US = 5
+
+
+def _efficiency(best, ideal_us, knee_us):
+    return best * ideal_us / (ideal_us + knee_us)
+
+
+def kernel_time(flops, nbytes, spec, dtype, kind="gemm", kernels=1):
+    """Roofline time in us of `kernels` launches moving nbytes and doing flops in total."""
+    times = [kernels * LAUNCH_US]
+    if flops:
+        ideal = flops / (spec[dtype] * 1e6)
+        times.append(ideal / _efficiency(spec[f"{kind}_eff"], ideal / kernels, COMPUTE_KNEE_US))
+    if nbytes:
+        ideal = nbytes / (spec["hbm_gbps"] * 1e3)
+        times.append(ideal / _efficiency(spec["mem_eff"], ideal / kernels, MEMORY_KNEE_US))
+    return max(times[1:], default=0) + times[0]
+
+
+def _num_params(args):
+    num_params = getattr(args, "model_param", None)
+    if num_params is None:
+        from workload_generator.comm_volume import megatron_num_params
+
+        num_params = megatron_num_params(args)
+    return num_params
+
+
+def op_costs(args):
+    """{op: (flops, bytes, kind, kernels)} of the AiobMegatron ops on one tensor parallel rank."""
+    size = DTYPE_BYTES[args.dtype]
+    tp = args.tensor_model_parallel_size
+    b, s, h = args.micro_batch, args.seq_length, args.hidden_size
+    tokens = b * s
+    ln_tokens = tokens // tp if args.enable_sequence_parallel else tokens
+
+    def gemm(m, k, n, kernels=1):
+        return (2 * m * k * n, (m * k + k * n + m * n) * size, "gemm", kernels)
+
+    # int64 word embedding gather + fp32 position embedding, their sum and the transpose
+    costs = {"Emb": (0, tokens * h * 48, "mem", 4)}
+    costs["layernorm"] = costs["layernorm2"] = costs["layernorm_post"] = (0, 2 * ln_tokens * h * size, "mem", 1)
+    costs["atten_qkv"] = gemm(tokens, h, 3 * h // tp)
+    if args.use_flash_attn:
+        # causal flash attention skips the upper half of QK^T and PV
+        costs["atten_flash"] = (2 * b * s * s * h // tp, 4 * tokens * h // tp * size, "attn", 1)
+    else:
+        scores = b * s * s * args.num_attention_heads // tp
+        costs["atten_core_qk"] = (2 * b * s * s * h // tp, (2 * tokens * h // tp + scores) * size, "gemm", 1)
+        costs["atten_core_softmax"] = (0, 2 * scores * size, "mem", 1)
+        costs["atten_core_contex"] = (2 * b * s * s * h // tp, (2 * tokens * h // tp + scores) * size, "gemm", 1)
+    costs["atten_linear"] = gemm(tokens, h // tp, h)
+
+    ffn = args.ffn_hidden_size
+    fc1 = 2 * ffn if args.gated_linear_unit else ffn
+    kernels = 1
+    if args.moe_enable:
+        # each rank runs the experts of its topk * tokens routed tokens
+        tokens *= args.moe_router_topk
+        if not args.moe_grouped_gemm:
+            kernels = args.num_experts // args.expert_model_parallel_size
+    costs["mlp_linear_1"] = gemm(tokens, h, fc1 // tp, kernels)
+    costs["mlp_gelu"] = (0, tokens * (fc1 + ffn) // tp * size, "mem", kernels)
+    costs["mlp_linear_2"] = gemm(tokens, ffn // tp, h, kernels)
+    costs["logit_time"] = gemm(b * s, h, args.padded_vocab_size // tp)
+    # Grad_param scales the fp32 gradient buffer of the rank in place
+    costs["param_time"] = (0, 8 * (_num_params(args) // tp), "mem", 1)
+    return costs
+
+
+def gpu_spec(args):
+    gpu_type = args.gpu_type or DEFAULT_GPU
+    if not args.gpu_type:
+        print(f"WARNING: no --gpu_type, the analytic compute model assumes {DEFAULT_GPU}")
+    assert gpu_type in GPU_SPECS, f"no spec for GPU {gpu_type}, known GPUs: {', '.join(GPU_SPECS)}"
+    return GPU_SPECS[gpu_type]
+
+
+def estimate_times(args, spec=None):
+    """{op: {time field: us}} estimated for args, in the format of parse_aiob_times."""
+    spec = spec or gpu_spec(args)
+    times = {}
+    for op, (flops, nbytes, kind, kernels) in op_costs(args).items():
+        t = kernel_time(flops, nbytes, spec, "float32" if op == "param_time" else args.dtype, kind, kernels)
+        times[op] = {"time_gpu_max": t, "time_gpu_min": t, "time_gpu_avg": t}
+    return times
+
+
+def analytic_compute_cache(args, spec=None):
+    """ComputeProfile of args estimated without a GPU."""
+    return ComputeProfile.from_times(estimate_times(args, spec), args)
+
+
+def cuda_available():
+    try:
+        import torch
+    except ImportError:
+        return False
+    return torch.cuda.is_available()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Estimate AIOB compute times from a GPU spec. "
+        "Unrecognized options describe the model, as for the workload generators."
+    )
+    parser.add_argument("--compare", type=str, default=None, help="AIOB output file to compare the estimate with")
+    roofline_args, rest = parser.parse_known_args()
+    args = get_params(rest)
+
+    times = estimate_times(args)
+    measured = parse_aiob_times(roofline_args.compare) if roofline_args.compare else {}
+    for op, values in times.items():
+        line = f"{op:<20}{values['time_gpu_avg']:>12.1f} us"
+        if op in measured and measured[op].get("time_gpu_avg"):
+            line += f"  measured {measured[op]['time_gpu_avg']:>10.1f} us  ratio {values['time_gpu_avg'] / measured[op]['time_gpu_avg']:.2f}"
+        print(line)
+    print("compute_cache = {")
+    for key, value in ComputeProfile.from_times(times, args).items():
+        print(f"    '{key}' : {value},")
+    print("}")
+
+
+if __name__ == "__main__":
+    main()
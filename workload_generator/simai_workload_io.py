@@ -0,0 +1,403 @@
+"""
+Copyright (c) 2021, Alibaba Group;
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Read, validate and convert SimAI workload files.
+
+python -m workload_generator.simai_workload_io <SimAI .txt> [--validate_only] [--roundtrip]
+python -m workload_generator.simai_workload_io <AICB _workload.pkl> --to_simai <SimAI .txt>
+torchrun ... -m workload_generator.simai_workload_io <SimAI .txt>
+
+A SimAI file is a header line ("HYBRID_TRANSFORMER_FWD_IN_BCKWD key: value
+..." or "MICRO"), the row count and one tab separated row per layer. Like
+SimAI, the converter runs the forward pass over the rows and the backward
+pass (input grad, weight grad, update) over them in reverse; forward and
+input grad comms run on the tp group, weight grad comms on the dp group,
+and the _EP / _DP_EP suffixes select the ep / ep_dp groups. Compute times
+become computation items replayed as sleeps (--aiob_enable), and every
+item keeps "<phase>.<row name>" as stage so the Workload converts back to
+the same rows. Sizes of NONE comms move no data and are written back as 0.
+"""
+
+import os
+import copy
+import pickle
+import argparse
+from utils.utils import CommType, CommGroup, get_params
+from log_analyzer.log import LogItem, Workload
+from workload_generator.AIOB_simAI_workload_generator import Work_Item, WORK_ITEM_FIELDS, write_work_items
+
+HYBRID = "HYBRID_TRANSFORMER_FWD_IN_BCKWD"
+MICRO = "MICRO"
+SIMAI_KINDS = {
+    HYBRID, MICRO, "DATA", "MODEL", "HYBRID_DATA_MODEL", "HYBRID_MODEL_DATA",
+    "HYBRID_CUSTOMIZED", "HYBRID_TRANSFORMER", "HYBRID_DLRM", "HYBRID_DLRM_ENHANCED",
+}
+# header key aliases, simAI_MicroTest used expert_parallel_npu_group for ep
+HEADER_ALIASES = {"expert_parallel_npu_group": "ep"}
+SIMAI_COMMS = {
+    "ALLREDUCE": CommType.all_reduce,
+    "ALLGATHER": CommType.all_gather,
+    "REDUCESCATTER": CommType.reduce_scatter,
+    "ALLTOALL": CommType.all_to_all,
+    "BROADCAST": CommType.broadcast,
+}
+SIMAI_COMM_NAMES = {comm_type: name for name, comm_type in SIMAI_COMMS.items()}
+SIMAI_GROUP_SUFFIXES = {"_DP_EP": CommGroup.ep_dp_group, "_EP": CommGroup.ep_group}
+NUMBER_FIELDS = [i for i, field in enumerate(WORK_ITEM_FIELDS) if field != "name" and not field.endswith("_comm")]
+COMM_FIELDS = [i for i, field in enumerate(WORK_ITEM_FIELDS) if field.endswith("_comm")]
+# SimAI columns of each phase: (compute time, comm, comm size, default comm group)
+PHASE_COLUMNS = {
+    "forward": ("forward_compute_time", "forward_comm", "forward_comm_size", CommGroup.tp_group),
+    "backward": ("backward_compute_time", "backward_comm", "backward_comm_size", CommGroup.tp_group),
+    "weight_grad": ("dp_compute_time", "dp_comm", "dp_comm_size", CommGroup.dp_group),
+    "update": ("process_time", None, None, None),
+}
+# computation items have no GEMM shape, they are replayed as a sleep of _elapsed_time
+NO_SHAPE = ((0,), (0,))
+
+
+def _number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+class SimAIWorkload:
+    def __init__(self, header, rows, filename=None):
+        self.header = header
+        self.rows = rows
+        self.filename = filename
+        tokens = header.split()
+        self.kind = tokens[0] if tokens else ""
+        self.fields = {}
+        for key, value in zip(tokens[1::2], tokens[2::2]):
+            key = key.rstrip(":")
+            self.fields[HEADER_ALIASES.get(key, key)] = _number(value)
+
+    def group_sizes(self):
+        """{CommGroup: size} implied by the header, empty for MICRO workloads.
+
+        pp defaults to 1; without all_gpus the dp and ep_dp sizes are left out.
+        """
+        fields = self.fields
+        if not fields:
+            return {}
+        tp = fields.get("model_parallel_NPU_group", 1)
+        ep = fields.get("ep", 1)
+        sizes = {CommGroup.tp_group: tp, CommGroup.ep_group: ep}
+        # historical headers have no all_gpus, their dp size is unknown
+        if "all_gpus" in fields:
+            dp = fields["all_gpus"] // (tp * fields.get("pp", 1))
+            sizes[CommGroup.dp_group] = dp
+            sizes[CommGroup.ep_dp_group] = max(dp // ep, 1)
+        return sizes
+
+
+def read_simai_workload(filename):
+    """Parse a SimAI workload file, raises ValueError on malformed lines."""
+    with open(filename) as f:
+        lines = f.read().split("\n")
+    if len(lines) < 2:
+        raise ValueError(f"{filename}: missing header or row count")
+    header, count = lines[0].rstrip(), lines[1].strip()
+    rows = []
+    num_fields = len(WORK_ITEM_FIELDS)
+    # sizes and compute times repeat across layers and micro batches, convert each string once
+    numbers = {}
+    for lineno, line in enumerate(lines[2:], start=3):
+        # SimAI reads the fields with operator>>, padding around them is valid
+        values = [value.strip() for value in line.split("\t")]
+        if len(values) != num_fields:
+            if not line.strip():
+                continue
+            raise ValueError(f"{filename}:{lineno}: expected {num_fields} fields, got {len(values)}")
+        for i in NUMBER_FIELDS:
+            value = values[i]
+            number = numbers.get(value)
+            if number is None:
+                try:
+                    number = numbers[value] = _number(value)
+                except ValueError:
+                    raise ValueError(f"{filename}:{lineno}: non numeric {WORK_ITEM_FIELDS[i]} {value!r}")
+            values[i] = number
+        rows.append(Work_Item(*values))
+    simai = SimAIWorkload(header, rows, filename)
+    try:
+        simai.count = int(count)
+    except ValueError:
+        raise ValueError(f"{filename}:2: row count {count!r} is not an integer")
+    return simai
+
+
+def _parse_comm(comm):
+    """(CommType, CommGroup or None for the column default) of a SimAI comm, None for NONE."""
+    if comm == "NONE":
+        return None
+    for suffix, comm_group in SIMAI_GROUP_SUFFIXES.items():
+        if comm.endswith(suffix) and comm[: -len(suffix)] in SIMAI_COMMS:
+            return SIMAI_COMMS[comm[: -len(suffix)]], comm_group
+    if comm in SIMAI_COMMS:
+        return SIMAI_COMMS[comm], None
+    raise ValueError(f"unknown SimAI comm {comm!r}")
+
+
+def validate_simai_workload(simai):
+    """Consistency problems of a parsed SimAI workload, as messages; empty when valid."""
+    errors = []
+    if simai.kind not in SIMAI_KINDS:
+        errors.append(f"unknown workload type {simai.kind!r}")
+    if getattr(simai, "count", len(simai.rows)) != len(simai.rows):
+        errors.append(f"header announces {simai.count} rows, file has {len(simai.rows)}")
+    fields = simai.fields
+    if simai.kind == HYBRID:
+        num_errors = len(errors)
+        # pp (default 1) and all_gpus (unknown) are missing from historical headers
+        if "model_parallel_NPU_group" not in fields:
+            errors.append("header has no model_parallel_NPU_group")
+        for key in ("model_parallel_NPU_group", "ep", "pp", "vpp", "ga", "all_gpus"):
+            if key in fields and (not isinstance(fields[key], int) or fields[key] < 1):
+                errors.append(f"header {key}: {fields[key]} is not a positive integer")
+        sizes = simai.group_sizes() if len(errors) == num_errors else {}
+        tp, pp, ep = fields.get("model_parallel_NPU_group", 1), fields.get("pp", 1), fields.get("ep", 1)
+        known_dp = CommGroup.dp_group in sizes
+        if known_dp and fields["all_gpus"] % (tp * pp):
+            errors.append(f"all_gpus {fields['all_gpus']} is not divisible by tp {tp} * pp {pp}")
+        elif known_dp and sizes[CommGroup.dp_group] % ep:
+            errors.append(f"dp {sizes[CommGroup.dp_group]} is not divisible by ep {ep}")
+        if (fields.get("pp_comm", 0) > 0) != (pp > 1):
+            errors.append(f"pp_comm {fields.get('pp_comm')} does not match pp {pp}")
+    elif simai.kind == MICRO and simai.fields:
+        errors.append("MICRO header has fields")
+
+    names = {}
+    for i, row in enumerate(simai.rows):
+        for field in WORK_ITEM_FIELDS:
+            value = getattr(row, field)
+            if field.endswith("_comm"):
+                try:
+                    parsed = _parse_comm(value)
+                except ValueError as e:
+                    errors.append(f"row {i} {row.name}: {e}")
+                    continue
+                if parsed and parsed[1] in (CommGroup.ep_group, CommGroup.ep_dp_group) and fields.get("ep", 1) == 1 \
+                        and simai.kind == HYBRID and getattr(row, field + "_size"):
+                    errors.append(f"row {i} {row.name}: {value} with ep 1")
+            elif field != "name" and field != "placeholder" and value < 0:
+                errors.append(f"row {i} {row.name}: negative {field} {value}")
+        names[row.name] = names.get(row.name, 0) + 1
+    # generated workloads repeat embedding_layer once per micro batch and the attention rows once per layer
+    ga, vpp = fields.get("ga"), fields.get("vpp")
+    micro_batches = names.get("embedding_layer", 0)
+    if simai.kind == HYBRID and micro_batches:
+        if ga is not None and micro_batches != ga:
+            errors.append(f"ga {ga} but {micro_batches} embedding_layer rows")
+        layers = names.get("attention_column", 0) or names.get("attention_layer", 0)
+        if vpp is not None and layers and layers != vpp * micro_batches:
+            errors.append(f"vpp {vpp} but {layers} attention rows for {micro_batches} micro batches")
+    return errors
+
+
+def simai_to_workload(simai, iterations=1):
+    """AICB Workload replaying `iterations` iterations of a SimAI workload."""
+    group_sizes = simai.group_sizes()
+    iteration = []
+
+    def add_phase(phase, row):
+        time_field, comm_field, size_field, default_group = PHASE_COLUMNS[phase]
+        stage = f"{phase}.{row.name}"
+        iteration.append(
+            LogItem(comm_type=CommType.computation, msg_size=NO_SHAPE, stage=stage, _elapsed_time=getattr(row, time_field))
+        )
+        parsed = _parse_comm(getattr(row, comm_field)) if comm_field else None
+        if parsed is not None:
+            comm_type, comm_group = parsed
+            comm_group = comm_group or default_group
+            iteration.append(
+                LogItem(
+                    comm_type=comm_type,
+                    comm_group=comm_group,
+                    comm_group_size=group_sizes.get(comm_group),
+                    msg_size=getattr(row, size_field),
+                    stage=stage,
+                )
+            )
+
+    for row in simai.rows:
+        add_phase("forward", row)
+    for row in reversed(simai.rows):
+        for phase in ("backward", "weight_grad", "update"):
+            add_phase(phase, row)
+
+    workload = Workload()
+    for _ in range(iterations):
+        workload.workload.extend(copy.copy(item) for item in iteration)
+        workload.append(LogItem(comm_type=CommType.epoch_end))
+    return workload
+
+
+def _simai_comm(item, default_group):
+    name = SIMAI_COMM_NAMES.get(item.comm_type)
+    assert name is not None, f"{item.comm_type} has no SimAI equivalent"
+    if item.comm_group == default_group:
+        return name
+    for suffix, comm_group in SIMAI_GROUP_SUFFIXES.items():
+        if item.comm_group == comm_group:
+            return name + suffix
+    raise AssertionError(f"{item.comm_type} on {item.comm_group} has no SimAI equivalent in {default_group} columns")
+
+
+def workload_to_simai(workload, header):
+    """SimAI rows of the first iteration of a Workload built by simai_to_workload."""
+    rows, pending = [], []
+    backward_index = None
+    row = None
+    for item in workload.workload:
+        if item.comm_type == CommType.epoch_end:
+            break
+        phase, _, name = item.stage.partition(".")
+        assert phase in PHASE_COLUMNS, f"stage {item.stage!r} is not a SimAI phase"
+        time_field, comm_field, size_field, default_group = PHASE_COLUMNS[phase]
+        if item.comm_type == CommType.computation:
+            if phase == "forward":
+                row = Work_Item(name=name, forward_comm_size=0, process_time=0)
+                rows.append(row)
+            elif phase == "backward":
+                # the backward pass walks the rows in reverse
+                backward_index = len(rows) - 1 if backward_index is None else backward_index - 1
+                assert backward_index >= 0, "more backward rows than forward rows"
+                row = rows[backward_index]
+            assert row is not None and row.name == name, f"{item.stage} out of SimAI row order"
+            setattr(row, time_field, item._elapsed_time)
+        else:
+            assert row is not None and row.name == name and comm_field, f"{item.stage} out of SimAI row order"
+            setattr(row, comm_field, _simai_comm(item, default_group))
+            setattr(row, size_field, item.msg_size)
+    return SimAIWorkload(header, rows)
+
+
+def write_simai_workload(simai, filename):
+    folder_path = os.path.dirname(filename)
+    if folder_path and not os.path.exists(folder_path):
+        os.makedirs(folder_path, exist_ok=True)
+    write_work_items(filename, simai.header, simai.rows)
+    return filename
+
+
+def normalized_rows(simai):
+    """Row tuples with the sizes of NONE comms zeroed, which is what a round trip preserves."""
+    rows = []
+    for row in simai.rows:
+        values = list(row.astuple())
+        for i in COMM_FIELDS:
+            if values[i] == "NONE":
+                values[i + 1] = 0
+        rows.append(tuple(values))
+    return rows
+
+
+def header_argv(simai):
+    """get_params options describing the parallel layout of a SimAI header."""
+    fields = simai.fields
+    if "all_gpus" not in fields:
+        return []
+    tp, pp, ep = fields.get("model_parallel_NPU_group", 1), fields.get("pp", 1), fields.get("ep", 1)
+    dp = fields["all_gpus"] // (tp * pp)
+    argv = [
+        "--world_size", str(fields["all_gpus"]),
+        "--tensor_model_parallel_size", str(tp),
+        "--pipeline_model_parallel", str(pp),
+        "--expert_model_parallel_size", str(ep),
+        "--global_batch", str(fields.get("ga", 1) * dp),
+        "--micro_batch", "1",
+    ]
+    if ep > 1:
+        argv += ["--num_experts", str(ep)]
+    if "vpp" in fields:
+        argv += ["--num_layers", str(fields["vpp"] * pp)]
+    return argv
+
+
+def dump_workload(workload, args, filename):
+    workload.dump(filename)
+    pkl_filename = os.path.join("results/mocked_workload/", filename.split(".")[0] + "_workload.pkl")
+    with open(pkl_filename, "wb") as f:
+        pickle.dump((workload, args), f)
+    print(f"Workload pickle generated:{pkl_filename}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Validate SimAI workload files and convert them to/from AICB workloads. "
+        "Unrecognized options are passed to get_params."
+    )
+    parser.add_argument("input", help="SimAI .txt workload, or AICB _workload.pkl with --to_simai")
+    parser.add_argument("--to_simai", default=None, help="Convert the AICB workload pickle to this SimAI file")
+    parser.add_argument("--validate_only", action="store_true", help="Only parse and validate the SimAI file")
+    parser.add_argument("--roundtrip", action="store_true", help="Check that SimAI -> Workload -> SimAI keeps the rows")
+    io_args, rest = parser.parse_known_args()
+
+    if io_args.to_simai:
+        workload, args = Workload.load(io_args.input)
+        header = getattr(args, "simai_header", None)
+        assert header, f"{io_args.input} was not converted from a SimAI workload, its header is unknown"
+        simai = workload_to_simai(workload, header)
+        write_simai_workload(simai, io_args.to_simai)
+        print(f"wrote {len(simai.rows)} SimAI rows to {io_args.to_simai}")
+        return
+
+    simai = read_simai_workload(io_args.input)
+    errors = validate_simai_workload(simai)
+    for error in errors:
+        print(f"ERROR: {io_args.input}: {error}")
+    assert not errors, f"{io_args.input} is not a valid SimAI workload"
+    print(f"{io_args.input}: {simai.kind} with {len(simai.rows)} rows, {simai.fields}")
+    if io_args.validate_only:
+        return
+
+    args = get_params(header_argv(simai) + ["--aiob_enable"] + rest)
+    args.simai_header = simai.header
+    workload = simai_to_workload(simai, args.epoch_num)
+    if io_args.roundtrip:
+        back = workload_to_simai(workload, simai.header)
+        assert normalized_rows(back) == normalized_rows(simai), "SimAI rows changed in the round trip"
+        print("round trip ok")
+
+    filename = "simai_replay_" + os.path.basename(io_args.input).rsplit(".", 1)[0] + ".csv"
+    if args.workload_only:
+        dump_workload(workload, args, filename)
+    else:
+        import torch
+        from workload_applyer import WorkloadApplyer
+        from utils.benchmark_logger import bench_logger
+
+        if not hasattr(args, "backend"):
+            args.backend = "nccl"
+        torch.distributed.init_process_group(backend=args.backend)
+        assert torch.distributed.get_world_size() == args.world_size, \
+            f"SimAI workload is for {args.world_size} ranks, job has {torch.distributed.get_world_size()}"
+        args.rank = torch.distributed.get_rank()
+        # only rank 0 writes the workload files, as in aicb.py
+        if args.rank == 0:
+            dump_workload(workload, args, filename)
+        applyer = WorkloadApplyer(workload=workload, args=args)
+        cpu_time = applyer.apply_workload()
+        if torch.distributed.get_rank() == 0:
+            bench_logger.analyze_comm_log()
+            bench_logger.analyze_comm_time()
+            bench_logger.dump_log(filename)
+            print(f"total time for SimAI workload replay is {cpu_time:.4f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""
+Copyright (c) 2021, Alibaba Group;
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Sparse rank-to-rank matrix of the bytes one training iteration sends.
+
+python -m workload_generator.traffic_matrix --world_size 16384 --tensor_model_parallel_size 8 \
+  --pipeline_model_parallel 8 --num_layers 80 --hidden_size 8192 --num_attention_heads 64 --global_batch 4096
+python -m workload_generator.traffic_matrix --workload results/mocked_workload/<workload>.pkl --allreduce_algo tree
+python -m workload_generator.traffic_matrix ... --policy order:pp-tp-dp-cp --gpus_per_node 8
+
+Every comm op of the iteration is expanded over all the groups of its
+comm group type, as RankGenerator('tp-cp-ep-dp-pp') builds them, with
+the traffic pattern of its algorithm, members in group rank order:
+- ring all_reduce/all_gather/reduce_scatter: each member sends
+  2(n-1)/n or (n-1)/n of msg_size to the next one
+- tree all_reduce: two complementary binary trees (NCCL double tree),
+  each carries half of msg_size up and down every edge
+- broadcast/reduce: a chain from/to the first member
+- all_to_all: msg_size / n to every other member
+- isend: the next pipeline stage for forward activations, the previous
+  one for backward gradients
+Without --workload the volume of every pipeline stage is estimated with
+comm_volume; a Workload is one rank's and is applied to every rank.
+
+Bytes of identical ops are summed before the expansion, so the edges of
+each comm group and pattern are generated once, and edges are merged into
+the matrix in chunks, so memory stays proportional to the non-zeros.
+The matrix is saved in results/traffic_matrix/ as a scipy.sparse COO
+.npz (scipy.sparse.load_npz reads it; scipy is not needed to write it).
+"""
+
+import os
+import argparse
+from collections import Counter, defaultdict
+import numpy as np
+from utils.utils import CommGroup, CommType, RankGenerator, get_params
+from workload_generator.comm_volume import estimate_comm_volume, workload_volume
+from workload_generator.placement import GROUP_TOKENS, RANK_ORDER, RING_FACTOR, PlacementModel, Topology
+
+DEFAULT_RESULT_DIR = "results/traffic_matrix"
+# pending edges merged into the matrix at once
+CHUNK_EDGES = 1 << 22
+
+
+class TrafficMatrix:
+    """Sparse num_ranks x num_ranks byte matrix accumulated from edge arrays."""
+
+    def __init__(self, num_ranks, chunk_edges=CHUNK_EDGES):
+        self.num_ranks = num_ranks
+        self.chunk_edges = chunk_edges
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.data = np.zeros(0)
+        self._pending = []
+        self._pending_edges = 0
+
+    def add(self, src, dst, nbytes):
+        """Add nbytes (scalar or array) from every src to the dst of the same index."""
+        src, dst = np.broadcast_arrays(np.asarray(src, dtype=np.int64), np.asarray(dst, dtype=np.int64))
+        keep = src != dst
+        keys = (src * self.num_ranks + dst)[keep]
+        data = np.broadcast_to(np.asarray(nbytes, dtype=float), src.shape)[keep]
+        self._pending.append((keys.ravel(), data.ravel()))
+        self._pending_edges += keys.size
+        if self._pending_edges >= self.chunk_edges:
+            self._merge()
+
+    def _merge(self):
+        if not self._pending:
+            return
+        keys = np.concatenate([self.keys] + [k for k, _ in self._pending])
+        data = np.concatenate([self.data] + [d for _, d in self._pending])
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.data = np.bincount(inverse.ravel(), weights=data, minlength=self.keys.size)
+        self._pending, self._pending_edges = [], 0
+
+    def coo(self):
+        """(row, col, data) of the non-zero entries, sorted by row then col."""
+        self._merge()
+        return self.keys // self.num_ranks, self.keys % self.num_ranks, self.data
+
+    @property
+    def nnz(self):
+        self._merge()
+        return self.keys.size
+
+    def relabel(self, placement):
+        """Matrix of the same traffic with rank r on device placement[r]."""
+        row, col, data = self.coo()
+        matrix = TrafficMatrix(int(placement.max()) + 1, self.chunk_edges)
+        matrix.add(placement[row], placement[col], data)
+        return matrix
+
+    def to_scipy(self):
+        from scipy.sparse import coo_matrix
+
+        row, col, data = self.coo()
+        return coo_matrix((data, (row, col)), shape=(self.num_ranks, self.num_ranks)).tocsr()
+
+    def save(self, filepath):
+        """Save in the scipy.sparse.save_npz layout of a COO matrix."""
+        row, col, data = self.coo()
+        index_dtype = np.int32 if self.num_ranks < 2 ** 31 else np.int64
+        np.savez_compressed(
+            filepath,
+            row=row.astype(index_dtype),
+            col=col.astype(index_dtype),
+            data=data,
+            shape=np.array((self.num_ranks, self.num_ranks)),
+            format=b"coo",
+        )
+
+
+def ring_edges(groups):
+    return groups, np.roll(groups, -1, axis=1)
+
+
+def chain_edges(groups):
+    return groups[:, :-1], groups[:, 1:]
+
+
+def tree_edges(groups):
+    """(child, parent) pairs of the two binary trees of a double tree."""
+    n = groups.shape[1]
+    children = np.arange(1, n)
+    parents = (children - 1) // 2
+    # the second tree is the first one over the members shifted by one
+    shifted = np.roll(groups, -1, axis=1)
+    return (
+        np.concatenate([groups[:, children], shifted[:, children]], axis=1),
+        np.concatenate([groups[:, parents], shifted[:, parents]], axis=1),
+    )
+
+
+def stage_traffic(volume, group_sizes, allreduce_algo="ring"):
+    """{(comm_group, pattern): bytes per edge} of one rank's volume, summed over identical ops."""
+    traffic = defaultdict(float)
+    for (comm_type, comm_group, group_size, msg_size), count in volume.items():
+        if comm_group not in group_sizes:
+            if msg_size and comm_type != CommType.irecv:
+                print(f"WARNING: no rank groups for {comm_group}, {comm_type.value} not in the matrix")
+            continue
+        n = group_size if group_size and group_size > 1 else group_sizes[comm_group]
+        nbytes = count * msg_size
+        if comm_type == CommType.isend:
+            traffic[(comm_group, "p2p")] += nbytes
+        elif n <= 1 or not nbytes:
+            continue
+        elif comm_type == CommType.all_reduce and allreduce_algo == "tree":
+            traffic[(comm_group, "tree")] += nbytes / 2
+        elif comm_type in (CommType.all_reduce, CommType.all_gather, CommType.reduce_scatter):
+            traffic[(comm_group, "ring")] += nbytes * RING_FACTOR[comm_type](n)
+        elif comm_type == CommType.broadcast:
+            traffic[(comm_group, "broadcast")] += nbytes
+        elif comm_type == CommType.reduce:
+            traffic[(comm_group, "reduce")] += nbytes
+        elif comm_type == CommType.all_to_all:
+            traffic[(comm_group, "all_to_all")] += nbytes / n
+    return traffic
+
+
+class TrafficMatrixBuilder:
+    def __init__(self, args, allreduce_algo="ring", chunk_edges=CHUNK_EDGES):
+        self.args = args
+        self.allreduce_algo = allreduce_algo
+        self.generator = RankGenerator(
+            tp=args.tensor_model_parallel_size,
+            ep=args.expert_model_parallel_size,
+            dp=args.dp_num,
+            pp=args.pipeline_model_parallel,
+            cp=args.context_parallel_size,
+            order=RANK_ORDER,
+        )
+        self.world_size = self.generator.world_size
+        self.pp = args.pipeline_model_parallel
+        self.groups = {CommGroup.all: np.arange(self.world_size)[None, :]}
+        for comm_group, (token, independent_ep) in GROUP_TOKENS.items():
+            self.groups[comm_group] = np.array(self.generator.get_ranks(token, independent_ep))
+        self.group_sizes = {group: ranks.shape[1] for group, ranks in self.groups.items()}
+        self.matrix = TrafficMatrix(self.world_size, chunk_edges)
+
+    def stage_of(self, ranks):
+        return ranks // (self.world_size // self.pp)
+
+    def add_traffic(self, traffic, stage=None):
+        """Expand {(comm_group, pattern): bytes} on the groups of pipeline stage `stage`, or on all."""
+        for (comm_group, pattern), nbytes in traffic.items():
+            groups = self.groups[comm_group]
+            if pattern == "p2p":
+                self._add_p2p(nbytes, stage)
+                continue
+            if stage is not None and comm_group != CommGroup.all:
+                groups = groups[self.stage_of(groups[:, 0]) == stage]
+            if pattern == "ring":
+                self.matrix.add(*ring_edges(groups), nbytes)
+            elif pattern == "tree":
+                child, parent = tree_edges(groups)
+                self.matrix.add(child, parent, nbytes)
+                self.matrix.add(parent, child, nbytes)
+            elif pattern == "broadcast":
+                self.matrix.add(*chain_edges(groups), nbytes)
+            elif pattern == "reduce":
+                dst, src = chain_edges(groups)
+                self.matrix.add(src, dst, nbytes)
+            elif pattern == "all_to_all":
+                # one sender column at a time keeps the edges of large groups bounded
+                for i in range(groups.shape[1]):
+                    self.matrix.add(groups[:, i:i + 1], groups, nbytes)
+
+    def _add_p2p(self, nbytes, stage):
+        """isend bytes of one rank: forward to the next stage, backward to the previous one."""
+        if self.pp <= 1:
+            return
+        pipelines = self.groups[CommGroup.pp_group]
+        stages = range(self.pp) if stage is None else [stage]
+        for s in stages:
+            # interior stages send as many activations forward as gradients backward
+            share = nbytes if s in (0, self.pp - 1) else nbytes / 2
+            if s < self.pp - 1:
+                self.matrix.add(pipelines[:, s], pipelines[:, s + 1], share)
+            if s > 0:
+                self.matrix.add(pipelines[:, s], pipelines[:, s - 1], share)
+
+    def add_estimate(self):
+        """Traffic of every pipeline stage estimated by comm_volume."""
+        if self.args.frame != "Megatron":
+            # the DeepSpeed estimate has no pipeline stages
+            volume = estimate_comm_volume(self.args)
+            self.add_traffic(stage_traffic(volume, self.group_sizes, self.allreduce_algo))
+            return self.matrix
+        for stage in range(self.pp):
+            volume = estimate_comm_volume(self.args, pp_rank=stage)
+            self.add_traffic(stage_traffic(volume, self.group_sizes, self.allreduce_algo), stage)
+        return self.matrix
+
+    def add_workload(self, workload, iteration=1):
+        """Traffic of a Workload of one rank, applied to every rank."""
+        volume = workload_volume(workload, iteration)
+        self.add_traffic(stage_traffic(volume, self.group_sizes, self.allreduce_algo))
+        return self.matrix
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the sparse rank-to-rank bytes matrix of one iteration. "
+        "Unrecognized options describe the model, as for the workload generators."
+    )
+    parser.add_argument("--workload", type=str, default=None,
+                        help="Workload pickle to expand instead of the estimated comm volume")
+    parser.add_argument("--allreduce_algo", choices=["ring", "tree"], default="ring")
+    parser.add_argument("--policy", type=str, default=None,
+                        help="Placement policy of workload_generator.placement, the matrix is then per device")
+    parser.add_argument("--gpus_per_node", type=int, default=8)
+    parser.add_argument("--top_k", type=int, default=10, help="Heaviest rank pairs to print")
+    parser.add_argument("--result_dir", type=str, default=DEFAULT_RESULT_DIR)
+    matrix_args, rest = parser.parse_known_args()
+
+    if matrix_args.workload:
+        from log_analyzer.log import Workload
+
+        workload, args = Workload.load(matrix_args.workload)
+        builder = TrafficMatrixBuilder(args, matrix_args.allreduce_algo)
+        matrix = builder.add_workload(workload)
+    else:
+        args = get_params(rest + ["--workload_only"])
+        builder = TrafficMatrixBuilder(args, matrix_args.allreduce_algo)
+        matrix = builder.add_estimate()
+    if matrix_args.policy:
+        topology = Topology.for_world(args.world_size, gpus_per_node=matrix_args.gpus_per_node)
+        placement = PlacementModel(args, Counter(), topology).policy(matrix_args.policy)
+        matrix = matrix.relabel(placement)
+
+    row, col, data = matrix.coo()
+    inter = data[row // matrix_args.gpus_per_node != col // matrix_args.gpus_per_node].sum()
+    print(f"ranks: {matrix.num_ranks}, non-zeros: {matrix.nnz}")
+    print(f"total: {data.sum() / 1024 ** 3:.3f} GB, inter-node: {inter / 1024 ** 3:.3f} GB")
+    from log_analyzer.results_index import print_table
+
+    heaviest = np.argsort(data)[::-1][:matrix_args.top_k]
+    print_table(["src", "dst", "GB"], [[int(row[i]), int(col[i]), round(data[i] / 1024 ** 3, 3)] for i in heaviest])
+
+    os.makedirs(matrix_args.result_dir, exist_ok=True)
+    filepath = os.path.join(
+        matrix_args.result_dir,
+        f"traffic_world_size{args.world_size}-tp{args.tensor_model_parallel_size}-pp{args.pipeline_model_parallel}"
+        f"-ep{args.expert_model_parallel_size}-{matrix_args.allreduce_algo}.npz",
+    )
+    matrix.save(filepath)
+    print(f"traffic matrix save in : {filepath}")
+
+
+if __name__ == "__main__":
+    main()
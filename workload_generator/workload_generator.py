@@ -33,7 +33,6 @@ class WorkloadGenerator:
         for i in range(args.epoch_num):
             if args.pipeline_model_parallel > 1 and args.frame != "collective_test":
                 self.with_pipeline_forward_backward()
-                self.step()
             else:
                 for _ in range(args.num_microbatches):
                     self.forward()